@@ -56,7 +56,7 @@ void emolog_handle_message(emo_header* header, uint32_t ticks)
 	switch (header->type) {
 	case EMO_MESSAGE_TYPE_VERSION: {
 		debug_printf("got Version message.\n");
-		encoded_len = emo_encode_version(buf_out, header->seq);
+		encoded_len = emo_encode_version_window(buf_out, header->seq, EMOLOG_RX_WINDOW);
 		comm_queue_message(buf_out, encoded_len);
 		debug_printf("sending Version message.\n");
 		break;
@@ -14,6 +14,16 @@ extern "C" {
 
 #include "emolog_protocol.h"
 
+/*
+ * Number of requests the host may send before getting the ack of the first,
+ * advertised in the version reply. One message is handled per emolog_run_step,
+ * so set this to the number of sampler_register_variable messages (24 bytes
+ * each) the comm rx buffer can hold. 1 is the classic one-at-a-time protocol.
+ */
+#ifndef EMOLOG_RX_WINDOW
+#define EMOLOG_RX_WINDOW 1
+#endif
+
 void emolog_init(void);
 void emolog_run_step(uint32_t ticks);
 
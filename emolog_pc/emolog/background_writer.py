@@ -0,0 +1,120 @@
+"""
+Writing recordings from a thread, so a stalled disk does not stall the
+asyncio receive path.
+
+CSVHandler wraps its writer in a BackgroundWriter when given a queue size.
+Every write call (one per received batch) becomes a queue entry; the thread
+applies them to the wrapped writer in order.
+
+Overflow policy, when the queue is full:
+
+    block - the receive path waits for the writer thread to make room. No
+            data is lost, but a long enough stall backs up the transport as
+            writing synchronously would.
+    drop  - the batch is discarded and counted in rows_dropped, the receive
+            path never waits. The recording has a gap, logged as a warning.
+"""
+
+from logging import getLogger
+from queue import Queue, Full
+from threading import Thread
+
+
+logger = getLogger('emolog')
+
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP = 'drop'
+OVERFLOW_POLICIES = [OVERFLOW_BLOCK, OVERFLOW_DROP]
+
+DEFAULT_QUEUE_SIZE = 1024
+
+_CLOSE = object()
+
+
+class BackgroundWriter:
+    """
+    Forwards writerow / writerows / write_columns / close of a writer to a
+    thread through a bounded queue. The arguments must not be modified by the
+    caller after the call.
+
+    Errors raised by the wrapped writer are raised again by the next call.
+    """
+
+    def __init__(self, writer, maxsize=DEFAULT_QUEUE_SIZE, overflow=OVERFLOW_BLOCK):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow policy must be one of {}, got {!r}'.format(OVERFLOW_POLICIES, overflow))
+        self.writer = writer
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.high_water = 0
+        self.rows_dropped = 0
+        self.batches_dropped = 0
+        self.error = None
+        self.queue = Queue(maxsize=maxsize)
+        self.thread = Thread(target=self._run, name='emolog-writer', daemon=True)
+        self.thread.start()
+        if hasattr(writer, 'write_columns'):
+            self.write_columns = self._write_columns
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _CLOSE:
+                return
+            if self.error is not None:
+                continue
+            method, args = item
+            try:
+                if method == 'writerows' and not hasattr(self.writer, 'writerows'):
+                    for row in args[0]:
+                        self.writer.writerow(row)
+                else:
+                    getattr(self.writer, method)(*args)
+            except Exception as e:
+                logger.error('recording writer failed: {}'.format(e))
+                self.error = e
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _put(self, method, args, rows):
+        self._check_error()
+        item = (method, args)
+        if self.overflow == OVERFLOW_BLOCK:
+            self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except Full:
+                if self.batches_dropped == 0:
+                    logger.warning('recording writer queue full ({} batches), dropping samples'.format(self.maxsize))
+                self.batches_dropped += 1
+                self.rows_dropped += rows
+                return
+        depth = self.queue.qsize()
+        if depth > self.high_water:
+            self.high_water = depth
+
+    def writerow(self, row):
+        self._put('writerow', (row,), 1)
+
+    def writerows(self, rows):
+        self._put('writerows', (rows,), len(rows))
+
+    def _write_columns(self, seq, ticks, timestamp, values, types):
+        self._put('write_columns', (seq, ticks, timestamp, values, types), len(seq))
+
+    def close(self):
+        """
+        Write everything queued, close the wrapped writer and stop the thread
+        """
+        self.queue.put(_CLOSE)
+        self.thread.join()
+        self._check_error()
+        self.writer.close()
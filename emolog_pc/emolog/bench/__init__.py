@@ -0,0 +1,3 @@
+"""
+Benchmarks of the emotool receive pipeline, see main.py (emotool-bench)
+"""
@@ -0,0 +1,201 @@
+"""
+emotool-bench-dwarf: time reading the variables table from an ELF.
+
+Parses the given ELFs and a synthesized one, many struct variables sharing a
+few types over several compilation units, into the variables table (as the
+ELF cache stores it), with and without the type facts shared between
+variables of a FileParser, and across process counts.
+
+stages:
+    dwarf-legacy  every variable walks its type chain for every fact, for reference
+    dwarf         type facts memoized per type DIE
+    dwarf-names   type facts memoized, reading only --names variables
+    dwarf-jobs    compilation units parsed by a pool of each of --jobs processes
+
+usage: emotool-bench-dwarf [--elf tests/example.out] [--synthetic-vars 2000] [--jobs 1,2,4] [--json results.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+
+from .. import VERSION
+from ..dwarf import FileParser
+from ..elfcache import CachedVariable, parse_elf_variables
+from .main import best_time, comma_separated
+
+
+STAGES = ['dwarf-legacy', 'dwarf', 'dwarf-names', 'dwarf-jobs']
+
+SYNTHETIC_TYPES = 20
+
+SYNTHETIC_CUS = 16
+
+
+class _ForgetfulDict(dict):
+    """
+    Stores nothing: every setdefault returns a fresh dict
+    """
+    def setdefault(self, key, default=None):
+        return default
+
+
+class LegacyFileParser(FileParser):
+    """
+    FileParser without the type facts shared between variables, as it was
+    before type_fact. The reference for the dwarf stage.
+    """
+    @property
+    def type_facts(self):
+        return _ForgetfulDict()
+
+    @type_facts.setter
+    def type_facts(self, value):
+        pass
+
+
+def synthesize_c(num_vars, num_types=SYNTHETIC_TYPES, first_var=0, with_main=True):
+    """
+    :return: C source with num_vars global struct variables of num_types
+             types, each with scalar, array, enum, typedef and nested struct members
+    """
+    lines = ['typedef enum { MODE_OFF = 0, MODE_ON = 1, MODE_FAULT = 2 } mode_t_;',
+             'typedef volatile unsigned short reg_t;',
+             'struct inner { int a; float b; reg_t c[4]; };']
+    for t in range(num_types):
+        lines.append('typedef struct {{ float x{t}; int y; unsigned char z[8]; mode_t_ mode; reg_t reg; '
+                     'struct inner in1; struct inner in2; const volatile long w; }} type{t}_t;'.format(t=t))
+    for i in range(first_var, first_var + num_vars):
+        lines.append('type{}_t var{};'.format(i % num_types, i))
+    if with_main:
+        lines.append('int main(void) { return 0; }')
+    return '\n'.join(lines) + '\n'
+
+
+def synthesize_elf(directory, num_vars, compiler='gcc', num_cus=SYNTHETIC_CUS):
+    """
+    Compile synthesize_c with debug information, num_vars variables spread
+    over num_cus compilation units
+    :return: the ELF filename
+    """
+    sources = []
+    per_cu = -(-num_vars // num_cus)
+    for cu in range(num_cus):
+        first_var = cu * per_cu
+        source = os.path.join(directory, 'synthetic{}_{}.c'.format(num_vars, cu))
+        with open(source, 'w') as fd:
+            fd.write(synthesize_c(max(0, min(per_cu, num_vars - first_var)), first_var=first_var,
+                                  with_main=cu == 0))
+        sources.append(source)
+    elf = os.path.join(directory, 'synthetic{}.out'.format(num_vars))
+    subprocess.check_call([compiler, '-g', '-O0', '-o', elf] + sources)
+    return elf
+
+
+def read_table(filename, parser_factory=FileParser, names=None):
+    """
+    What elfcache stores: every fact of every leaf variable
+    :return: number of leaf variables
+    """
+    file_parser = parser_factory(filename, names=names)
+    return len([CachedVariable.from_var_descriptor(v) for v in file_parser.visit_interesting_vars_tree_leafs()])
+
+
+def make_stage_runner(stage, filename, names, jobs=1):
+    if stage == 'dwarf-jobs':
+        return lambda: len(parse_elf_variables(filename, jobs=jobs))
+    if stage == 'dwarf-legacy':
+        return lambda: read_table(filename, parser_factory=LegacyFileParser)
+    if stage == 'dwarf':
+        return lambda: read_table(filename)
+    if stage == 'dwarf-names':
+        return lambda: read_table(filename, names=names)
+    raise ValueError('unknown stage {}'.format(stage))
+
+
+def run_benchmarks(stage_names, elfs, synthetic_vars, names, repeat, compiler='gcc', jobs=(1,)):
+    """
+    :return: list of result dicts, one per stage and ELF, and per jobs count for dwarf-jobs
+    """
+    results = []
+    with TemporaryDirectory() as tmpdir:
+        elfs = list(elfs) + [synthesize_elf(tmpdir, n, compiler=compiler) for n in synthetic_vars]
+        for elf in elfs:
+            elf_names = names if names else [default_name(elf)]
+            for stage in stage_names:
+                for stage_jobs in (jobs if stage == 'dwarf-jobs' else [None]):
+                    dt, variables = best_time(make_stage_runner(stage, elf, elf_names, stage_jobs), repeat)
+                    results.append(dict(
+                        stage=stage,
+                        jobs=stage_jobs,
+                        elf=os.path.basename(elf),
+                        elf_bytes=os.path.getsize(elf),
+                        variables=variables,
+                        seconds=dt,
+                        variables_per_sec=variables / dt if dt > 0 else None,
+                    ))
+    return results
+
+
+def default_name(elf):
+    """
+    The first top level variable of the ELF, to time reading a single variable
+    """
+    for v in FileParser(elf).interesting_vars:
+        return v.name
+    return ''
+
+
+def print_results(results, out=sys.stdout):
+    print('{:13} {:>4} {:24} {:>10} {:>9} {:>8} {:>11}'.format(
+        'stage', 'jobs', 'elf', 'bytes', 'variables', 'seconds', 'vars/sec'), file=out)
+    for r in results:
+        print('{stage:13} {jobs!s:>4} {elf:24} {elf_bytes:10} {variables:9} {seconds:8.3f} '
+              '{variables_per_sec:11.0f}'.format(**r), file=out)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='emolog ELF variables table reading benchmark')
+    parser.add_argument('--stages', type=comma_separated(str), default=STAGES,
+                        help='comma separated, from {}'.format(','.join(STAGES)))
+    parser.add_argument('--elf', action='append', default=[], help='ELF to time, can be given more than once')
+    parser.add_argument('--synthetic-vars', type=comma_separated(int), default=[2000],
+                        help='comma separated variable counts of synthesized ELFs, empty for none')
+    parser.add_argument('--names', type=comma_separated(str), default=None,
+                        help='comma separated variables for dwarf-names, default is the first in each ELF')
+    parser.add_argument('--jobs', type=comma_separated(int), default=[1, 2, 4],
+                        help='comma separated process counts for dwarf-jobs')
+    parser.add_argument('--compiler', default='gcc', help='compiler for the synthesized ELFs')
+    parser.add_argument('--repeat', type=int, default=3, help='take the best of this many runs')
+    parser.add_argument('--json', default=None, help='write the results as json to this file, - for stdout')
+    args = parser.parse_args(args)
+
+    unknown = [x for x in args.stages if x not in STAGES]
+    if unknown:
+        parser.error('unknown stage {}, choose from {}'.format(','.join(unknown), ','.join(STAGES)))
+
+    results = run_benchmarks(stage_names=args.stages, elfs=args.elf, synthetic_vars=args.synthetic_vars,
+                             names=args.names, repeat=args.repeat, compiler=args.compiler, jobs=args.jobs)
+    if args.json != '-':
+        print_results(results)
+    if args.json is not None:
+        report = dict(
+            emolog_version='.'.join(map(str, VERSION)),
+            python=platform.python_version(),
+            machine=platform.machine(),
+            cpus=os.cpu_count(),
+            results=results,
+        )
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=1)
+        else:
+            with open(args.json, 'w') as fd:
+                json.dump(report, fd, indent=1)
+
+
+if __name__ == '__main__':
+    main()
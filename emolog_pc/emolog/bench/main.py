@@ -0,0 +1,178 @@
+"""
+emotool-bench: throughput of the receive pipeline.
+
+Runs synthesized SamplerSample streams (or an emotool --dump file) through
+each stage of the receive path and end to end, for every combination of
+scenario, variable count and chunk size asked for, and reports samples/sec
+and MB/s of stream.
+
+stages:
+    parser-legacy  the concatenating parser loop, for reference
+    parser         Parser.consume_and_return_messages, a SamplerSample per sample
+    parser-batch   Parser.consume_into, samples into a SampleBatch
+    sampler        VariableSampler decoding, as CSVHandler does it
+    csv            CSVHandler decoding and writing csv
+    emolog-bin     CSVHandler decoding and writing emolog-bin
+    end-to-end     EmotoolCylib.data_received, parsing to csv
+    stream         CSVHandler decoding and streaming to 4 emotool --listen subscribers
+    stream-pickle  the same, pickling for every subscriber as --listen used to, for reference
+    stream-minmax  the same, decimated to 2000 points per second
+
+With --noise, some messages are followed by bursts of random bytes, to time
+resynchronizing after line noise.
+
+usage: emotool-bench [--scenarios uniform,mixed] [--vars 1,8,64] [--chunk-sizes 4096] [--noise 0.1] [--json results.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from .. import VERSION
+from . import streams, stages
+
+
+STAGES = ['parser-legacy', 'parser', 'parser-batch', 'sampler', 'csv', 'emolog-bin', 'end-to-end', 'stream',
+          'stream-pickle', 'stream-minmax']
+# stages that need to know the variables, not available for a dump
+DECODING_STAGES = ['sampler', 'csv', 'emolog-bin', 'end-to-end', 'stream', 'stream-pickle', 'stream-minmax']
+
+
+def comma_separated(convert):
+    def parse(s):
+        return [convert(x) for x in s.split(',') if x]
+    return parse
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        samples = func()
+        dt = perf_counter() - start
+        if best is None or dt < best[0]:
+            best = (dt, samples)
+    return best
+
+
+def make_stage_runner(stage, variables, chunks, batches, tmpdir):
+    filename = os.path.join(tmpdir, 'bench')
+    if stage == 'parser-legacy':
+        return lambda: stages.run_legacy_parser(chunks)
+    if stage == 'parser':
+        return lambda: stages.run_parser(chunks)
+    if stage == 'parser-batch':
+        return lambda: stages.run_batch_parser(chunks)
+    if stage == 'sampler':
+        return lambda: stages.run_sampler(stages.make_sampler(variables), variables, batches)
+    if stage == 'csv':
+        return lambda: stages.run_handler(stages.make_sampler(variables), variables, batches, filename + '.csv')
+    if stage == 'emolog-bin':
+        return lambda: stages.run_handler(stages.make_sampler(variables), variables, batches, filename + '.emob',
+                                          recording_format='emolog-bin')
+    if stage == 'end-to-end':
+        return lambda: stages.run_end_to_end(variables, chunks, filename + '.csv')
+    if stage == 'stream':
+        return lambda: stages.run_stream(stages.make_sampler(variables), variables, batches)
+    if stage == 'stream-pickle':
+        return lambda: stages.run_stream(stages.make_sampler(variables), variables, batches, pickled=True)
+    if stage == 'stream-minmax':
+        return lambda: stages.run_stream(stages.make_sampler(variables), variables, batches,
+                                         points_per_second=stages.STREAM_POINTS_PER_SECOND)
+    raise ValueError('unknown stage {}'.format(stage))
+
+
+def run_benchmarks(stage_names, scenarios, var_counts, chunk_sizes, ticks, repeat, dump=None, noise=0.0):
+    """
+    :return: list of result dicts, one per stage, scenario, variable count and chunk size
+    """
+    results = []
+    if dump is not None:
+        cases = [('dump', None, None, streams.read_dump_chunks(dump))]
+        stage_names = [s for s in stage_names if s not in DECODING_STAGES]
+    else:
+        cases = []
+        for scenario in scenarios:
+            for num_vars in var_counts:
+                variables = streams.make_variables(scenario, num_vars)
+                stream, _samples = streams.synthesize_stream(variables, ticks, noise=noise)
+                for chunk_size in chunk_sizes:
+                    cases.append((scenario, variables, chunk_size, streams.chunked(stream, chunk_size)))
+    with TemporaryDirectory() as tmpdir:
+        for scenario, variables, chunk_size, chunks in cases:
+            total_bytes = sum(len(c) for c in chunks)
+            batches = stages.parse_batches(chunks) if variables is not None else None
+            for stage in stage_names:
+                dt, samples = best_time(make_stage_runner(stage, variables, chunks, batches, tmpdir), repeat)
+                results.append(dict(
+                    stage=stage,
+                    scenario=scenario,
+                    variables=len(variables) if variables is not None else None,
+                    chunk_size=chunk_size,
+                    samples=samples,
+                    bytes=total_bytes,
+                    seconds=dt,
+                    samples_per_sec=samples / dt,
+                    mb_per_sec=total_bytes / dt / 1e6,
+                ))
+    return results
+
+
+def print_results(results, out=sys.stdout):
+    print('{:14} {:9} {:>5} {:>7} {:>9} {:>8} {:>13} {:>9}'.format(
+        'stage', 'scenario', 'vars', 'chunk', 'samples', 'seconds', 'samples/sec', 'MB/s'), file=out)
+    for r in results:
+        print('{stage:14} {scenario:9} {variables!s:>5} {chunk_size!s:>7} {samples:9} {seconds:8.3f} '
+              '{samples_per_sec:13.0f} {mb_per_sec:9.2f}'.format(**r), file=out)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='emolog receive pipeline throughput benchmark')
+    parser.add_argument('--stages', type=comma_separated(str), default=STAGES,
+                        help='comma separated, from {}'.format(','.join(STAGES)))
+    parser.add_argument('--scenarios', type=comma_separated(str), default=streams.SCENARIOS,
+                        help='comma separated, from {}'.format(','.join(streams.SCENARIOS)))
+    parser.add_argument('--vars', type=comma_separated(int), default=[1, 8, 64], help='comma separated variable counts')
+    parser.add_argument('--chunk-sizes', type=comma_separated(int), default=[4096],
+                        help='comma separated bytes per transport read')
+    parser.add_argument('--ticks', type=int, default=20000, help='ticks in each synthesized stream')
+    parser.add_argument('--repeat', type=int, default=3, help='take the best of this many runs')
+    parser.add_argument('--noise', type=float, default=0.0,
+                        help='fraction of the messages followed by line noise in the synthesized streams')
+    parser.add_argument('--dump', default=None,
+                        help='emotool --dump file to use instead of synthesized streams, parser stages only')
+    parser.add_argument('--json', default=None, help='write the results as json to this file, - for stdout')
+    args = parser.parse_args(args)
+
+    for name, given, known in [('stage', args.stages, STAGES), ('scenario', args.scenarios, streams.SCENARIOS)]:
+        unknown = [x for x in given if x not in known]
+        if unknown:
+            parser.error('unknown {} {}, choose from {}'.format(name, ','.join(unknown), ','.join(known)))
+
+    results = run_benchmarks(stage_names=args.stages, scenarios=args.scenarios, var_counts=args.vars,
+                             chunk_sizes=args.chunk_sizes, ticks=args.ticks, repeat=args.repeat, dump=args.dump,
+                             noise=args.noise)
+    if args.json != '-':
+        print_results(results)
+    if args.json is not None:
+        report = dict(
+            emolog_version='.'.join(map(str, VERSION)),
+            python=platform.python_version(),
+            machine=platform.machine(),
+            ticks=args.ticks,
+            noise=args.noise,
+            results=results,
+        )
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=1)
+        else:
+            with open(args.json, 'w') as fd:
+                json.dump(report, fd, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""
+The receive pipeline stages, each run over a whole stream.
+
+Every stage function takes the prepared input of its stage and returns the
+number of samples it handled; main times it.
+"""
+
+import os
+import pickle
+from struct import pack
+
+from ..cylib import (Parser, SamplerSample, SampleBatch, MissingBytes, emo_decode, VariableSampler, CSVHandler,
+                     EmotoolCylib)
+from ..recording import RECORDING_FORMATS
+from ..streaming import SampleStreamServer
+
+
+# subscribers of the stream stages
+STREAM_SUBSCRIBERS = 4
+
+# the rate stream-minmax decimates to, of a target at emotool's default ticks per second
+STREAM_POINTS_PER_SECOND = 2000
+STREAM_TICKS_PER_SECOND = 20000
+
+
+class LegacyParser:
+    """
+    The parsing loop as it was before Parser got its receive buffer: every
+    chunk is concatenated to the leftover bytes, and the leftover is sliced off
+    after decoding. The reference for the parser stage.
+    """
+
+    def __init__(self):
+        self.buf = b''
+
+    def consume_and_return_messages(self, s):
+        self.buf = buf = self.buf + s
+        i = 0
+        n = len(buf)
+        ret = []
+        while i < n:
+            msg, i_next, error = emo_decode(buf, i)
+            if isinstance(msg, MissingBytes):
+                break
+            # old emo_decode returned bytes, not views
+            if isinstance(msg, SamplerSample):
+                msg.payload = bytes(msg.payload)
+            ret.append(msg)
+            i = i_next
+        self.buf = buf[i:]
+        return ret
+
+
+def make_sampler(variables):
+    sampler = VariableSampler()
+    sampler.register_variables(variables)
+    return sampler
+
+
+def parse_batches(chunks):
+    """
+    :return: the SampleBatch instances EmotoolCylib hands CSVHandler, one per
+             chunk with samples
+    """
+    parser = Parser(None)
+    batches = []
+    now = 0.0
+    for chunk in chunks:
+        # a batch per chunk, EmotoolCylib reuses one
+        batch = SampleBatch()
+        parser.consume_into(chunk, batch, now)
+        if len(batch) > 0:
+            batches.append(batch)
+        now += 1.0
+    return batches
+
+
+def run_parser(chunks, parser_factory=lambda: Parser(None)):
+    parser = parser_factory()
+    samples = 0
+    for chunk in chunks:
+        # not len(): the legacy parser returns a SkipBytes per skip
+        for msg in parser.consume_and_return_messages(chunk):
+            if isinstance(msg, SamplerSample):
+                samples += 1
+    return samples
+
+
+def run_legacy_parser(chunks):
+    return run_parser(chunks, parser_factory=LegacyParser)
+
+
+def run_batch_parser(chunks):
+    parser = Parser(None)
+    batch = SampleBatch()
+    samples = 0
+    for chunk in chunks:
+        samples += len(parser.consume_into(chunk, batch, 0.0)) + len(batch)
+    return samples
+
+
+def run_sampler(sampler, variables, batches):
+    """
+    Decoding only, the way CSVHandler decodes: whole batches to columns when
+    possible, else sample by sample
+    """
+    name_to_index = {v['name']: i for i, v in enumerate(variables)}
+    samples = 0
+    for batch in batches:
+        if sampler.columns_from_batch(batch) is None:
+            for now, seq, ticks, payload in batch.samples():
+                sampler.list_from_ticks_and_payload(name_to_index=name_to_index, ticks=ticks, payload=payload)
+        samples += len(batch)
+    return samples
+
+
+def _min_ticks(variables):
+    return min(v['period_ticks'] for v in variables)
+
+
+def run_handler(sampler, variables, batches, filename, recording_format='csv'):
+    """
+    Decoding and writing, CSVHandler.handle_sample_batch
+    """
+    handler = CSVHandler(sampler=sampler, verbose=False, dump=False, csv_writer_factory=None)
+    handler.reset(csv_filename=filename, names=[v['name'] for v in variables], min_ticks=_min_ticks(variables),
+                  max_samples=0, writer_factory=RECORDING_FORMATS[recording_format].writer_factory)
+    for batch in batches:
+        handler.handle_sample_batch(batch)
+    handler.stop()
+    samples = handler.samples_received
+    os.unlink(filename)
+    return samples
+
+
+def run_end_to_end(variables, chunks, filename, recording_format='csv'):
+    """
+    Everything data_received does: parsing, decoding and writing
+    """
+    cylib = EmotoolCylib(parent=None)
+    cylib.sampler.register_variables(variables)
+    cylib.sampler.on_started()
+    cylib.csv_handler.reset(csv_filename=filename, names=[v['name'] for v in variables],
+                            min_ticks=_min_ticks(variables), max_samples=0,
+                            writer_factory=RECORDING_FORMATS[recording_format].writer_factory)
+    for chunk in chunks:
+        cylib.data_received(chunk)
+    cylib.csv_handler.stop()
+    samples = cylib.samples_received
+    os.unlink(filename)
+    return samples
+
+
+class NullTransport:
+    """
+    A subscriber's connection that always keeps up
+    """
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+
+class _NullWriter:
+    def write_columns(self, seq, ticks, timestamp, values, types):
+        pass
+
+    def close(self):
+        pass
+
+
+def _pickling_listener(transports):
+    """
+    What emotool --listen did before streaming.py: every subscriber pickled what it was given
+    """
+    def listener(names, types, seq, ticks, timestamp, values):
+        for transport in transports:
+            pickled = pickle.dumps((names, seq, ticks, timestamp, values))
+            transport.write(pack('<i', len(pickled)))
+            transport.write(pickled)
+    return listener
+
+
+def run_stream(sampler, variables, batches, pickled=False, subscribers=STREAM_SUBSCRIBERS, points_per_second=0):
+    """
+    Decoding and streaming to subscribers, CSVHandler listeners, without writing a recording
+    :param pickled: stream pickles instead of streaming.py frames, for reference
+    :param points_per_second: decimate the stream to this rate with minmax, 0 for every sample
+    """
+    handler = CSVHandler(sampler=sampler, verbose=False, dump=False, csv_writer_factory=None)
+    handler.reset(csv_filename='', names=[v['name'] for v in variables], min_ticks=_min_ticks(variables),
+                  max_samples=0, writer_factory=lambda filename, *args, **kw: _NullWriter())
+    transports = [NullTransport() for _ in range(subscribers)]
+    if pickled:
+        handler.register_listener(_pickling_listener(transports))
+    else:
+        server = SampleStreamServer(points_per_second=points_per_second, ticks_per_second=STREAM_TICKS_PER_SECOND)
+        for transport in transports:
+            server.protocol_factory().connection_made(transport)
+        handler.register_listener(server.listener)
+    for batch in batches:
+        handler.handle_sample_batch(batch)
+    handler.stop()
+    return handler.samples_received
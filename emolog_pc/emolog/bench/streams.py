@@ -0,0 +1,98 @@
+"""
+Sample streams for the benchmarks: synthesized from a set of variables, or
+read from an emotool --dump file.
+"""
+
+from random import Random
+
+from ..cylib import SamplerSample
+from ..decoders import Decoder, ArrayDecoder, NamedDecoder
+from ..dump import read_dump
+
+
+ENUM_NAMES = {0: 'off', 1: 'on', 2: 'fault'}
+
+SCENARIOS = ['uniform', 'mixed', 'decoders']
+
+MIXED_PERIODS = [1, 2, 5, 10, 13]
+
+MAX_NOISE_BURST = 32
+
+
+def make_variables(scenario, num_vars):
+    """
+    :param scenario: one of SCENARIOS
+        uniform  - float variables, all sampled every tick
+        mixed    - float / int32 / int16 variables sampled at different periods and phases
+        decoders - every tick, a mix of floats, 2 element int16 arrays and enums
+    :return: variable dicts as given to VariableSampler.register_variables
+    """
+    variables = []
+    for i in range(num_vars):
+        name = 'v{}'.format(i)
+        period, phase = 1, 0
+        if scenario == 'uniform':
+            size, t = 4, Decoder(name.encode(), b'f')
+        elif scenario == 'mixed':
+            period = MIXED_PERIODS[i % len(MIXED_PERIODS)]
+            phase = i % period
+            size, t = [(4, Decoder(name.encode(), b'f')),
+                       (4, Decoder(name.encode(), b'l')),
+                       (2, Decoder(name.encode(), b'h'))][i % 3]
+        elif scenario == 'decoders':
+            size, t = [(4, Decoder(name.encode(), b'f')),
+                       (4, ArrayDecoder(name.encode(), b'h', 2)),
+                       (1, NamedDecoder(name.encode(), max_unsigned_val=256, unpack_str=b'b',
+                                        val_to_name=ENUM_NAMES))][i % 3]
+        else:
+            raise ValueError('unknown scenario {}'.format(scenario))
+        variables.append(dict(name=name, phase_ticks=phase, period_ticks=period, address=0x1000 + 4 * i,
+                              size=size, _type=t))
+    return variables
+
+
+def _value(v, ticks):
+    t = v['_type']
+    if isinstance(t, NamedDecoder):
+        return ticks % len(ENUM_NAMES)
+    if t.unpack_str == b'f':
+        return float(ticks)
+    if v['size'] == 2:
+        return ticks % 32768
+    return ticks
+
+
+def synthesize_stream(variables, num_ticks, noise=0.0):
+    """
+    :param noise: fraction of the messages followed by a burst of line noise,
+                  up to MAX_NOISE_BURST random bytes
+    :return: (stream bytes, number of samples), one SamplerSample per tick
+             with at least one variable
+    """
+    messages = []
+    num_samples = 0
+    random = Random(0)
+    for ticks in range(num_ticks):
+        var_size_pairs = [(_value(v, ticks), v['size']) for v in variables
+                          if ticks % v['period_ticks'] == v['phase_ticks']]
+        if len(var_size_pairs) == 0:
+            continue
+        messages.append(SamplerSample(seq=ticks % 256, ticks=ticks, var_size_pairs=var_size_pairs).encode())
+        num_samples += 1
+        if noise > 0 and random.random() < noise:
+            messages.append(bytes(random.getrandbits(8) for _ in range(random.randint(1, MAX_NOISE_BURST))))
+    return b''.join(messages), num_samples
+
+
+def chunked(stream, chunk_size):
+    """
+    Split a stream as it would arrive from the transport
+    """
+    return [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+
+def read_dump_chunks(filename):
+    """
+    Read the chunks written by EmotoolCylib.dump_buf, in the order received
+    """
+    return [chunk for _timestamp, chunk in read_dump(filename)]
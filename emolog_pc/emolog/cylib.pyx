@@ -26,12 +26,23 @@ from array import array
 import sys
 from datetime import datetime
 from logging import getLogger
-from struct import pack, unpack
+from struct import pack, unpack, calcsize, Struct
+from math import gcd
 import csv
 
+import numpy as np
+
+from .decoders import Decoder, numpy_dtype_from_unpack_str
+from .background_writer import BackgroundWriter, OVERFLOW_BLOCK
+from .dump import DumpWriter
+from .rotation import RotatingWriter, write_header
+from .ticks import TICKS_WRAP
+
 import builtins # profile will be here when run via kernprof
 
 import cython
+from cpython.bytearray cimport PyByteArray_AS_STRING
+from libc.string cimport memchr
 
 # TODO: line_profiler is not compatible with cython.
 if 'profile' not in builtins.__dict__:
@@ -59,6 +70,7 @@ ctypedef unsigned char uint8_t
 
 cdef extern from "emolog_protocol.h":
     uint16_t emo_encode_version(uint8_t *dest, uint8_t reply_to_seq);
+    uint16_t emo_encode_version_window(uint8_t *dest, uint8_t reply_to_seq, uint8_t window);
     uint16_t emo_encode_ping(uint8_t *dest);
     uint16_t emo_encode_ack(uint8_t *dest, uint8_t reply_to_seq, uint16_t error);
     uint16_t emo_encode_sampler_register_variable(uint8_t *dest, uint32_t phase_ticks,
@@ -70,7 +82,7 @@ cdef extern from "emolog_protocol.h":
     void emo_encode_sampler_sample_add_var(uint8_t *dest, const uint8_t *p, uint16_t size);
     uint16_t emo_encode_sampler_sample_end(uint8_t *dest, uint32_t ticks);
     #int16_t emo_decode(const uint8_t *src, uint16_t size);
-    int16_t emo_decode_with_offset(const uint8_t *src, unsigned offset, uint16_t size);
+    int16_t emo_decode_with_offset(const uint8_t *src, unsigned offset, uint16_t size) nogil;
     void crc_init();
 
 
@@ -122,6 +134,8 @@ def header_size():
 
 MAGIC = unpack(ENDIANESS + 'H', b'EM')[0]
 
+cdef uint8_t MAGIC_FIRST = MAGIC & 0xff
+
 ### Messages
 
 
@@ -151,20 +165,26 @@ cdef class Message:
 
 
 cdef class Version(Message):
+    """
+    window: number of requests the sender can receive before replying to the
+    first one, 0 (reserved by old senders) and 1 mean one at a time.
+    """
     type = emo_message_types.version
-    cdef unsigned version
-    cdef unsigned reply_to_seq
-    def __init__(self, unsigned seq, unsigned version=0, unsigned reply_to_seq=0):
+    cdef public unsigned version
+    cdef public unsigned reply_to_seq
+    cdef public unsigned window
+    def __init__(self, unsigned seq, unsigned version=0, unsigned reply_to_seq=0, unsigned window=0):
         self.seq = seq
         self.version = version
         self.reply_to_seq = reply_to_seq
+        self.window = window
 
     def encode_inner(self):
-        return emo_encode_version(self.buf, self.reply_to_seq if self.reply_to_seq is not None else self.seq)
+        return emo_encode_version_window(self.buf, self.reply_to_seq, self.window)
 
     def handle_by(self, handler):
         #logger.debug("Got Version: {self.version}".format(self=self))
-        handler.ack_received()
+        handler.version_received(self)
 
 
 class Ping(Message):
@@ -186,7 +206,7 @@ class Ack(Message):
     def handle_by(self, handler):
         if self.error != 0:
             logger.error("embedded responded to {reply_to_seq} with ERROR: {error}".format(**self.__dict__))
-        handler.ack_received()
+        handler.ack_received(self.reply_to_seq)
 
     def __str__(self):
         # TODO - string for error
@@ -242,12 +262,13 @@ cdef class SamplerStop(Message):
 cdef class SamplerSample(Message):
     type = emo_message_types.sampler_sample
     cdef public unsigned ticks
-    cdef public bytes payload
+    cdef public object payload
     cdef public list var_size_pairs
 
-    def __init__(self, unsigned seq, unsigned ticks, bytes payload=None, list var_size_pairs=None):
+    def __init__(self, unsigned seq, unsigned ticks, object payload=None, list var_size_pairs=None):
         """
         :param ticks:
+        :param payload: bytes-like, a memoryview into the Parser buffer when decoded
         :param vars: dictionary from variable index to value
         :return:
         """
@@ -286,7 +307,7 @@ cdef class SamplerSample(Message):
             assert self.payload is None
             return '<sample {} var_size_pairs {}>'.format(self.ticks, self.var_size_pairs)
         elif self.payload is not None:
-            return '<sample {} undecoded {}>'.format(self.ticks, repr(self.payload))
+            return '<sample {} undecoded {}>'.format(self.ticks, repr(bytes(self.payload)))
         else:
             return '<sample {} error>'.format(self.ticks)
 
@@ -341,19 +362,13 @@ class UnknownMessage:
 HEADER_FORMAT = ENDIANESS + 'HBHBBB'
 
 
-cdef (unsigned, unsigned, unsigned) decode_emo_header_unsafe(s):
+cdef inline (unsigned, unsigned, unsigned) decode_emo_header_unsafe(const uint8_t *p):
     """
-    Decode emolog header assuming the MAGIC is correct
-    :param s: bytes of header
-    :return: success (None if yes, string of error otherwise), message type (byte), payload length (uint16), message sequence (byte)
+    Decode emolog header assuming the MAGIC and CRC are correct
+    :param p: pointer to the first byte of the header, layout is HEADER_FORMAT
+    :return: message type (byte), payload length (uint16), message sequence (byte)
     """
-    cdef unsigned _magic
-    cdef unsigned _type
-    cdef unsigned length
-    cdef unsigned payload_crc
-    cdef unsigned header_crc
-    _magic, _type, length, seq, payload_crc, header_crc = unpack(HEADER_FORMAT, s)
-    return _type, length, seq
+    return p[2], p[3] | (p[4] << 8), p[5]
 
 
 def decode_emo_header(s):
@@ -369,6 +384,19 @@ def decode_emo_header(s):
     return None, _type, length, seq
 
 
+def numpy_dtype_from_types(types):
+    """
+    Structured dtype of a sample payload containing one value of each of types,
+    or None if any of them has no fixed numpy representation.
+    """
+    fields = []
+    for i, t in enumerate(types):
+        if hasattr(t, 'decode') or t.unpack_str not in numpy_dtype_from_unpack_str:
+            return None
+        fields.append(('f{}'.format(i), numpy_dtype_from_unpack_str[t.unpack_str]))
+    return np.dtype(fields)
+
+
 cdef class RegisteredVariable:
     cdef public str name
     cdef public int phase_ticks
@@ -403,6 +431,11 @@ class Once:
         logger.error(s)
 
 
+# Upper bound on the number of tick patterns VariableSampler keeps decoding
+# plans for
+MAX_PRECOMPUTED_DECODE_PLANS = 1 << 14
+
+
 @cython.final
 cdef class VariableSampler:
     # variables
@@ -415,6 +448,9 @@ cdef class VariableSampler:
     cdef bint _use_unpack
     cdef bint _single_sample
     cdef bytes _single_sample_unpack_str
+    cdef object _single_sample_dtype
+    cdef long long _plans_period
+    cdef dict _plans
     cdef object once
 
     cdef public bint running
@@ -462,8 +498,10 @@ cdef class VariableSampler:
         self._type = [x._type for x in variables]
         # special case really fast - all variables has zero phase and same period
         self._use_unpack = not any(hasattr(t, 'decode') for t in self._type) # conservative
+        self._single_sample_dtype = None
         if len(variables) == 0:
             self._use_unpack = self._single_sample = False
+            self._set_plans()
             return
         if not self._use_unpack:
             logger.info("sample decoding mode: mixed unpack and decoder")
@@ -473,10 +511,105 @@ cdef class VariableSampler:
             if len(variables) > 0 and self._single_sample:
                 logger.info("sample decoding mode: single unpack")
                 self._single_sample_unpack_str = b'<' + b''.join(t.unpack_str for t in self._type)
+                self._single_sample_dtype = numpy_dtype_from_types(self._type)
+                if (self._single_sample_dtype is not None and
+                        self._single_sample_dtype.itemsize != calcsize(self._single_sample_unpack_str)):
+                    self._single_sample_dtype = None
             else:
                 logger.info("sample decoding mode: multiple unpack")
+        if not self._single_sample:
+            self._set_plans()
+
+    cdef _set_plans(self):
+        """
+        The variables contained in a sample depend only on ticks modulo the
+        least common multiple of the periods. Precompute the decoding of each
+        such residue (if there are not too many of them, otherwise they are
+        computed on first use).
+
+        The multiple is computed with python ints, and is capped at
+        TICKS_WRAP: ticks are uint32, so beyond that the residue is the
+        ticks themselves.
+        """
+        period = 1
+        for p in self.period_ticks:
+            period = period * int(p) // gcd(period, int(p))
+            if period >= TICKS_WRAP:
+                period = TICKS_WRAP
+                break
+        self._plans_period = period
+        self._plans = {}
+        if period <= MAX_PRECOMPUTED_DECODE_PLANS:
+            for residue in range(period):
+                self._plans[residue] = self._make_plan(residue)
+            logger.info("sample decoding: {} precomputed tick patterns".format(period))
+
+    cdef tuple _make_plan(self, long long residue):
+        """
+        :return: with unpack: (struct.Struct of the whole payload, indices of the variables, their types)
+                 otherwise: ([(type, index, size, struct.Struct or None if type has a decode method)],)
+        """
+        cdef unsigned i
+        indices = tuple(i for i in range(self.phase_ticks.size)
+                        if residue % self.period_ticks[i] == self.phase_ticks[i])
+        types = tuple(self._type[i] for i in indices)
+        if self._use_unpack:
+            return Struct(b'<' + b''.join(t.unpack_str for t in types)), indices, types
+        return (tuple((t, i, self.size[i], None if hasattr(t, 'decode') else Struct(b'<' + t.unpack_str))
+                      for t, i in zip(types, indices)),)
+
+    cdef tuple _plan(self, long ticks):
+        cdef long long residue = ticks % self._plans_period
+        plan = self._plans.get(residue)
+        if plan is None:
+            plan = self._make_plan(residue)
+            if len(self._plans) < MAX_PRECOMPUTED_DECODE_PLANS:
+                self._plans[residue] = plan
+        return plan
+
+    @property
+    def types(self):
+        return self._type
 
-    cdef list_from_ticks_and_payload(self, dict name_to_index, int ticks, bytes payload):
+    def columns_from_samples(self, list samples):
+        """
+        Decode a whole batch of samples at once.
+
+        Only possible when every sample contains every variable (all periods
+        are 1 and all phases 0) and every variable has a fixed size numpy type.
+
+        :param samples: [(time, seq, ticks, payload)] as in EmotoolCylib.pending_samples
+        :return: (seq, ticks, timestamp, [one array per variable]) or None if
+                 the batch cannot be decoded in one go; use list_from_ticks_and_payload
+                 per sample in that case.
+        """
+        cdef object dtype = self._single_sample_dtype
+        if dtype is None or len(samples) == 0:
+            return None
+        payloads = b''.join([sample[3] for sample in samples])
+        if len(payloads) != len(samples) * dtype.itemsize:
+            return None
+        records = np.frombuffer(payloads, dtype=dtype)
+        timestamp = np.array([sample[0] for sample in samples], dtype=np.float64)
+        seq = np.array([sample[1] for sample in samples], dtype=np.uint8)
+        ticks = np.array([sample[2] for sample in samples], dtype=np.uint32)
+        return seq, ticks, timestamp, [records[name] for name in dtype.names]
+
+    def columns_from_batch(self, SampleBatch batch):
+        """
+        columns_from_samples of a SampleBatch, gathering the payloads from the
+        receive buffer by their offsets.
+        :return: (seq, ticks, timestamp, [one array per variable]), copies the
+                 batch's arrays are not reused into, or None as columns_from_samples
+        """
+        cdef object dtype = self._single_sample_dtype
+        if dtype is None or len(batch) == 0 or (batch.length != dtype.itemsize).any():
+            return None
+        data = np.frombuffer(batch.buf, dtype=np.uint8)
+        records = data[batch.offset.astype(np.intp)[:, None] + np.arange(dtype.itemsize)].view(dtype)[:, 0]
+        return batch.seq.copy(), batch.ticks.copy(), batch.timestamp.copy(), [records[name] for name in dtype.names]
+
+    cpdef list_from_ticks_and_payload(self, dict name_to_index, int ticks, object payload):
         cdef unsigned offset = 0
         cdef unsigned size
         cdef unsigned i
@@ -484,27 +617,25 @@ cdef class VariableSampler:
             values = list(unpack(self._single_sample_unpack_str, payload))
             types = self._type
         else:
-            types_enum = [(self._type[i], i) for i in range(self.phase_ticks.size)
-                        if ticks % self.period_ticks[i] == self.phase_ticks[i]]
+            plan = self._plan(ticks)
             values = [None] * len(self.name)
             types = [None] * len(self.name)
             if self._use_unpack:
-                unpacked = list(unpack(b'<' + b''.join(t.unpack_str for t, i in types_enum), payload))
-                for (t, i), v in zip(types_enum, unpacked):
+                compiled, indices, plan_types = plan
+                for i, t, v in zip(indices, plan_types, compiled.unpack(payload)):
                     values[i] = v
                     types[i] = t
             else:
-                for t, i in types_enum:
-                    size = self.size[i]
+                for t, i, size, compiled in plan[0]:
                     encoded = payload[offset:offset + size]
                     if len(encoded) == 0:
                         self.once.print_error_once('EMBEDDED ERROR: ran out of bytes in sample')
                         val = None
                         continue
-                    if hasattr(t, 'decode'):
+                    if compiled is None:
                         val = t.decode(encoded)
                     else:
-                        val, = unpack(b'<' + t.unpack_str, encoded)
+                        val, = compiled.unpack(encoded)
                     try:
                         ind = name_to_index[self.name[i]]
                         values[ind] = val
@@ -539,31 +670,75 @@ cdef uint8_t *to_str(val, size):
 
 SAMPLER_SAMPLE_TICKS_FORMAT = ENDIANESS + 'L'
 
+cdef unsigned SAMPLER_SAMPLE_TYPE = emo_message_types.sampler_sample
 
-cpdef emo_decode(bytes buf, unsigned i_start):
-    cdef unsigned n = len(buf)
+
+cdef inline unsigned decode_ticks_unsafe(const uint8_t *p) nogil:
+    """
+    :param p: pointer to the first byte of a sampler sample payload, the ticks
+    """
+    return p[0] | (p[1] << 8) | (p[2] << 16) | (<unsigned>p[3] << 24)
+
+
+cdef tuple decode_message(const uint8_t *p, object view, unsigned i_start, unsigned n):
+    """
+    Decode a single message starting at p[i_start], with p[:n] valid.
+
+    view is a memoryview over the same bytes as p; payloads are returned as
+    slices of it so decoding does not copy.
+    """
+    return decode_checked_message(p, view, i_start, n, emo_decode_with_offset(p, i_start, min(n - i_start, 0xffff)))
+
+
+cdef Py_ssize_t skip_to_message(const uint8_t *p, Py_ssize_t i, Py_ssize_t n, int skip) nogil:
+    """
+    Resynchronize after emo_decode found no valid message at p[i] and asked to
+    skip bytes: look for the next header start (the first MAGIC byte) and check
+    it with emo_decode, until a valid message or one needing more bytes.
+    :return: index of that message, n if all the bytes up to n can be skipped
+    """
+    cdef const uint8_t *found
+    cdef int needed
+    i += skip
+    while i < n:
+        if p[i] != MAGIC_FIRST:
+            found = <const uint8_t *>memchr(p + i, MAGIC_FIRST, n - i)
+            if found == NULL:
+                return n
+            i = found - p
+        needed = emo_decode_with_offset(p, i, min(n - i, 0xffff))
+        if needed >= 0:
+            return i
+        i -= needed
+    return n
+
+
+cdef tuple decode_checked_message(const uint8_t *p, object view, unsigned i_start, unsigned n, int needed):
+    """
+    decode_message, given what emo_decode returned for p[i_start:n]
+    """
     cdef object error = None
     cdef unsigned payload_start
-    cdef bytes header # make not a copy
-    cdef bytes payload # make not a copy
     cdef unsigned emo_type
     cdef unsigned emo_len
     cdef unsigned seq
-    cdef int needed = emo_decode_with_offset(buf, i_start, min(n - i_start, 0xffff))
+    cdef unsigned i_next
 
     if needed == 0:
         payload_start = i_start + HEADER_SIZE
-        header = buf[i_start : payload_start]
-        emo_type, emo_len, seq = decode_emo_header_unsafe(header)
+        emo_type, emo_len, seq = decode_emo_header_unsafe(p + i_start)
         i_next = payload_start + emo_len
-        payload = buf[payload_start : i_next]
         if emo_type == emo_message_types.sampler_sample:
-            # TODO: this requires having a variable map so we can compute the variables from ticks
-            ticks = unpack(SAMPLER_SAMPLE_TICKS_FORMAT, payload[:4])[0]
-            msg = SamplerSample(seq=seq, ticks=ticks, payload=payload[4:])
-        elif emo_type == emo_message_types.version:
-            (client_version, reply_to_seq, reserved) = unpack(ENDIANESS + 'HBB', payload)
-            msg = Version(seq=seq, version=client_version, reply_to_seq=reply_to_seq)
+            if emo_len < 4:
+                # no room for the ticks, as in decode_messages
+                return SkipBytes(HEADER_SIZE + emo_len), i_next, 'skip bytes'
+            msg = SamplerSample(seq=seq, ticks=decode_ticks_unsafe(p + payload_start),
+                                payload=view[payload_start + 4 : i_next])
+            return msg, i_next, error
+        payload = view[payload_start : i_next]
+        if emo_type == emo_message_types.version:
+            (client_version, reply_to_seq, window) = unpack(ENDIANESS + 'HBB', payload)
+            msg = Version(seq=seq, version=client_version, reply_to_seq=reply_to_seq, window=window)
         elif emo_type == emo_message_types.ack:
             (error, reply_to_seq) = unpack(ENDIANESS + 'HB', payload)
             msg = Ack(seq=seq, error=error, reply_to_seq=reply_to_seq)
@@ -579,9 +754,9 @@ cpdef emo_decode(bytes buf, unsigned i_start):
             msg = SamplerRegisterVariable(seq=seq, phase_ticks=phase_ticks, period_ticks=period_ticks,
                                           address=address, size=size)
         else:
-            msg = UnknownMessage(seq=seq, type=emo_type, buf=Message.buf)
+            msg = UnknownMessage(type=emo_type, buf=payload)
     elif needed > 0:
-        msg = MissingBytes(message=buf, header=buf[i_start : i_start + HEADER_SIZE], needed=needed)
+        msg = MissingBytes(message=view[i_start : n], header=view[i_start : i_start + HEADER_SIZE], needed=needed)
         i_next = i_start + needed
         error = 'missing bytes'
     else:
@@ -591,68 +766,397 @@ cpdef emo_decode(bytes buf, unsigned i_start):
     return msg, i_next, error
 
 
+cpdef emo_decode(buf, unsigned i_start):
+    """
+    Decode a single message from any bytes-like object starting at i_start.
+    :return: message, index of next message, error (None if message is valid)
+    """
+    cdef const uint8_t[::1] data = buf
+    cdef unsigned n = len(data)
+    if n == 0:
+        return decode_message(NULL, memoryview(buf), 0, 0)
+    return decode_message(&data[0], memoryview(buf), i_start, n)
+
+
+# Initial number of samples of a SampleBatch. It grows (doubling) if a single
+# read holds more.
+SAMPLE_BATCH_INITIAL_SIZE = 1024
+
+
+ctypedef struct sample_columns_t:
+    # the arrays of a SampleBatch, for decode_messages
+    double *timestamp
+    uint8_t *seq
+    uint32_t *ticks
+    uint32_t *offset
+    uint32_t *length
+    Py_ssize_t size
+    Py_ssize_t n
+
+
+cdef class SampleBatch:
+    """
+    The sampler samples decoded from one received chunk, see Parser.consume_into.
+
+    Instead of a SamplerSample per sample, every sample is a row of
+    preallocated arrays: timestamp (float64), seq (uint8), ticks (uint32),
+    and the offset and length of its payload in buf, the Parser receive
+    buffer. The arrays are reused for every chunk; the properties return
+    views of the current len(batch) rows, valid until the next chunk.
+    """
+    cdef sample_columns_t columns
+    cdef object _timestamp
+    cdef object _seq
+    cdef object _ticks
+    cdef object _offset
+    cdef object _length
+    cdef double[::1] timestamp_view
+    cdef uint8_t[::1] seq_view
+    cdef uint32_t[::1] ticks_view
+    cdef uint32_t[::1] offset_view
+    cdef uint32_t[::1] length_view
+    cdef public bytearray buf
+
+    def __init__(self, Py_ssize_t size=SAMPLE_BATCH_INITIAL_SIZE):
+        self.columns.n = 0
+        self.buf = None
+        self._allocate(max(size, 1))
+
+    cdef _allocate(self, Py_ssize_t size):
+        """
+        Replace the arrays by ones of size rows, keeping the current rows
+        """
+        cdef Py_ssize_t n = self.columns.n
+        arrays = []
+        for old, dtype in [(self._timestamp, np.float64), (self._seq, np.uint8), (self._ticks, np.uint32),
+                           (self._offset, np.uint32), (self._length, np.uint32)]:
+            new = np.empty(size, dtype=dtype)
+            if n > 0:
+                new[:n] = old[:n]
+            arrays.append(new)
+        self._timestamp, self._seq, self._ticks, self._offset, self._length = arrays
+        self.timestamp_view = self._timestamp
+        self.seq_view = self._seq
+        self.ticks_view = self._ticks
+        self.offset_view = self._offset
+        self.length_view = self._length
+        self.columns.timestamp = &self.timestamp_view[0]
+        self.columns.seq = &self.seq_view[0]
+        self.columns.ticks = &self.ticks_view[0]
+        self.columns.offset = &self.offset_view[0]
+        self.columns.length = &self.length_view[0]
+        self.columns.size = size
+
+    cdef reserve(self, Py_ssize_t n):
+        """
+        Make room for n more samples
+        """
+        cdef Py_ssize_t size = self.columns.size
+        if self.columns.n + n <= size:
+            return
+        while size < self.columns.n + n:
+            size *= 2
+        self._allocate(size)
+
+    def clear(self):
+        self.columns.n = 0
+        self.buf = None
+
+    def truncate(self, Py_ssize_t n):
+        """
+        Drop all but the first n samples
+        """
+        if n < self.columns.n:
+            self.columns.n = max(n, 0)
+
+    def __len__(self):
+        return self.columns.n
+
+    @property
+    def timestamp(self):
+        return self._timestamp[:self.columns.n]
+
+    @property
+    def seq(self):
+        return self._seq[:self.columns.n]
+
+    @property
+    def ticks(self):
+        return self._ticks[:self.columns.n]
+
+    @property
+    def offset(self):
+        return self._offset[:self.columns.n]
+
+    @property
+    def length(self):
+        return self._length[:self.columns.n]
+
+    def payload(self, Py_ssize_t i):
+        cdef unsigned offset = self.offset_view[i]
+        return memoryview(self.buf)[offset:offset + self.length_view[i]]
+
+    def samples(self):
+        """
+        :return: [(time, seq, ticks, payload)] as in EmotoolCylib.pending_samples, for
+                 decoding sample by sample
+        """
+        cdef Py_ssize_t i
+        cdef unsigned offset
+        view = memoryview(self.buf) if self.buf is not None else None
+        ret = []
+        for i in range(self.columns.n):
+            offset = self.offset_view[i]
+            ret.append((self.timestamp_view[i], self.seq_view[i], self.ticks_view[i],
+                        view[offset:offset + self.length_view[i]]))
+        return ret
+
+
+cdef inline int append_sample(sample_columns_t *columns, double timestamp, unsigned seq, unsigned ticks,
+                              unsigned offset, unsigned length) nogil:
+    cdef Py_ssize_t i = columns.n
+    columns.timestamp[i] = timestamp
+    columns.seq[i] = seq
+    columns.ticks[i] = ticks
+    columns.offset[i] = offset
+    columns.length[i] = length
+    columns.n = i + 1
+    return 0
+
+
+ctypedef struct decoded_message_t:
+    # a valid message other than a sample decoded into a batch
+    unsigned offset # of the header
+    uint8_t type
+
+
+ctypedef struct decode_result_t:
+    Py_ssize_t end # first byte not decoded
+    Py_ssize_t num_messages
+    Py_ssize_t skipped_bytes
+    Py_ssize_t resyncs
+    bint full # stopped for lack of room in the messages or the samples
+
+
+# messages other than batched samples decode_messages returns in one call
+cdef enum:
+    MAX_DECODED_MESSAGES = 256
+
+
+cdef Py_ssize_t decode_messages(const uint8_t *p, Py_ssize_t i, Py_ssize_t n,
+                                decoded_message_t *messages, Py_ssize_t max_messages,
+                                sample_columns_t *samples, double now, decode_result_t *result) nogil:
+    """
+    Decode the messages of p[i:n] without creating any object: sampler
+    samples are appended to samples, unless it is NULL, the other messages
+    are listed in messages. Line noise is skipped, see skip_to_message.
+
+    Stops at the first incomplete message, or when messages or samples are full.
+    :return: number of messages listed, also in result
+    """
+    cdef int needed
+    cdef Py_ssize_t i_next
+    cdef unsigned emo_type
+    cdef unsigned emo_len
+    cdef unsigned seq
+    result.num_messages = 0
+    result.skipped_bytes = 0
+    result.resyncs = 0
+    result.full = False
+    while i < n:
+        needed = emo_decode_with_offset(p, i, min(n - i, 0xffff))
+        if needed > 0:
+            break
+        if needed < 0:
+            i_next = skip_to_message(p, i, n, -needed)
+            result.skipped_bytes += i_next - i
+            result.resyncs += 1
+            i = i_next
+            continue
+        # decode_emo_header_unsafe, without the tuple
+        emo_type = p[i + 2]
+        emo_len = p[i + 3] | (p[i + 4] << 8)
+        seq = p[i + 5]
+        if samples != NULL and emo_type == SAMPLER_SAMPLE_TYPE and emo_len >= 4:
+            if samples.n == samples.size:
+                result.full = True
+                break
+            append_sample(samples, now, seq, decode_ticks_unsafe(p + i + HEADER_SIZE), i + HEADER_SIZE + 4,
+                          emo_len - 4)
+        else:
+            if result.num_messages == max_messages:
+                result.full = True
+                break
+            messages[result.num_messages].offset = i
+            messages[result.num_messages].type = emo_type
+            result.num_messages += 1
+        i += HEADER_SIZE + emo_len
+    result.end = i
+    return result.num_messages
+
+
+# Initial size of the Parser receive buffer. It grows (doubling) if a single
+# read plus the unparsed leftover does not fit.
+PARSER_INITIAL_BUFFER_SIZE = 1 << 16
+
+
 cdef class Parser:
+    """
+    Incremental decoder of an emolog byte stream.
+
+    Received chunks are copied once into a preallocated bytearray and decoded
+    in place. Message payloads are memoryview slices of that bytearray. Bytes
+    that were already returned as messages are never overwritten: when there
+    is no room left the unparsed tail is moved to a fresh buffer, so payloads
+    stay valid for as long as the caller holds them.
+
+    Line noise is skipped in a single scan to the next valid message, see
+    skip_to_message; the skipped bytes are only counted, see skip_stats.
+
+    A chunk is decoded by decode_messages without the GIL. Message objects are
+    then created for what it listed: the control messages, and the samples
+    unless decoding into a SampleBatch.
+    """
+    cdef decoded_message_t messages[MAX_DECODED_MESSAGES]
+    cdef public unsigned long long skipped_bytes
+    cdef public unsigned long long resyncs
     cdef unsigned send_seq
     cdef unsigned empty_count
-    cdef bytes buf
+    cdef bytearray buf
+    cdef object view
+    cdef Py_ssize_t start # first byte not yet decoded
+    cdef Py_ssize_t end # one past the last received byte
     cdef object transport
     cdef bint debug_message_encoding
     cdef bint debug_message_decoding
 
-    def __init__(self, transport, bint debug=False):
-        self.buf = b''
+    def __init__(self, transport, bint debug=False, Py_ssize_t buffer_size=PARSER_INITIAL_BUFFER_SIZE):
+        self._set_buffer(bytearray(max(buffer_size, HEADER_SIZE)))
+        self.start = 0
+        self.end = 0
         self.send_seq = 0
         self.empty_count = 0
+        self.skipped_bytes = 0
+        self.resyncs = 0
         self.set_transport(transport)
 
         # debug flags
         self.debug_message_encoding = debug
         self.debug_message_decoding = debug
 
-    cpdef consume_and_return_messages(self, bytes s):
-        if len(s) == 0:
+    cdef _set_buffer(self, bytearray buf):
+        self.buf = buf
+        self.view = memoryview(buf)
+
+    cdef _reserve(self, Py_ssize_t n):
+        """
+        Make room for n more bytes after self.end
+        """
+        cdef Py_ssize_t pending = self.end - self.start
+        cdef Py_ssize_t size = len(self.buf)
+        cdef bytearray new_buf
+        if self.end + n <= size:
+            return
+        while size < pending + n:
+            size *= 2
+        new_buf = bytearray(size)
+        new_buf[:pending] = self.view[self.start:self.end]
+        self._set_buffer(new_buf)
+        self.start = 0
+        self.end = pending
+
+    @property
+    def pending(self):
+        """
+        Number of received bytes not yet decoded into messages
+        """
+        return self.end - self.start
+
+    @property
+    def buffer_size(self):
+        return len(self.buf)
+
+    @property
+    def skip_stats(self):
+        """
+        :return: dict of skipped_bytes, the bytes not part of any valid message,
+                 and resyncs, the number of times the stream was resynchronized
+        """
+        return dict(skipped_bytes=self.skipped_bytes, resyncs=self.resyncs)
+
+    cpdef consume_and_return_messages(self, s):
+        return self._consume(s, None, 0)
+
+    cpdef list consume_into(self, s, SampleBatch batch, double now):
+        """
+        Like consume_and_return_messages, but sampler samples are decoded
+        into batch rather than returned as SamplerSample instances.
+        :param batch: cleared first, holds the samples of s afterwards
+        :param now: timestamp of the samples
+        :return: the other messages
+        """
+        batch.clear()
+        return self._consume(s, batch, now)
+
+    cdef list _consume(self, s, SampleBatch batch, double now):
+        cdef Py_ssize_t len_s = len(s)
+        if len_s == 0:
             self.empty_count += 1
             # stream closed - quit - but wait a bit to be sure
             if self.empty_count > 2:
                 logger.info("DEBUG - SHOULD WE SYSTEM EXIT HERE?")
                 raise SystemExit()
-        self.buf = self.buf + s
-        cdef unsigned i = 0
-        cdef unsigned i_next
-        cdef bytes buf = self.buf
-        cdef unsigned n = len(buf)
+        self._reserve(len_s)
+        self.buf[self.end:self.end + len_s] = s
+        self.end += len_s
+        cdef Py_ssize_t i = self.start
+        cdef Py_ssize_t n = self.end
+        cdef const uint8_t *p = <const uint8_t *>PyByteArray_AS_STRING(self.buf)
+        cdef object view = self.view
         cdef list ret = []
-        while i < n:
-            msg, i_next, error = emo_decode(buf, i_start=i)
-            if error:
-                if isinstance(msg, SkipBytes):
-                    parsed_buf = buf[i:i_next]
-                    logger.debug("communication error - skipped {} bytes: {}".format(msg.skip, parsed_buf))
-                elif isinstance(msg, MissingBytes):
-                    break
-                else:
-                    logger.error(error)
-            if self.debug_message_decoding:
-                if error:
-                    logger.error("decoding error, buf length {}, error: {}".format(n, error))
-                elif not hasattr(msg, 'type'):
+        cdef sample_columns_t *samples = NULL
+        cdef decode_result_t result
+        cdef Py_ssize_t skipped = 0
+        cdef Py_ssize_t resyncs = 0
+        cdef Py_ssize_t k
+        if batch is not None:
+            batch.buf = self.buf
+            samples = &batch.columns
+        while True:
+            if batch is not None:
+                # every sample is at least a header and ticks
+                batch.reserve((n - i) // (HEADER_SIZE + 4) + 1)
+            with nogil:
+                decode_messages(p, i, n, self.messages, MAX_DECODED_MESSAGES, samples, now, &result)
+            skipped += result.skipped_bytes
+            resyncs += result.resyncs
+            for k in range(result.num_messages):
+                msg, i_next, error = decode_checked_message(p, view, self.messages[k].offset, n, 0)
+                if type(msg) is SkipBytes:
+                    skipped += msg.skip
+                    resyncs += 1
+                    continue
+                if self.debug_message_decoding and not hasattr(msg, 'type'):
                     logger.debug("decoded {}".format(msg))
-                else:
-                    pass # TODO: return this but only when run with --debug - it is slow otherwise
-                    #logger.debug("decoded header: type {}, len {}, seq {} (buf #{})".format(
-                    #    emo_message_type_to_str[msg.type], i_next - i, msg.seq, n))
-            ret.append(msg)
-            i = i_next
-        self.buf = self.buf[i:]
-        if len(self.buf) > 1024:
+                ret.append(msg)
+            i = result.end
+            if not result.full:
+                break
+        if resyncs > 0:
+            self.skipped_bytes += skipped
+            self.resyncs += resyncs
+            logger.debug("communication error - skipped {} bytes in {} places".format(skipped, resyncs))
+        consumed = i - self.start
+        self.start = i
+        if self.end - self.start > 1024:
             logger.warning("WARNING: something is wrong with the packet decoding: {} bytes left (from {})".format(
-                len(self.buf), len(self.buf) + i))
+                self.end - self.start, self.end - self.start + consumed))
         return ret
 
     def send_message(self, command_class, **kw):
         """
-        Sends a command to the client and waits for a reply and returns it.
-        Blocking.
+        Sends a command to the client, does not wait for the reply.
+        :return: the seq in the sent header, which the reply's reply_to_seq refers to
         """
         command = command_class(seq=self.send_seq, **kw)
         self.send_seq += 1
@@ -660,12 +1164,13 @@ cdef class Parser:
         if self.debug_message_encoding:
             logger.debug("sending: {}, encoded as {}".format(command, encoded))
         self.transport.write(encoded)
+        return decode_emo_header_unsafe(encoded)[2]
 
     def set_transport(self, transport):
         self.transport = transport
 
     def __str__(self):
-        return '<Parser: #{}: {!r}'.format(len(self.buf), self.buf)
+        return '<Parser: #{}: {!r}'.format(self.end - self.start, bytes(self.view[self.start:self.end]))
 
     __repr__ = __str__
 
@@ -695,6 +1200,9 @@ class ClosingWriter:
         self.writer = csv.writer(fd, *args, **kw)
         self.fd = fd
 
+    def flush(self):
+        self.fd.flush()
+
     def close(self):
         self.fd.flush()
         self.fd.close()
@@ -702,6 +1210,9 @@ class ClosingWriter:
     def writerow(self, *args, **kw):
         self.writer.writerow(*args, **kw)
 
+    def writerows(self, *args, **kw):
+        self.writer.writerows(*args, **kw)
+
 
 def default_csv_factory(filename, fields, *args, **kw):
     """
@@ -728,6 +1239,13 @@ cdef class CSVHandler:
     cdef dict name_to_index
     cdef VariableSampler sampler
     cdef object writer
+    cdef object writer_factory
+    cdef bint _columnar
+    cdef object background_writer
+    cdef long writer_queue_size
+    cdef str writer_overflow
+    cdef long rotate_samples
+    cdef double rotate_seconds
 
     cdef public str csv_filename
     cdef public object csv_writer_factory
@@ -736,7 +1254,12 @@ cdef class CSVHandler:
     cdef public long ticks_lost
     cdef public long samples_received
 
-    def __init__(self, sampler, verbose, dump, csv_writer_factory):
+    def __init__(self, sampler, verbose, dump, csv_writer_factory, writer_queue_size=0, writer_overflow=OVERFLOW_BLOCK):
+        """
+        :param writer_queue_size: if not 0, write from a thread through a queue of this many
+                                  batches, see background_writer
+        :param writer_overflow: what to do when that queue is full, background_writer.OVERFLOW_POLICIES
+        """
         self.sampler = sampler
         self.verbose = verbose
         self.dump = dump
@@ -753,9 +1276,23 @@ cdef class CSVHandler:
         if csv_writer_factory is None:
             csv_writer_factory = default_csv_factory
         self.csv_writer_factory = csv_writer_factory
+        self.writer_queue_size = writer_queue_size
+        self.writer_overflow = writer_overflow
+        self.background_writer = None
 
-    def reset(self, str csv_filename, list names, long min_ticks, unsigned long max_samples):
+    def reset(self, str csv_filename, list names, long min_ticks, unsigned long max_samples, writer_factory=None,
+              long rotate_samples=0, double rotate_seconds=0):
+        """
+        Start a new recording.
+        :param writer_factory: factory to use for this recording instead of csv_writer_factory,
+                               see recording.RECORDING_FORMATS
+        :param rotate_samples, rotate_seconds: if either is not 0, write the recording in parts of at most
+                                               that many samples / host seconds, see rotation
+        """
         self.csv_filename = csv_filename
+        self.writer_factory = writer_factory if writer_factory is not None else self.csv_writer_factory
+        self.rotate_samples = rotate_samples
+        self.rotate_seconds = rotate_seconds
         self.first_ticks = -1
         self.last_ticks = -1
         self.min_ticks = min_ticks
@@ -769,6 +1306,9 @@ cdef class CSVHandler:
         self.writer = self._init_csv()
 
     def register_listener(self, callback):
+        """
+        :param callback: called with every decoded batch, see _notify_listeners
+        """
         self.sample_listeners.add(callback)
 
     cpdef bint running(self):
@@ -778,16 +1318,39 @@ cdef class CSVHandler:
         if not self._running:
             return
         self._running = False
-        self.writer.close()
+        if self.writer is not None:
+            self.writer.close()
+
+    @property
+    def writer_stats(self):
+        """
+        :return: dict of queue_depth, high_water, queue_size, rows_dropped of the background writer,
+                 None if writing synchronously
+        """
+        writer = self.background_writer
+        if writer is None:
+            return None
+        return dict(queue_depth=writer.queue_depth, high_water=writer.high_water,
+                    queue_size=writer.maxsize, rows_dropped=writer.rows_dropped)
 
     cdef _init_csv(self):
         if self.csv_filename is None:
             return
-        writer = self.csv_writer_factory(self.csv_filename, fields=self.csv_fields, lineterminator='\n')
-        if hasattr(writer, 'writeheader'):
-            writer.writeheader()
+        if self.rotate_samples > 0 or self.rotate_seconds > 0:
+            # writes the header of every part itself
+            writer = RotatingWriter(self.csv_filename, self.csv_fields, self.writer_factory,
+                                    rotate_samples=self.rotate_samples, rotate_seconds=self.rotate_seconds,
+                                    lineterminator='\n')
         else:
-            writer.writerow(self.csv_fields)
+            writer = self.writer_factory(self.csv_filename, fields=self.csv_fields, lineterminator='\n')
+            # columnar writers get the decoded values, not csv rows, and write their own header
+            if not hasattr(writer, 'write_columns'):
+                write_header(writer, self.csv_fields)
+        self._columnar = hasattr(writer, 'write_columns')
+        self.background_writer = None
+        if self.writer_queue_size > 0:
+            writer = self.background_writer = BackgroundWriter(
+                writer, maxsize=self.writer_queue_size, overflow=self.writer_overflow)
         return writer
 
     # python version for profiling
@@ -797,10 +1360,8 @@ cdef class CSVHandler:
         :param msgs: [(time, seq, ticks, {name: value})]
         :return: None
         """
-        cdef list new_float_only_msgs
         cdef int missing
         cdef double now
-        cdef bint have_listeners
 
         if not self._running:
             return
@@ -810,29 +1371,125 @@ cdef class CSVHandler:
             missing = self.max_samples - self.samples_received
             if len(time_and_msgs) > missing:
                 del time_and_msgs[missing:]
-        # TODO - decode variables (integer/float) in emolog VariableSampler
-        have_listeners = len(self.sample_listeners) > 0
-        if have_listeners:
-            new_float_only_msgs = []
-        name_to_index = self.name_to_index
-        for now, seq, ticks, payload in time_and_msgs:
-            types, values = self.sampler.list_from_ticks_and_payload(name_to_index=name_to_index, ticks=ticks, payload=payload)
-            row_start = [seq, ticks, now]
-            self.writer.writerow(row_start + [(encode_if_bytes(t.to_csv_val(v)) if v is not None else None) for t, v in zip(types, values)])
-            if self.first_ticks == -1:
-                self.first_ticks = ticks
-            if self.last_ticks != -1 and ticks - self.last_ticks != self.min_ticks:
-                logger.warning("{:8.5}: ticks jump {:6} -> {:6} [{:6}]".format(
-                    now / 1000, self.last_ticks, ticks, ticks - self.last_ticks))
-                self.ticks_lost += ticks - self.last_ticks - self.min_ticks
-            self.last_ticks = ticks
-        if have_listeners:
-            for listener in self.sample_listeners:
-                listener(new_float_only_msgs)
-        self.samples_received += len(time_and_msgs)
+        if len(time_and_msgs) == 0:
+            return
+        columns = self.sampler.columns_from_samples(time_and_msgs)
+        if columns is None and self._columnar:
+            columns = self._columns_from_samples(time_and_msgs)
+        if columns is not None:
+            seq, ticks, timestamp, values = columns
+            self._handle_columns(seq, ticks, timestamp, values)
+        else:
+            name_to_index = self.name_to_index
+            rows = []
+            for now, seq, ticks, payload in time_and_msgs:
+                types, values = self.sampler.list_from_ticks_and_payload(name_to_index=name_to_index, ticks=ticks, payload=payload)
+                row_start = [seq, ticks, now]
+                rows.append(row_start + [(encode_if_bytes(t.to_csv_val(v)) if v is not None else None) for t, v in zip(types, values)])
+                self._check_ticks(now, ticks)
+            self._writerows(rows)
+        if len(self.sample_listeners) > 0:
+            if columns is None:
+                columns = self._columns_from_samples(time_and_msgs)
+            seq, ticks, timestamp, values = columns
+            self._notify_listeners(seq, ticks, timestamp, values)
+        self._samples_handled(len(time_and_msgs))
+
+    cpdef handle_sample_batch(self, SampleBatch batch):
+        """
+        handle_sampler_samples of a SampleBatch, decoded to columns straight
+        from the receive buffer when possible
+        """
+        if not self._running:
+            return
+        if self.max_samples > 0:
+            batch.truncate(self.max_samples - self.samples_received)
+        columns = self.sampler.columns_from_batch(batch)
+        if columns is None:
+            self.handle_sampler_samples(batch.samples())
+            return
+        seq, ticks, timestamp, values = columns
+        self._handle_columns(seq, ticks, timestamp, values)
+        self._notify_listeners(seq, ticks, timestamp, values)
+        self._samples_handled(len(batch))
+
+    cdef _notify_listeners(self, seq, ticks, timestamp, list values):
+        """
+        Listeners are called with (names, types, seq, ticks, timestamp, values),
+        values having one array or list (None where not sampled) per name
+        """
+        for listener in self.sample_listeners:
+            listener(self.names, self.sampler.types, seq, ticks, timestamp, values)
+
+    cdef _samples_handled(self, Py_ssize_t n):
+        self.samples_received += n
         if self.max_samples != 0 and self.samples_received >= self.max_samples:
             self.stop()
 
+    cdef _check_ticks(self, double now, long ticks):
+        if self.first_ticks == -1:
+            self.first_ticks = ticks
+        if self.last_ticks != -1 and ticks - self.last_ticks != self.min_ticks:
+            logger.warning("{:8.5}: ticks jump {:6} -> {:6} [{:6}]".format(
+                now / 1000, self.last_ticks, ticks, ticks - self.last_ticks))
+            self.ticks_lost += ticks - self.last_ticks - self.min_ticks
+        self.last_ticks = ticks
+
+    cdef _handle_columns(self, seq, ticks, timestamp, list values):
+        """
+        Write a batch decoded into columns, see VariableSampler.columns_from_samples
+        """
+        if self._columnar:
+            self.writer.write_columns(seq, ticks, timestamp, values, self.sampler.types)
+        else:
+            self._write_rows(seq, ticks, timestamp, values)
+        # vectorized version of _check_ticks, calling it only for the jumps
+        if self.first_ticks == -1:
+            self.first_ticks = ticks[0]
+        ticks = ticks.astype(np.int64)
+        previous = np.empty_like(ticks)
+        previous[1:] = ticks[:-1]
+        previous[0] = self.last_ticks if self.last_ticks != -1 else ticks[0] - self.min_ticks
+        for i in np.flatnonzero(ticks - previous != self.min_ticks):
+            self.last_ticks = previous[i]
+            self._check_ticks(timestamp[i], ticks[i])
+        self.last_ticks = ticks[-1]
+
+    cdef _write_rows(self, seq, ticks, timestamp, list values):
+        cdef list columns = []
+        for t, column in zip(self.sampler.types, values):
+            column = column.tolist()
+            if type(t) is not Decoder:
+                column = [encode_if_bytes(t.to_csv_val(v)) for v in column]
+            columns.append(column)
+        self._writerows(list(zip(seq.tolist(), ticks.tolist(), timestamp.tolist(), *columns)))
+
+    cdef _writerows(self, list rows):
+        """
+        One call per batch, so a background writer gets a single queue entry
+        """
+        if hasattr(self.writer, 'writerows'):
+            self.writer.writerows(rows)
+        else:
+            for row in rows:
+                self.writer.writerow(row)
+
+    cdef tuple _columns_from_samples(self, list time_and_msgs):
+        """
+        Decode sample by sample into columns, for columnar writers when
+        VariableSampler.columns_from_samples cannot be used. Variables missing
+        from a sample are None.
+        """
+        cdef list columns = [[] for _ in self.names]
+        for now, seq, ticks, payload in time_and_msgs:
+            types, values = self.sampler.list_from_ticks_and_payload(name_to_index=self.name_to_index, ticks=ticks, payload=payload)
+            for column, v in zip(columns, values):
+                column.append(v)
+        return (np.array([x[1] for x in time_and_msgs], dtype=np.uint8),
+                np.array([x[2] for x in time_and_msgs], dtype=np.uint32),
+                np.array([x[0] for x in time_and_msgs], dtype=np.float64),
+                columns)
+
 #####
 
 cdef class EmotoolCylib:
@@ -845,43 +1502,57 @@ cdef class EmotoolCylib:
     cdef object parent
     cdef public VariableSampler sampler
     cdef public list pending_samples
+    cdef public SampleBatch sample_batch
     cdef public Parser parser
     cdef public CSVHandler csv_handler
 
-    def __init__(self, parent, verbose=False, dump=None, csv_writer_factory=None):
+    def __init__(self, parent, verbose=False, dump=None, csv_writer_factory=None, writer_queue_size=0,
+                 writer_overflow=OVERFLOW_BLOCK):
         self.parent = parent
         self.verbose = verbose
         self.dump = dump is not None and dump is not False
         if dump:
-            self.dump_out = open(dump, 'wb')
+            self.dump_out = DumpWriter(dump)
         self.sampler = VariableSampler()
         self.pending_samples = []
+        self.sample_batch = SampleBatch()
         self.parser = Parser(None, debug=self.verbose)
         self.csv_handler = CSVHandler(sampler=self.sampler, verbose=verbose, dump=dump,
-                                      csv_writer_factory=csv_writer_factory)
+                                      csv_writer_factory=csv_writer_factory,
+                                      writer_queue_size=writer_queue_size, writer_overflow=writer_overflow)
 
     @property
     def samples_received(self):
         return self.csv_handler.samples_received
 
-    def dump_buf(self, buf):
-        self.dump_out.write(pack('<fI', utc(), len(buf)) + buf)
+    def dump_buf(self, buf, timestamp=None):
+        self.dump_out.write(utc() if timestamp is None else timestamp, buf)
         #self.dump.flush()
 
     def _debug_log(self, s):
         logger.debug(s)
 
-    def data_received(self, bytes data):
+    def data_received(self, bytes data, timestamp=None):
+        """
+        :param timestamp: utc seconds data was received at, None for now; given when replaying a dump
+        """
+        if timestamp is None:
+            timestamp = utc()
         if self.dump:
-            self.dump_buf(data)
-        for msg in self.parser.consume_and_return_messages(data):
+            self.dump_buf(data, timestamp)
+        for msg in self.parser.consume_into(data, self.sample_batch, timestamp * 1000):
             msg.handle_by(self)
+        if len(self.sample_batch) > 0 and self.sampler.running:
+            self.csv_handler.handle_sample_batch(self.sample_batch)
         if len(self.pending_samples) > 0:
             self.csv_handler.handle_sampler_samples(self.pending_samples)
             del self.pending_samples[:]
 
-    def ack_received(self):
-        self.parent.set_future_result(self.parent.ack, True)
+    def ack_received(self, reply_to_seq):
+        self.parent.ack_received(reply_to_seq)
+
+    def version_received(self, version):
+        self.parent.version_received(version)
 
     def running(self):
         return self.csv_handler.running()
@@ -0,0 +1,105 @@
+"""
+Decimation of live samples to a target rate, for plots and --listen
+subscribers that do not need every sample. Recordings are always written at
+the full rate.
+
+The ticks axis is cut into buckets, and every bucket becomes:
+
+    stride - its first row
+    minmax - two rows: the first with the minimum of every variable in the
+             bucket, the second with the maximum. The first row has the
+             ticks of the bucket's first row, the second those of its last.
+             Peaks survive decimation, unlike with stride. Buckets are twice
+             as wide, for the same rate.
+
+Batches are decimated as a whole with numpy. Buckets continue across batches:
+stride remembers the last bucket sent, minmax holds back the rows of the
+last bucket of a batch until a later batch starts a new one.
+"""
+
+import numpy as np
+
+
+DECIMATION_MINMAX = 'minmax'
+DECIMATION_STRIDE = 'stride'
+DECIMATION_METHODS = [DECIMATION_MINMAX, DECIMATION_STRIDE]
+
+# column layout of the arrays decimated, as streaming.stream_arrays makes them
+TICKS_COLUMN = 1
+FIRST_VALUE_COLUMN = 3
+
+
+class Decimator:
+    """
+    Called with every batch, as a list of columns: sequence, ticks, timestamp
+    and the variables, floats with NaN where not sampled. Returns the
+    decimated columns, possibly empty.
+    """
+
+    def __init__(self, method, points_per_second, ticks_per_second):
+        if method not in DECIMATION_METHODS:
+            raise ValueError('decimation method must be one of {}, got {!r}'.format(DECIMATION_METHODS, method))
+        if points_per_second <= 0 or ticks_per_second <= 0:
+            raise ValueError('decimation needs positive rates, got {} points and {} ticks per second'.format(
+                points_per_second, ticks_per_second))
+        self.method = method
+        self.points_per_second = points_per_second
+        self.bucket_ticks = ticks_per_second / points_per_second
+        if method == DECIMATION_MINMAX:
+            self.bucket_ticks *= 2
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the previous batches, for a new recording
+        """
+        self.last_bucket = None
+        self.pending = None
+
+    def buckets(self, ticks):
+        return np.floor(ticks / self.bucket_ticks)
+
+    def __call__(self, arrays):
+        if self.method == DECIMATION_STRIDE:
+            return self._stride(arrays)
+        return self._minmax(arrays)
+
+    def _stride(self, arrays):
+        if len(arrays[TICKS_COLUMN]) == 0:
+            return arrays
+        buckets = self.buckets(arrays[TICKS_COLUMN])
+        keep = np.empty(len(buckets), dtype=bool)
+        keep[0] = buckets[0] != self.last_bucket
+        np.not_equal(buckets[1:], buckets[:-1], out=keep[1:])
+        self.last_bucket = buckets[-1]
+        return [a[keep] for a in arrays]
+
+    def _minmax(self, arrays):
+        fixed = arrays[:FIRST_VALUE_COLUMN]
+        # one reduceat over all the variables
+        values = np.column_stack(arrays[FIRST_VALUE_COLUMN:]) if len(arrays) > FIRST_VALUE_COLUMN else None
+        if self.pending is not None:
+            pending_fixed, pending_values = self.pending
+            fixed = [np.concatenate((p, a)) for p, a in zip(pending_fixed, fixed)]
+            if values is not None:
+                values = np.concatenate((pending_values, values))
+        ticks = fixed[TICKS_COLUMN]
+        if len(ticks) == 0:
+            return arrays
+        buckets = self.buckets(ticks)
+        starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+        # the last bucket may go on in the next batch
+        complete = starts[-1]
+        self.pending = ([a[complete:] for a in fixed], values[complete:] if values is not None else None)
+        starts = starts[:-1]
+        rows = np.empty(2 * len(starts), dtype=np.intp)
+        rows[0::2] = starts
+        rows[1::2] = np.concatenate((starts[1:], [complete])) - 1
+        ret = [a[rows] for a in fixed]
+        if values is not None:
+            decimated = np.empty((values.shape[1], len(rows)), dtype=values.dtype)
+            if len(starts) > 0:
+                decimated[:, 0::2] = np.fmin.reduceat(values[:complete], starts).T
+                decimated[:, 1::2] = np.fmax.reduceat(values[:complete], starts).T
+            ret.extend(decimated)
+        return ret
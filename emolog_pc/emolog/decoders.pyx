@@ -70,3 +70,22 @@ def unpack_str_from_size(size):
     else:
         raise Exception("unhandled size in unpack_str_from_size: {size}".format(size=size))
     return s
+
+
+# struct format character to little endian numpy dtype, for decoding whole
+# batches of samples with numpy.frombuffer
+numpy_dtype_from_unpack_str = {
+    b'b': 'i1',
+    b'B': 'u1',
+    b'h': '<i2',
+    b'H': '<u2',
+    b'i': '<i4',
+    b'I': '<u4',
+    b'l': '<i4',
+    b'L': '<u4',
+    b'q': '<i8',
+    b'Q': '<u8',
+    b'f': '<f4',
+    b'd': '<f8',
+    b'c': 'S1',
+}
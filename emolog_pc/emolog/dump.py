@@ -0,0 +1,63 @@
+"""
+emotool --dump files: the bytes received from the target, chunk by chunk as
+received, for replaying through the receive pipeline (emotool --replay).
+
+Layout (little endian):
+
+    magic        8 bytes, DUMP_MAGIC
+    records      until end of file, each:
+                 float64 utc seconds when received
+                 uint32 length
+                 length received bytes
+
+Dumps written before the magic was added have records with a float32
+timestamp (LEGACY_RECORD_HEADER_FORMAT) and no magic. That timestamp is too
+coarse to be of use, such dumps are read with None timestamps.
+"""
+
+from struct import pack, unpack, calcsize
+
+
+DUMP_MAGIC = b'EMODUMP\x01'
+RECORD_HEADER_FORMAT = '<dI'
+LEGACY_RECORD_HEADER_FORMAT = '<fI'
+
+
+class DumpWriter:
+    def __init__(self, filename):
+        self.fd = open(filename, 'wb')
+        self.fd.write(DUMP_MAGIC)
+
+    def write(self, timestamp, buf):
+        """
+        :param timestamp: utc seconds buf was received at
+        """
+        self.fd.write(pack(RECORD_HEADER_FORMAT, timestamp, len(buf)) + buf)
+
+    def close(self):
+        self.fd.close()
+
+
+def read_dump(filename):
+    """
+    Read a dump, including the ones written before DUMP_MAGIC. A truncated
+    last record, as left by a killed emotool, is ignored.
+    :return: iterator of (utc seconds or None for old dumps, received bytes)
+    """
+    with open(filename, 'rb') as fd:
+        magic = fd.read(len(DUMP_MAGIC))
+        if magic == DUMP_MAGIC:
+            header_format = RECORD_HEADER_FORMAT
+        else:
+            header_format = LEGACY_RECORD_HEADER_FORMAT
+            fd.seek(0)
+        header_size = calcsize(header_format)
+        while True:
+            header = fd.read(header_size)
+            if len(header) < header_size:
+                return
+            timestamp, length = unpack(header_format, header)
+            buf = fd.read(length)
+            if len(buf) < length:
+                return
+            yield (timestamp if header_format == RECORD_HEADER_FORMAT else None), buf
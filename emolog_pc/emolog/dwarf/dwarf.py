@@ -52,8 +52,10 @@ typedef enum {
 
 import sys
 import logging
+import mmap
 import struct
-from functools import reduce
+from bisect import bisect_right
+from functools import reduce, wraps
 from itertools import chain
 
 from elftools.elf.elffile import ELFFile
@@ -75,32 +77,83 @@ logger = logging.getLogger('dwarf')
 uleb128 = _ULEB128('dummy')
 
 
+class LazyDieMap(dict):
+    """
+    offset to DIE mapping that parses the DIEs on first use, standing in for
+    FileParser.all_dies when not every DIE is read
+    """
+    def __init__(self, dwarfinfo) -> None:
+        super().__init__()
+        self.dwarfinfo = dwarfinfo
+
+    def __missing__(self, offset: int) -> DIE:
+        die = self[offset] = self.dwarfinfo.get_DIE_from_refaddr(offset)
+        return die
+
+
+def top_level_name(full_name: str) -> str:
+    return full_name.split('.', 1)[0]
+
+
 class FileParser:
-    def __init__(self, filename: str) -> None:
+    def __init__(self, filename: str, names: Optional[List[str]] = None,
+                 cu_offsets: Optional[List[int]] = None) -> None:
+        """
+        :param names: None to read every variable. Else only the variables
+            with these top level names are read (for 'motor.state' the
+            variable 'motor' with all of its members): their DIEs are found
+            through a name index of the compilation units' variables, instead
+            of reading every DIE and describing every variable.
+        :param cu_offsets: when reading every variable, None for all
+            compilation units, else only the variables of the units at these
+            offsets are read. DIEs they refer to in other units are read on
+            first use.
+        """
         self.all_dies = {}
         self.elf_file = None
         self.symbol_table = None
+        self.name_index = None
+        # type DIE offset to the facts VarDescriptor derived from it, see type_fact
+        self.type_facts = {}
+        # section number to its contents, see get_section_data
+        self.section_data = {}
+        self.symbol_addresses = None
+        self.var_descriptors_by_name = None
         f = open(filename, 'rb')
         logger.debug('Processing file: {}'.format(filename))
         self.elf_file = ELFFile(f)
-        self.read_dies_from_dwarf_file()
+        try:
+            self.elf_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.elf_mmap = None
         # the following assumes there's just one symbol table (ELF format allows more than one):
         self.symbol_tables = [x for x in self.elf_file.iter_sections() if isinstance(x, SymbolTableSection)]
-        self.symbol_table = {x.name: x for x in chain(*[s.iter_symbols() for s in self.symbol_tables])}
-        var_dies = {offset: die for offset, die in self.all_dies.items() if die.tag == 'DW_TAG_variable' and 'DW_AT_type' in die.attributes}
-        logger.debug("read %d DIEs which include %d variable DIEs" % (len(self.all_dies), len(var_dies)))
+        self.symbols = list(chain(*[s.iter_symbols() for s in self.symbol_tables]))
+        self.symbol_table = {x.name: x for x in self.symbols}
+        if names is None:
+            self.read_dies_from_dwarf_file(cu_offsets)
+            var_dies = {offset: die for offset, die in self.all_dies.items() if die.tag == 'DW_TAG_variable' and 'DW_AT_type' in die.attributes}
+            logger.debug("read %d DIEs which include %d variable DIEs" % (len(self.all_dies), len(var_dies)))
+        else:
+            var_dies = self.read_var_dies_by_name(names)
+            logger.debug("read %d variable DIEs for %d names" % (len(var_dies), len(names)))
         self.var_descriptors = var_descriptors = []
         for offset, var_die in var_dies.items():
             var_descriptors.append(VarDescriptor(self, self.all_dies, var_die, None))
         self.interesting_vars = [v for v in var_descriptors if v.is_interesting()]
         # note the file is intentionally kept open, otherwise some functions would fail later
 
-    def read_dies_from_dwarf_file(self) -> None:
+    def read_dies_from_dwarf_file(self, cu_offsets: Optional[List[int]] = None) -> None:
         if not self.elf_file.has_dwarf_info():
             logger.error('file has no DWARF info')
             return
         dwarfinfo = self.elf_file.get_dwarf_info()
+        if cu_offsets is not None:
+            cu_offsets = set(cu_offsets)
+            self.all_dies = LazyDieMap(dwarfinfo)
         for CU in dwarfinfo.iter_CUs():
+            if cu_offsets is not None and CU.cu_offset not in cu_offsets:
+                continue
             top_DIE = CU.get_top_DIE()
             self.read_die_rec(top_DIE)
 
@@ -109,6 +162,41 @@ class FileParser:
         for child in die.iter_children():
             self.read_die_rec(child)
 
+    def read_var_dies_by_name(self, names: List[str]) -> Dict[int, DIE]:
+        """
+        :param names: full or top level variable names
+        :return: offset to DIE of the variables with the top level names of names
+        """
+        if not self.elf_file.has_dwarf_info():
+            logger.error('file has no DWARF info')
+            return {}
+        dwarfinfo = self.elf_file.get_dwarf_info()
+        self.all_dies = LazyDieMap(dwarfinfo)
+        wanted = {top_level_name(name) for name in names}
+        self.name_index = self.build_name_index(dwarfinfo, recursive=False)
+        if not wanted <= self.name_index.keys():
+            # function static variables are only found by reading every DIE
+            self.name_index = self.build_name_index(dwarfinfo, recursive=True)
+        offsets = sorted(chain(*[self.name_index.get(name, []) for name in wanted]))
+        return {offset: self.all_dies[offset] for offset in offsets}
+
+    @staticmethod
+    def build_name_index(dwarfinfo, recursive: bool) -> Dict[str, List[int]]:
+        """
+        :param recursive: False to index only the variables at the top of each
+            compilation unit and in namespaces, skipping functions' DIEs.
+        :return: variable name to the offsets of the variable DIEs with that name
+        """
+        index = {}
+        for CU in dwarfinfo.iter_CUs():
+            dies = CU.iter_DIEs() if recursive else iter_namespace_dies(CU.get_top_DIE())
+            for die in dies:
+                if die.tag != 'DW_TAG_variable' or 'DW_AT_type' not in die.attributes or \
+                        'DW_AT_name' not in die.attributes:
+                    continue
+                index.setdefault(die.attributes['DW_AT_name'].value.decode('utf-8'), []).append(die.offset)
+        return index
+
     def visit_interesting_vars_tree_leafs(self) -> Generator['VarDescriptor', None, None]:
         for v in self.interesting_vars:
             yield from v.visit_leafs()
@@ -120,14 +208,53 @@ class FileParser:
             print("{}{!s}".format('   ' * tab, v))
             self.pretty_print(children=v.children, tab=tab + 1)
 
-    def read_value_at_address(self, address, size, section_name='st_shndx'):
+    def get_section_data(self, section_num: int) -> Tuple[int, Union[bytes, memoryview]]:
         """
+        Start address and contents of a section, read once: a view of the
+        mapped ELF file, or the decoded data for NOBITS and compressed sections
         """
-        return None
-        section_num = symbol.entry[section_name]
-        section = self.elf_file.get_section(section_num)
-        section_start_addr = section['sh_addr']
-        return section.data()[address - section_start_addr : address - section_start_addr + size]
+        ret = self.section_data.get(section_num)
+        if ret is None:
+            section = self.elf_file.get_section(section_num)
+            if self.elf_mmap is not None and section['sh_type'] != 'SHT_NOBITS' and \
+                    not getattr(section, 'compressed', False):
+                data = memoryview(self.elf_mmap)[section['sh_offset']:section['sh_offset'] + section['sh_size']]
+            else:
+                data = section.data()
+            ret = self.section_data[section_num] = (section['sh_addr'], data)
+        return ret
+
+    def read_section_bytes(self, section_num: int, address: int, size: int) -> bytes:
+        section_start_addr, data = self.get_section_data(section_num)
+        return bytes(data[address - section_start_addr:address - section_start_addr + size])
+
+    def build_symbol_address_index(self) -> None:
+        """
+        Sort the data symbols by address, for read_value_at_address
+        """
+        symbols = sorted((symbol['st_value'], symbol['st_size'], symbol.entry['st_shndx'])
+                         for symbol in self.symbols
+                         if symbol['st_info']['type'] == 'STT_OBJECT' and symbol['st_size'] > 0 and
+                         isinstance(symbol.entry['st_shndx'], int))
+        self.symbol_addresses = [address for address, _size, _section_num in symbols]
+        self.symbols_by_address = symbols
+
+    def read_value_at_address(self, address: int, size: int) -> Optional[bytes]:
+        """
+        :return: the initial bytes at address, from the section of the data
+                 symbol containing it, None if no data symbol contains it
+        """
+        if not isinstance(address, int) or size is None:
+            return None
+        if self.symbol_addresses is None:
+            self.build_symbol_address_index()
+        i = bisect_right(self.symbol_addresses, address) - 1
+        if i < 0:
+            return None
+        symbol_address, symbol_size, section_num = self.symbols_by_address[i]
+        if address + size > symbol_address + symbol_size:
+            return None
+        return self.read_section_bytes(section_num, address, size)
 
     def get_value_by_name(self, name, var_descriptor=None):
         if self.symbol_table is None:
@@ -149,16 +276,25 @@ class FileParser:
         # size = symbol['st_size']  # NOT GOOD, rounded to multiple of 4 or something.
         # have to look up size in DWARF data (var_descriptor):
         if var_descriptor is None: # hack - mixed use cases. should fix
-            var_descriptor = [x for x in self.var_descriptors if x.name == name]
-            if var_descriptor is None or len(var_descriptor) > 1:
+            if self.var_descriptors_by_name is None:
+                self.var_descriptors_by_name = {}
+                for v in self.var_descriptors:
+                    self.var_descriptors_by_name.setdefault(v.name, []).append(v)
+            var_descriptor = self.var_descriptors_by_name.get(name, [])
+            if len(var_descriptor) != 1:
                 return None  # TODO more meaningful error return values?
             var_descriptor = var_descriptor[0]
         size = var_descriptor.size
         if size is None:
             return None  # TODO more meaningful error return values?
-        section = self.elf_file.get_section(section_num)
-        section_start_addr = section['sh_addr']
-        return section.data()[address - section_start_addr : address - section_start_addr + size]
+        return self.read_section_bytes(section_num, address, size)
+
+
+def iter_namespace_dies(die: DIE) -> Iterator[DIE]:
+    for child in die.iter_children():
+        yield child
+        if child.tag == 'DW_TAG_namespace':
+            yield from iter_namespace_dies(child)
 
 
 DW_OP_plus_uconst = 0x23    # Page 20
@@ -183,6 +319,27 @@ int_unpack_from_size = {
 }
 
 
+def type_fact(method):
+    """
+    Memoize a VarDescriptor method that depends only on the variable's type
+    DIE, in FileParser.type_facts. Every variable and struct member of a type
+    then shares one walk of its type chain.
+
+    The returned value is shared too, callers must not modify it.
+    """
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self):
+        if not isinstance(self.type, DIE):
+            return method(self)
+        facts = self.parser.type_facts.setdefault(self.type.offset, {})
+        if name not in facts:
+            facts[name] = method(self)
+        return facts[name]
+    return wrapper
+
+
 class VarDescriptor:
 
     uninteresting_var_names = ['main_func_sp', 'g_pfnVectors']
@@ -224,8 +381,11 @@ class VarDescriptor:
         self.address = self.parse_location()
         self.type = self.get_type_die(var_die)
         self.size = self._get_size()
-        # look for default value
-        init_value = self.parser.get_value_by_name(self.name, self)
+        # look for default value: by symbol for variables, within the containing symbol for members
+        if self.parent is None:
+            init_value = self.parser.get_value_by_name(self.name, self)
+        else:
+            init_value = self.parser.read_value_at_address(self.address, self.size)
         if init_value is not None and \
                 not isinstance(init_value, int) and \
                 len(init_value) > 0 and \
@@ -291,7 +451,7 @@ class VarDescriptor:
         opcode = loc.value[0]
         if len(loc.value) == 9 and opcode == DW_OP_addr: # seen with amd64 compilation of static variables
             # should use host endianess
-            return struct.unpack('<q', struct.pack('bbbbbbbb', *loc.value[1:]))[0]
+            return struct.unpack('<q', bytes(loc.value[1:]))[0]
         if len(loc.value) != 5 or opcode != DW_OP_addr:
             return self.ADDRESS_TYPE_UNSUPPORTED
         a, b, c, d = loc.value[1:]
@@ -324,10 +484,10 @@ class VarDescriptor:
             and not self.name.startswith('$')   # not sure when these pop up but they are not interesting
             and not self.name in VarDescriptor.uninteresting_var_names)
 
+    @type_fact
     def get_die_tags(self) -> List[str]:
         type_chain, last_type = self.visit_type_chain()
-        type_chain.append(last_type)
-        return [die.tag for die in type_chain]
+        return [die.tag for die in type_chain + [last_type]]
 
     def is_pointer(self) -> bool:
         return self.DW_TAG_pointer_type in self.get_die_tags()
@@ -354,14 +514,15 @@ class VarDescriptor:
             return default
         return attr.value
 
+    @type_fact
     def get_array_type(self) -> Optional[DIE]:
         type_chain, last_type = self.visit_type_chain()
-        type_chain.append(last_type)
-        for die in type_chain:
+        for die in type_chain + [last_type]:
             if die.tag == self.DW_TAG_array_type:
                 return die
         return None
 
+    @type_fact
     def visit_type_chain(self) -> Union[Tuple[List[DIE], DIE], Tuple[List[Any], DIE]]:
         cur_type = self.type
         all_but_last = []
@@ -385,15 +546,18 @@ class VarDescriptor:
         assert len(with_tag) == 1, 'more than a single tag {tag} in {v}'.format(tag=tag, v=v)
         return with_tag[0]
 
+    @type_fact
     def get_enum_type(self) -> None:
         return self.get_only_die_in_type_chain(self.DW_TAG_enumeration_type, required=False)
 
+    @type_fact
     def get_enum_dict(self):
         enum_type = self.get_enum_type()
         return {c.attributes['DW_AT_name'].value.decode('utf-8'):
                     c.attributes['DW_AT_const_value'].value
                 for c in enum_type.iter_children()}
 
+    @type_fact
     def get_type_str(self) -> str:
         type_str = []
         all_but_last, last_cur_type = self.visit_type_chain()
@@ -415,6 +579,7 @@ class VarDescriptor:
 
         return ' '.join(type_str)
 
+    @type_fact
     def get_array_sizes(self) -> List[int]:
         res = []
         array_type = self.get_array_type()
@@ -430,6 +595,7 @@ class VarDescriptor:
             res.append(child.attributes[self.DW_AT_upper_bound].value + 1)
         return res
 
+    @type_fact
     def get_array_flat_length(self) -> int:
         bounds = self.get_array_sizes()
         if bounds is None or len(bounds) == 0:
@@ -444,9 +610,10 @@ class VarDescriptor:
             return byte_size.value
         return None
 
+    @type_fact
     def _get_size(self) -> int:
         type_chain, last_type = self.visit_type_chain()
-        type_chain.append(last_type)
+        type_chain = type_chain + [last_type]
 
         # get the element size from the last type-die in the chain that does have a size:
         for type_die in reversed(type_chain):
@@ -472,12 +639,16 @@ class VarDescriptor:
             byte_size = elem_size
         return byte_size
 
-    def _create_children(self) -> List[Any]:
+    @type_fact
+    def _get_member_dies(self) -> List[DIE]:
         all_but_last, last = self.visit_type_chain()
         if last.tag in {'DW_TAG_class_type', 'DW_TAG_structure_type'} and last.has_children:
-            return [VarDescriptor(self.parser, self.all_dies, v, self) for v in last.iter_children() if v.tag == 'DW_TAG_member' and 'DW_AT_type' in v.attributes]
+            return [v for v in last.iter_children() if v.tag == 'DW_TAG_member' and 'DW_AT_type' in v.attributes]
         return []
 
+    def _create_children(self) -> List[Any]:
+        return [VarDescriptor(self.parser, self.all_dies, v, self) for v in self._get_member_dies()]
+
     def get_full_name(self) -> str:
         if self.parent is None:
             return self.name
@@ -43,3 +43,31 @@ class TestDwarf(TestCase):
 
         foo = [v for v in parser.interesting_vars if v.name == 'foo'][0]
 
+
+    def test_names(self):
+        parser = FileParser(sanity_out)
+        lazy = FileParser(sanity_out, names=['foo.p.x', 'global_var'])
+        self.assertEqual(sorted(v.name for v in lazy.interesting_vars), ['foo', 'global_var'])
+        expected = [(v.get_full_name(), v.address, v.size, v.get_type_str())
+                    for v in parser.visit_interesting_vars_tree_leafs() if v.get_full_name().split('.')[0] in
+                    ['foo', 'global_var']]
+        self.assertEqual(sorted(expected), sorted((v.get_full_name(), v.address, v.size, v.get_type_str())
+                                                  for v in lazy.visit_interesting_vars_tree_leafs()))
+        self.assertEqual(list(FileParser(sanity_out, names=['missing']).visit_interesting_vars_tree_leafs()), [])
+
+    def test_init_values(self):
+        parser = FileParser(linked_list_out)
+        global_var = [v for v in parser.interesting_vars if v.name == 'global_var'][0]
+        self.assertEqual(parser.read_value_at_address(global_var.address, global_var.size),
+                         parser.get_value_by_name('global_var'))
+        self.assertIsNone(parser.read_value_at_address(global_var.address, 1000))
+        # members are read from within their variable's symbol
+        foo = [v for v in parser.interesting_vars if v.name == 'foo'][0]
+        for member in foo.children:
+            self.assertEqual(member.init_value,
+                             int.from_bytes(parser.read_value_at_address(member.address, member.size), 'little',
+                                            signed=True))
+        # every section is read once
+        sections = set(parser.section_data.keys())
+        self.assertEqual(parser.get_value_by_name('enum_instance'), b'\0')
+        self.assertEqual(sections, set(parser.section_data.keys()))
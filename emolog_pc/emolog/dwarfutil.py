@@ -1,9 +1,11 @@
 import logging
-from string import ascii_lowercase
+import os
 import sys
 
 from .consts import BUILD_TIMESTAMP_VARNAME
 from .dwarf import FileParser
+from .elfcache import read_elf_variables_table, parse_elf_variables, read_suggestion_index
+from .suggest import SuggestionIndex
 from .decoders import Decoder, ArrayDecoder, NamedDecoder, unpack_str_from_size
 from .varsfile import (read_vars_file, parse_vars_definition, VarsFileError,
     merge_vars_from_file_and_list)
@@ -12,38 +14,45 @@ from .varsfile import (read_vars_file, parse_vars_definition, VarsFileError,
 logger = logging.getLogger()
 
 
-def with_errors(s):
-    # TODO - find a library for this? using error distance
-    #  deleted element
-    for i in range(0, len(s)):
-        yield s[:i] + s[i + 1:]
-    # rotated adjacent elements
-    for i in range(0, len(s) - 1):
-        yield s[:i] + s[i + 1] + s[i] + s[i + 2:]
-    if len(s) > 3:
-        # 26**3 is already ~ 1e5 is too much
-        return
-    # single complete alphabet typing errors - this is really large..
-    for i in range(0, len(s)):
-        for other in ascii_lowercase:
-            yield s[:i] + other + s[i + 1:]
-
-
-def dwarf_get_variables_by_name(filename, names):
+def elf_leaf_variables(filename, names=None, cache=True, jobs=1):
+    """
+    :param names: None for all variables, else only the variables with the
+        top level names of these are read, see FileParser
+    :param cache: use the on disk cache of elfcache, else parse the DWARF
+    :param jobs: processes to parse all variables with, 0 for one per cpu
+    :return: list of the interesting leaf variables of the ELF
+    """
+    if cache:
+        return read_elf_variables_table(filename, names=names, jobs=jobs)
+    if names is None and jobs != 1:
+        return parse_elf_variables(filename, jobs=jobs)
+    return list(FileParser(filename=filename, names=names).visit_interesting_vars_tree_leafs())
+
+
+def print_suggestions(filename, missing, cache=True, jobs=1):
+    """
+    Print the variables of the ELF close to each of the missing names.
+    Suggestions are looked for among all the variables, not only the ones read
+    """
+    if cache:
+        index = read_suggestion_index(filename, jobs=jobs)
+    else:
+        index = SuggestionIndex(v.get_full_name() for v in elf_leaf_variables(filename, cache=False, jobs=jobs))
+    for name in missing:
+        options = index.suggest(name)
+        if len(options) > 0:
+            print("{} is close to {}".format(name, ", ".join(options)))
+
+
+def dwarf_get_variables_by_name(filename, names, cache=True, jobs=1):
     regular_mode = names is not None and len(names) > 0
     if names is None:
         names = []
     name_filter = (lambda v_name: v_name in names) if regular_mode else (lambda v_name: True)
     missing_check = (lambda found, given: given != found) if regular_mode else (lambda found, given: False)
-    if not hasattr(dwarf_get_variables_by_name, 'file_parser') or dwarf_get_variables_by_name.prev_filename != filename:
-        dwarf_get_variables_by_name.file_parser = FileParser(filename=filename)
-        dwarf_get_variables_by_name.prev_filename = filename
     sampled_vars = {}
     found = set()
-    elf_vars = list(dwarf_get_variables_by_name.file_parser.visit_interesting_vars_tree_leafs())
-    elf_var_names = [v.get_full_name() for v in elf_vars]
-    lower_to_actual = {name.lower(): name for name in elf_var_names}
-    elf_var_names_set_lower = set(lower_to_actual.keys())
+    elf_vars = elf_leaf_variables(filename, names=names if regular_mode else None, cache=cache, jobs=jobs)
     logger.debug('candidate variables found in ELF file:')
     for v in elf_vars:
         v_name = v.get_full_name()
@@ -57,16 +66,7 @@ def dwarf_get_variables_by_name(filename, names):
     given = set(names)
     if missing_check(found, given):
         logger.error("the following variables were not found in the ELF:\n{}".format(", ".join(list(given - found))))
-        elf_name_to_options = {name: set(with_errors(name)) for name in elf_var_names_set_lower}
-        missing_lower = [name.lower() for name in given - found]
-        missing_lower_to_actual = {name.lower(): name for name in given - found}
-        missing_to_errors = {name: set(with_errors(name)) for name in missing_lower}
-        for name in missing_lower:
-            options = [elf_name for elf_name, elf_options in elf_name_to_options.items() if
-                       len(missing_to_errors[name] & elf_options) > 0]
-            if len(options) > 0:
-                print("{} is close to {}".format(missing_lower_to_actual[name],
-                                                 ", ".join(lower_to_actual[x] for x in options)))
+        print_suggestions(filename, sorted(given - found), cache=cache, jobs=jobs)
         sys.exit(-1)
     logger.info("Registering variables from {}".format(filename))
     for v in sampled_vars.values():
@@ -212,15 +212,26 @@ def fake_dwarf(build_timestamp, names):
     return {name: fake_variable(name=name) for name in names}
 
 
-def read_elf_variables(elf, defs, skip_unsupported_vars=False, fake_build_timestamp=None):
+def read_elf_variables(elf, defs, skip_unsupported_vars=False, fake_build_timestamp=None, cache=True, jobs=1):
     """
     defs - list of (name, ticks, phase)
+    cache - read the ELF through the on disk cache
+    jobs - processes to parse the whole ELF with, when it has to be
     """
     names = [name for name, ticks, phase in defs]
     if elf is None:
         dwarf_variables = fake_dwarf(build_timestamp=fake_build_timestamp, names=names)
     else:
-        dwarf_variables = dwarf_get_variables_by_name(elf, names)
+        dwarf_variables = dwarf_get_variables_by_name(elf, names, cache=cache, jobs=jobs)
+    return variables_from_defs(defs, dwarf_variables, skip_unsupported_vars=skip_unsupported_vars)
+
+
+def variables_from_defs(defs, dwarf_variables, skip_unsupported_vars=False):
+    """
+    The read_elf_variables result for defs, from dwarf variables holding at least theirs
+    """
+    names = [name for name, ticks, phase in defs]
+    dwarf_variables = {name: dwarf_variables[name] for name in names if name in dwarf_variables}
     if len(dwarf_variables) == 0:
         logger.error("no variables set for sampling")
         raise SystemExit
@@ -232,8 +243,29 @@ def read_elf_variables(elf, defs, skip_unsupported_vars=False, fake_build_timest
         skip_unsupported_vars=skip_unsupported_vars)
 
 
-def read_all_elf_variables(elf):
-    dwarf_variables = dwarf_get_variables_by_name(elf, None)
+def read_elf_variables_of_targets(elfs_and_defs, fake_build_timestamp=None, cache=True, jobs=1):
+    """
+    read_elf_variables of several targets, reading every ELF once for all the
+    targets using it
+    :param elfs_and_defs: list of (elf, defs) per target
+    :return: list of (names, variables) per target
+    """
+    elfs_and_defs = [(None if elf is None else os.path.realpath(elf), defs) for elf, defs in elfs_and_defs]
+    names_by_elf = {}
+    for elf, defs in elfs_and_defs:
+        names = names_by_elf.setdefault(elf, [])
+        names.extend(name for name, ticks, phase in defs if name not in names)
+    dwarf_by_elf = {}
+    for elf, names in names_by_elf.items():
+        if elf is None:
+            dwarf_by_elf[elf] = fake_dwarf(build_timestamp=fake_build_timestamp, names=names)
+        else:
+            dwarf_by_elf[elf] = dwarf_get_variables_by_name(elf, names, cache=cache, jobs=jobs)
+    return [variables_from_defs(defs, dwarf_by_elf[elf]) for elf, defs in elfs_and_defs]
+
+
+def read_all_elf_variables(elf, cache=True, jobs=1):
+    dwarf_variables = dwarf_get_variables_by_name(elf, None, cache=cache, jobs=jobs)
     names = list(sorted(dwarf_variables.keys()))
     name_to_ticks_and_phase = {k: (1, 0) for k in names}
     return names, variables_from_dwarf_variables(
@@ -246,11 +278,13 @@ def main_dump():
     from pprint import pprint
     parser = argparse.ArgumentParser()
     parser.add_argument('-e', '--elf', required=True, type=str, help='ELF file')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help='processes to parse the DWARF with, by compilation units, 0 for one per cpu')
     args = parser.parse_args()
     if not os.path.exists(args.elf):
         print("error: missing file {elf}".format(elf=args.elf))
         raise SystemExit
-    out = read_all_elf_variables(args.elf)
+    out = read_all_elf_variables(args.elf, jobs=args.jobs)
     pprint(out)
 
 
@@ -262,6 +296,8 @@ def main():
     parser.add_argument('-e', '--elf', required=True, type=str, help='ELF file')
     parser.add_argument('-v', '--vars', default=None, type=str, help='vars file')
     parser.add_argument('--verbose', action='store_true', default=False, help='verbose')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help='processes to parse the DWARF with, by compilation units, 0 for one per cpu')
     # slight logic duplication with emotool.main, but at least in one project
     args = parser.parse_args()
     if not os.path.exists(args.elf):
@@ -271,10 +307,10 @@ def main():
         print("error: missing file {vars}".format(vars=args.vars))
         raise SystemExit
     if args.vars is None:
-        out = read_all_elf_variables(elf=args.elf)
+        out = read_all_elf_variables(elf=args.elf, jobs=args.jobs)
     else:
         defs = merge_vars_from_file_and_list(filename=args.vars)
-        out = read_elf_variables(elf=args.elf, defs=defs)
+        out = read_elf_variables(elf=args.elf, defs=defs, jobs=args.jobs)
     if args.verbose:
         pprint(out)
     print("ok")
@@ -0,0 +1,339 @@
+"""
+On disk cache of the variables table read from an ELF's DWARF information.
+
+Walking all the DIEs of a large firmware ELF dominates emotool startup. The
+table dwarfutil needs - every interesting leaf variable with its full name,
+address, size, type string, enum values, array shape and init value - is
+small, so it is stored after the first parse and read back as CachedVariable
+instances on the next runs.
+
+Cache files are named by the sha256 of the ELF contents, so a rebuilt ELF
+never matches a stale table, while the same build copied or touched still
+does. Hashing is cheap next to parsing the DWARF.
+
+A suggest.SuggestionIndex of all the names is stored too once asked for.
+
+The table is kept per top level variable name. A lookup of some names parses
+only the names missing from the cache (see FileParser's names) and adds them
+to it; reading every variable fills it completely.
+
+Reading every variable can be split across processes by compilation units,
+each process returning its part of the table (see parse_elf_variables jobs).
+
+The cache directory is $EMOLOG_CACHE_DIR if set, else the user cache
+directory (~/.cache/emolog, or %LOCALAPPDATA%\\emolog\\cache on windows).
+"""
+
+import hashlib
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+from tempfile import NamedTemporaryFile
+
+from elftools.elf.elffile import ELFFile
+
+from .dwarf import FileParser
+from .dwarf.dwarf import top_level_name
+from .suggest import SuggestionIndex
+
+
+logger = getLogger('emolog')
+
+
+# bump when the stored fields or their meaning change
+CACHE_FORMAT_VERSION = 4
+
+CACHE_DIR_ENV = 'EMOLOG_CACHE_DIR'
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+class CachedVariableError(Exception):
+    pass
+
+
+class CachedVariable:
+    """
+    Stands in for a dwarf.VarDescriptor leaf, with the parts of its interface
+    dwarfutil uses. Values that raised when computed from the DWARF raise
+    CachedVariableError when asked for.
+    """
+
+    ADDRESS_TYPE_UNSUPPORTED = '(Address Type Unsupported)'
+
+    FIELDS = ['full_name', 'name', 'address', 'size', 'type_str', 'enum', 'enum_dict', 'array', 'array_sizes',
+              'init_value']
+
+    def __init__(self, full_name, name, address, size, type_str, enum, enum_dict, array, array_sizes, init_value):
+        """
+        type_str, enum, enum_dict, array and array_sizes are (value, error)
+        pairs, error being None or the message of what computing the value
+        raised. enum_dict and array_sizes are only computed for enums and
+        arrays.
+        """
+        self.full_name = full_name
+        self.name = name
+        self.address = address
+        self.size = size
+        self.type_str = type_str
+        self.enum = enum
+        self.enum_dict = enum_dict
+        self.array = array
+        self.array_sizes = array_sizes
+        self.init_value = init_value
+
+    @classmethod
+    def from_var_descriptor(cls, v):
+        enum = _value_or_error(v.is_enum)
+        array = _value_or_error(v.is_array)
+        return cls(full_name=v.get_full_name(), name=v.name, address=v.address, size=v.size,
+                   type_str=_value_or_error(v.get_type_str),
+                   enum=enum, enum_dict=_value_or_error(v.get_enum_dict) if enum[0] else (None, None),
+                   array=array, array_sizes=_value_or_error(v.get_array_sizes) if array[0] else (None, None),
+                   init_value=v.init_value)
+
+    def to_tuple(self):
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def _get(self, pair):
+        value, error = pair
+        if error is not None:
+            raise CachedVariableError('{}: {}'.format(self.full_name, error))
+        return value
+
+    def get_full_name(self):
+        return self.full_name
+
+    def get_type_str(self):
+        return self._get(self.type_str)
+
+    def is_enum(self):
+        return self._get(self.enum)
+
+    def get_enum_dict(self):
+        if not self.is_enum():
+            raise CachedVariableError('{}: not an enum'.format(self.full_name))
+        return self._get(self.enum_dict)
+
+    def is_array(self):
+        return self._get(self.array)
+
+    def get_array_sizes(self):
+        if not self.is_array():
+            raise CachedVariableError('{}: not an array'.format(self.full_name))
+        return self._get(self.array_sizes)
+
+    def get_array_flat_length(self):
+        bounds = self.get_array_sizes()
+        if bounds is None or len(bounds) == 0:
+            return None
+        array_len = 1
+        for bound in bounds:
+            array_len *= bound
+        return array_len
+
+    def __str__(self):
+        if isinstance(self.address, int):
+            address_str = hex(self.address)
+        else:
+            address_str = self.address
+        return "<{} {} @ {}>".format(self.type_str[0], self.full_name, address_str)
+
+    __repr__ = __str__
+
+
+def _value_or_error(func):
+    try:
+        return func(), None
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+
+def default_cache_dir():
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if cache_dir:
+        return cache_dir
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+        return os.path.join(base, 'emolog', 'cache')
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'emolog')
+
+
+def elf_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fd:
+        while True:
+            block = fd.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_filename(cache_dir, digest):
+    return os.path.join(cache_dir, 'elf-{}.pickle'.format(digest))
+
+
+def parse_elf_variables(filename, names=None, jobs=1, cu_offsets=None):
+    """
+    :param names: None for all variables, else the top level names to parse
+    :param jobs: processes to parse all variables with, 0 for one per cpu
+    :param cu_offsets: None for all compilation units, else the offsets of the ones to parse
+    :return: list of CachedVariable, one per interesting leaf variable, parsed from the DWARF
+    """
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    if names is None and cu_offsets is None and jobs > 1:
+        return parse_elf_variables_parallel(filename, jobs)
+    file_parser = FileParser(filename=filename, names=names, cu_offsets=cu_offsets)
+    return [CachedVariable.from_var_descriptor(v) for v in file_parser.visit_interesting_vars_tree_leafs()]
+
+
+def compilation_unit_groups(filename, num_groups):
+    """
+    Split the compilation units, in order, to up to num_groups groups of
+    about the same DWARF size
+    :return: list of lists of compilation unit offsets
+    """
+    with open(filename, 'rb') as fd:
+        elf_file = ELFFile(fd)
+        if not elf_file.has_dwarf_info():
+            return []
+        units = [(cu.cu_offset, cu['unit_length']) for cu in elf_file.get_dwarf_info().iter_CUs()]
+    group_size = sum(length for offset, length in units) / max(1, num_groups)
+    groups = []
+    group = []
+    group_length = 0
+    for offset, length in units:
+        group.append(offset)
+        group_length += length
+        if group_length >= group_size:
+            groups.append(group)
+            group = []
+            group_length = 0
+    if len(group) > 0:
+        groups.append(group)
+    return groups
+
+
+def _parse_cu_group(filename, cu_offsets):
+    return [v.to_tuple() for v in parse_elf_variables(filename, cu_offsets=cu_offsets)]
+
+
+def parse_elf_variables_parallel(filename, jobs):
+    """
+    parse_elf_variables of all variables, by groups of compilation units in
+    a pool of jobs processes. The table is the same as a serial parse's.
+    """
+    # one group per process: every group reads the ELF's symbols again
+    groups = compilation_unit_groups(filename, jobs)
+    if len(groups) <= 1:
+        return parse_elf_variables(filename)
+    with ProcessPoolExecutor(max_workers=min(jobs, len(groups))) as executor:
+        parts = executor.map(_parse_cu_group, [filename] * len(groups), groups)
+        return [CachedVariable(*fields) for part in parts for fields in part]
+
+
+def _by_top_level_name(variables):
+    ret = {}
+    for v in variables:
+        ret.setdefault(top_level_name(v.full_name), []).append(v.to_tuple())
+    return ret
+
+
+def _load(path, digest):
+    try:
+        with open(path, 'rb') as fd:
+            contents = pickle.load(fd)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning('ignoring unreadable ELF cache {}: {}'.format(path, e))
+        return None
+    if not isinstance(contents, dict) or contents.get('format') != CACHE_FORMAT_VERSION or \
+            contents.get('sha256') != digest:
+        return None
+    return contents
+
+
+def _store(path, contents):
+    """
+    Write to a temporary file and rename, so concurrent emotools never read a partial cache
+    """
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with NamedTemporaryFile(mode='wb', dir=directory, prefix='.elf-', delete=False) as fd:
+            pickle.dump(contents, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fd.name, path)
+    except OSError as e:
+        logger.warning('could not write ELF cache {}: {}'.format(path, e))
+
+
+def _open(filename, cache_dir):
+    """
+    :return: (cache file path, its contents or empty contents for this ELF)
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    digest = elf_hash(filename)
+    path = cache_filename(cache_dir, digest)
+    contents = _load(path, digest)
+    if contents is None:
+        contents = dict(format=CACHE_FORMAT_VERSION, sha256=digest, complete=False, variables={})
+    return path, contents
+
+
+def _complete(filename, path, contents, jobs):
+    if not contents['complete']:
+        logger.debug('ELF variables of {} not in cache, parsing DWARF'.format(filename))
+        contents['variables'] = _by_top_level_name(parse_elf_variables(filename, jobs=jobs))
+        contents['complete'] = True
+        _store(path, contents)
+
+
+def read_elf_variables_table(filename, names=None, cache_dir=None, jobs=1):
+    """
+    The leaf variables of the ELF, from the cache when it holds them for this
+    ELF's contents, else parsed from the DWARF and added to the cache.
+    :param names: None for every variable, else full or top level names; the
+        variables with the top level names of these are returned
+    :param cache_dir: None for default_cache_dir()
+    :param jobs: processes to parse all variables with, see parse_elf_variables
+    :return: list of CachedVariable
+    """
+    path, contents = _open(filename, cache_dir)
+    by_name = contents['variables']
+    if names is None:
+        _complete(filename, path, contents, jobs)
+        by_name = contents['variables']
+        top_names = list(by_name.keys())
+    else:
+        top_names = list(dict.fromkeys(top_level_name(name) for name in names))
+        missing = [] if contents['complete'] else [name for name in top_names if name not in by_name]
+        if len(missing) > 0:
+            logger.debug('ELF variables {} of {} not in cache, parsing DWARF'.format(', '.join(missing), filename))
+            parsed = _by_top_level_name(parse_elf_variables(filename, names=missing))
+            for name in missing:
+                # names not in the ELF are stored too, as known to be missing
+                by_name[name] = parsed.get(name, [])
+            _store(path, contents)
+    logger.debug('ELF variables of {} read from cache {}'.format(filename, path))
+    return [CachedVariable(*fields) for name in top_names for fields in by_name.get(name, [])]
+
+
+def read_suggestion_index(filename, cache_dir=None, jobs=1):
+    """
+    The suggest.SuggestionIndex of all the ELF's variable names, built once
+    and stored with the variables table
+    """
+    path, contents = _open(filename, cache_dir)
+    _complete(filename, path, contents, jobs)
+    if contents.get('suggestions') is None:
+        contents['suggestions'] = SuggestionIndex(
+            fields[0] for variables in contents['variables'].values() for fields in variables)
+        _store(path, contents)
+    return contents['suggestions']
@@ -8,27 +8,36 @@
 from datetime import datetime
 import traceback
 import argparse
+from copy import copy
 import os
 from os import path
 import sys
 import logging
-from struct import pack
 import random
 import re
 from time import time
 from socket import socket
 from configparser import ConfigParser
 from shutil import which
-from asyncio import sleep, Protocol, get_event_loop, Task
-from pickle import dumps
+from asyncio import sleep, get_event_loop, gather, Task, CancelledError
 import csv
 
 from ..consts import BUILD_TIMESTAMP_VARNAME
-from ..util import resolve, create_process, gcd
+from ..util import resolve, create_process, gcd, get_python_executable
 from ..util import verbose as util_verbose
 from ..lib import AckTimeout, ClientProtocolMixin, SamplerSample
 from ..varsfile import merge_vars_from_file_and_list
-from ..dwarfutil import read_elf_variables
+from ..dwarfutil import read_elf_variables, read_elf_variables_of_targets
+from ..recording import RECORDING_FORMATS, RECORDING_EXTENSIONS
+from ..rotation import index_filename, recording_exists, INDEX_SUFFIX
+from ..background_writer import DEFAULT_QUEUE_SIZE, OVERFLOW_BLOCK, OVERFLOW_POLICIES
+from ..dump import read_dump
+from ..decimation import DECIMATION_MINMAX, DECIMATION_METHODS
+from ..liveplot import (LivePlot, LivePlotError, DEFAULT_WINDOW_SECONDS, DEFAULT_POINTS_PER_SECOND,
+                        DEFAULT_MAX_FPS)
+from ..streaming import SampleStreamServer, OVERFLOW_DROP as STREAM_OVERFLOW_DROP, \
+    OVERFLOW_POLICIES as STREAM_OVERFLOW_POLICIES
+from ..serial_transport import create_serial_connection
 from multiprocessing import Process, freeze_support
 from emolog import serial2tcp
 from .serial_autodetect import resolve_serial, AutodetectError, format_autodetect_detail
@@ -99,11 +108,12 @@ def validate_filename_component(value, flag_name):
 
 
 def max_existing_recording_number(root_folder, prefix):
-    """Largest NNN found in <prefix>_NNN[ <label>|_<label>].(csv|xlsx) across root_folder
-    and any subfolders, or 0 if none exist. Keeps the recording counter global across
-    --group subfolders so emo_NNN remains a unique identifier across the whole tree.
+    """Largest NNN found in <prefix>_NNN[ <label>|_<label>][.partNNNN].(csv|emob|xlsx|index.json)
+    across root_folder and any subfolders, or 0 if none exist. Keeps the recording counter global
+    across --group subfolders so emo_NNN remains a unique identifier across the whole tree.
     """
-    pattern = re.compile(r'^' + re.escape(prefix) + r'_(\d+)(?:[\s_].*)?\.(?:csv|xlsx)$')
+    extensions = '|'.join(re.escape(e[1:]) for e in RECORDING_EXTENSIONS + ['.xlsx', INDEX_SUFFIX])
+    pattern = re.compile(r'^' + re.escape(prefix) + r'_(\d+)(?:[\s_].*)?(?:\.part\d+)?\.(?:' + extensions + r')$')
     if not os.path.isdir(root_folder):
         return 0
     max_n = 0
@@ -117,7 +127,7 @@ def max_existing_recording_number(root_folder, prefix):
     return max_n
 
 
-def next_available(folder, prefix, group=None, label=None):
+def next_available(folder, prefix, group=None, label=None, extension='.csv'):
     """Path for the next recording. Numbering is global across subfolders of `folder`
     (max found + 1). Placed in `<folder>/<group>/` if `group` is set (created if needed),
     with ` <label>` appended to the bare numbered name when `label` is non-empty.
@@ -131,7 +141,7 @@ def next_available(folder, prefix, group=None, label=None):
         os.makedirs(out_dir, exist_ok=True)
     else:
         out_dir = folder
-    return os.path.join(out_dir, base + '.csv')
+    return os.path.join(out_dir, base + extension)
 
 
 def setup_logging(filename, silent):
@@ -167,13 +177,18 @@ def start_serial_process(serialurl, baudrate, hw_flow_control, port):
 
 class EmoToolClient(ClientProtocolMixin):
 
-    def __init__(self, ticks_per_second, verbose, dump, debug, csv_writer_factory=None):
+    def __init__(self, ticks_per_second, verbose, dump, debug, csv_writer_factory=None, writer_queue_size=0,
+                 writer_overflow=OVERFLOW_BLOCK):
         if debug:
             print("timeout set to one hour for debugging (gdb)")
             ClientProtocolMixin.ACK_TIMEOUT_SECONDS = 3600.0
         super().__init__(verbose=verbose, dump=dump,
             ticks_per_second=ticks_per_second,
-            csv_writer_factory=csv_writer_factory)
+            csv_writer_factory=csv_writer_factory,
+            writer_queue_size=writer_queue_size, writer_overflow=writer_overflow)
+        # the --fake gen subprocess and the --gui redraw task, stopped by cleanup
+        self.fake_process = None
+        self.gui_task = None
 
     @property
     def running(self):
@@ -187,6 +202,14 @@ class EmoToolClient(ClientProtocolMixin):
     def samples_received(self):
         return self.cylib.csv_handler.samples_received
 
+    @property
+    def writer_stats(self):
+        return self.cylib.csv_handler.writer_stats
+
+    @property
+    def skip_stats(self):
+        return self.cylib.parser.skip_stats
+
     @property
     def csv_filename(self):
         return self.cylib.csv_handler.csv_filename
@@ -202,12 +225,16 @@ class EmoToolClient(ClientProtocolMixin):
         self.cylib.data_received(bytes(data))
 
 
+CONNECT_ATTEMPTS = 100
+
+
 async def start_transport(client, args):
     loop = get_event_loop()
     port = random.randint(10000, 50000)
     if args.fake is not None:
         if args.fake == 'gen':
-            start_fake_sine(ticks_per_second=args.ticks_per_second, port=port, build_timestamp_value=args.fake_gen_build_timestamp_value)
+            client.fake_process = start_fake_sine(ticks_per_second=args.ticks_per_second, port=port,
+                                                  build_timestamp_value=args.fake_gen_build_timestamp_value)
         elif args.fake == 'bench':
             start_fake_bench(port)
         elif args.fake == 'pc' or os.path.exists(args.fake):
@@ -216,20 +243,29 @@ async def start_transport(client, args):
         else:
             print("error: unfinished support for fake {fake}".format(fake=args.fake))
             raise SystemExit(1)
+    elif not args.serial_bridge:
+        transport, client2 = await create_serial_connection(
+            loop, lambda: client, url=args.serial, baudrate=args.baud, rtscts=args.hw_flow_control)
+        assert client2 is client
+        loop.create_task(monitor_serial_transport(transport))
+        return
     else:
         serial_process = start_serial_process(serialurl=args.serial, baudrate=args.baud, hw_flow_control=args.hw_flow_control, port=port)
-    loop.create_task(monitor_subprocess(serial_process))
-    attempt = 0
-    while attempt < 10:
-        attempt += 1
+        loop.create_task(monitor_subprocess(serial_process))
+    # the subprocess takes a while to start listening, longer on a loaded machine
+    for attempt in range(CONNECT_ATTEMPTS):
         await sleep(0.1)
         s = socket()
         try:
             s.connect(('127.0.0.1', port))
-        except:
-            pass
+        except OSError:
+            s.close()
         else:
             break
+    else:
+        print("error: no connection to port {port} after {seconds} seconds".format(
+            port=port, seconds=CONNECT_ATTEMPTS / 10), file=sys.stderr)
+        raise SystemExit(1)
     client_transport, client2 = await loop.create_connection(lambda: client, sock=s)
     assert client2 is client
 
@@ -244,6 +280,14 @@ async def monitor_subprocess(process: Process):
     sys.exit(0)
 
 
+async def monitor_serial_transport(transport):
+    exc = await transport.lost
+    if exc is not None:
+        # same as the serial2tcp subprocess exiting
+        print('exiting: serial connection lost')
+        sys.exit(0)
+
+
 args = None
 
 
@@ -270,8 +314,15 @@ else:
 
 
 async def cleanup(args, client):
+    await stop_gui(client)
+    if args.replay is not None:
+        client.exit_gracefully()
+        stop_recording(client)
+        return
     if not hasattr(client, 'transport') or client.transport is None:
         cancel_outstanding_tasks()
+        stop_recording(client)
+        stop_fake_process(client)
         return
     if not args.no_cleanup:
         logger.info("sending sampler stop")
@@ -282,6 +333,23 @@ async def cleanup(args, client):
     client.exit_gracefully()
     if client.transport is not None:
         client.transport.close()
+    stop_recording(client)
+    stop_fake_process(client)
+
+
+def stop_recording(client):
+    """
+    Write what the recording writer still buffers and close it. Only done by
+    the writer itself when max_samples is reached, not on --runtime 0, ctrl-c
+    or a key press.
+    """
+    client.cylib.csv_handler.stop()
+
+
+def stop_fake_process(client):
+    if client.fake_process is not None:
+        client.fake_process.terminate()
+        client.fake_process.wait()
 
 
 def parse_args(args=None):
@@ -302,7 +370,18 @@ def parse_args(args=None):
                              'otherwise the built-in default shipped with emolog.')
     parser.add_argument('--baud', default=8000000, help='baudrate, using RS422 up to 12000000 theoretically', type=int)
     parser.add_argument('--hw_flow_control', default=False, action='store_true', help='use CTS/RTS signals for flow control')
+    parser.add_argument('--max-window', type=int, default=ClientProtocolMixin.MAX_WINDOW,
+                        help='most variable registrations in flight when the target supports it, 1 to send one at a time')
+    parser.add_argument('--serial-bridge', default=False, action='store_true',
+                        help='fallback: relay the serial port through a serial2tcp subprocess instead of reading it in process')
     parser.add_argument('--elf', default=None, help='elf executable running on embedded side')
+    parser.add_argument('--target', default=[], action='append', type=parse_target,
+                        help='record several targets at once, each to its own recording: '
+                             'name=motor,serial=COM4,elf=motor.out,varfile=motor_vars.csv, fields from {}. '
+                             'Fields not given are taken from --serial, --elf, --varfile etc. '
+                             'Give once per target'.format(', '.join(TARGET_FIELDS)))
+    parser.add_argument('--no-elf-cache', default=False, action='store_true',
+                        help='parse the ELF DWARF information instead of reading it from the on disk cache')
     parser.add_argument('--var', default=[], action='append',
                         help='add a single var, example "foo,1,0" = "varname,ticks,tickphase"')
     parser.add_argument('--snapshotfile', help='file containing variable definitions to be taken once at startup')
@@ -323,6 +402,23 @@ def parse_args(args=None):
                              'Recording number stays global across groups. Not compatible with --out.')
 
     parser.add_argument('--csv-factory', help='advanced: module[.module]*.function to use as factory for csv file writing', default=None)
+    parser.add_argument('--format', default='csv', choices=list(RECORDING_FORMATS.keys()),
+                        help='recording file format. emolog-bin is a compact binary columnar format (.emob), '
+                             'read by the post processor like csv. The parameters snapshot is always csv.')
+
+    parser.add_argument('--writer-queue', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='write the recording from a thread, through a queue of this many received batches. '
+                             '0 writes synchronously in the receive path')
+    parser.add_argument('--writer-overflow', default=OVERFLOW_BLOCK, choices=OVERFLOW_POLICIES,
+                        help='when the writer queue is full: block waits for the disk (no samples lost), '
+                             'drop discards the batch and reports the dropped samples')
+    parser.add_argument('--rotate-samples', type=int, default=0,
+                        help='write the recording in parts of at most this many samples, emo_NNN.part0001.csv, '
+                             'emo_NNN.part0002.csv, ... listed with their ticks range in emo_NNN.index.json. '
+                             'The post processor reads the index like a recording. 0 (default) for a single file')
+    parser.add_argument('--rotate-seconds', type=float, default=0,
+                        help='start a new part every this many seconds, see --rotate-samples. '
+                             'With both, a part ends at whichever limit is reached first')
 
     parser.add_argument('--verbose', default=True, action='store_false', dest='silent',
                         help='turn on verbose logging; affects performance under windows')
@@ -330,14 +426,34 @@ def parse_args(args=None):
     parser.add_argument('--log', default=None, help='log messages and other debug/info logs to this file')
     parser.add_argument('--runtime', type=float, default=3.0, help='quit after given seconds. use 0 for endless run.')
     parser.add_argument('--no-cleanup', default=False, action='store_true', help='do not stop sampler on exit')
-    parser.add_argument('--dump')
+    parser.add_argument('--dump', help='write everything received from the target to this file, see --replay')
+    parser.add_argument('--replay', default=None,
+                        help='instead of connecting to a target, decode a --dump file with the given variables. '
+                             '--runtime is ignored, the whole dump is replayed')
+    parser.add_argument('--replay-speed', type=float, default=0,
+                        help='with --replay: 1 for the speed it was recorded at, N for N times faster, '
+                             '0 (default) for as fast as possible')
     parser.add_argument('--ticks-per-second', default=1000000 / 50, type=float,
                         help='number of ticks per second. used in conjunction with runtime')
     parser.add_argument('--debug', default=False, action='store_true', help='produce more verbose debugging output')
 
     # Server - used for GUI access
     parser.add_argument('--listen', default=None, type=int, help='enable listening TCP port for samples') # later: add a command interface, making this suitable for interactive GUI
+    parser.add_argument('--listen-overflow', default=STREAM_OVERFLOW_DROP, choices=STREAM_OVERFLOW_POLICIES,
+                        help='when a --listen subscriber falls behind: drop skips batches until it catches up, '
+                             'decimate sends every 2nd, 4th.. sample first')
+    parser.add_argument('--listen-points-per-second', default=0, type=float,
+                        help='decimate what --listen subscribers get to this rate, unless they ask for another. '
+                             '0 (default) for every sample. The recording always has every sample')
+    parser.add_argument('--listen-decimation', default=DECIMATION_MINMAX, choices=DECIMATION_METHODS,
+                        help='minmax (default) sends the minimum and maximum of every variable over each period, '
+                             'keeping peaks; stride sends the first sample of each period')
     parser.add_argument('--gui', default=False, action='store_true', help='launch graphing gui in addition to saving')
+    parser.add_argument('--gui-window', default=DEFAULT_WINDOW_SECONDS, type=float,
+                        help='seconds of samples shown by --gui')
+    parser.add_argument('--gui-points-per-second', default=DEFAULT_POINTS_PER_SECOND, type=float,
+                        help='--gui plots the minimum and maximum of every variable over periods making this rate')
+    parser.add_argument('--gui-fps', default=DEFAULT_MAX_FPS, type=float, help='most --gui redraws per second')
 
     # Embedded
     parser.add_argument('--embedded', default=False, action='store_true', help='debugging: be a fake embedded target')
@@ -346,6 +462,85 @@ def parse_args(args=None):
 
     ret, unparsed = parser.parse_known_args(args=args)
 
+    if ret.replay is not None:
+        if ret.fake is not None or ret.snapshotfile or ret.check_timestamp:
+            print("{e}: error: --replay cannot be combined with --fake, --snapshotfile or --check-timestamp".format(
+                e=sys.argv[0]))
+            raise SystemExit(1)
+        if not os.path.exists(ret.replay):
+            print("{e}: error: no such dump file: {replay}".format(e=sys.argv[0], replay=ret.replay))
+            raise SystemExit(1)
+
+    if ret.gui and min(ret.gui_window, ret.gui_points_per_second, ret.gui_fps) <= 0:
+        print("{e}: error: --gui-window, --gui-points-per-second and --gui-fps must be positive".format(
+            e=sys.argv[0]))
+        raise SystemExit(1)
+
+    if ret.rotate_samples < 0 or ret.rotate_seconds < 0:
+        print("{e}: error: --rotate-samples and --rotate-seconds cannot be negative".format(e=sys.argv[0]))
+        raise SystemExit(1)
+
+    if ret.listen_points_per_second < 0:
+        print("{e}: error: --listen-points-per-second cannot be negative".format(e=sys.argv[0]))
+        raise SystemExit(1)
+
+    if len(ret.target) > 0:
+        combined = [flag for flag, given in [('--replay', ret.replay is not None), ('--snapshotfile', ret.snapshotfile),
+                                             ('--check-timestamp', ret.check_timestamp), ('--listen', ret.listen),
+                                             ('--gui', ret.gui), ('--embedded', ret.embedded)] if given]
+        if len(combined) > 0:
+            print("{e}: error: --target cannot be combined with {flags}".format(e=sys.argv[0], flags=', '.join(combined)))
+            raise SystemExit(1)
+        ret.targets = [target_args(ret, spec, i) for i, spec in enumerate(ret.target)]
+        names = [target.name for target in ret.targets]
+        if len(set(names)) != len(names):
+            print("{e}: error: --target names must differ, got {names}".format(e=sys.argv[0], names=', '.join(names)))
+            raise SystemExit(1)
+        for target in ret.targets:
+            validate_filename_component(target.name, '--target name')
+            complete_target_args(target, parser)
+    else:
+        ret.targets = []
+        complete_target_args(ret, parser)
+    return ret
+
+
+TARGET_FIELDS = ['name', 'serial', 'elf', 'varfile', 'fake', 'baud']
+
+
+def parse_target(s):
+    """
+    --target value: comma separated field=value, fields from TARGET_FIELDS
+    """
+    spec = {}
+    for item in s.split(','):
+        field, sep, value = item.partition('=')
+        field = field.strip()
+        if not sep or field not in TARGET_FIELDS:
+            raise argparse.ArgumentTypeError('expected comma separated field=value, fields from {}, got {!r}'.format(
+                ', '.join(TARGET_FIELDS), item))
+        spec[field] = int(value) if field == 'baud' else value
+    return spec
+
+
+def target_args(args, spec, index):
+    """
+    The arguments of one --target: args with the fields given in its spec
+    """
+    ret = copy(args)
+    ret.target = []
+    ret.targets = []
+    ret.name = spec.get('name', 'target{}'.format(index + 1))
+    for field in TARGET_FIELDS[1:]:
+        if field in spec:
+            setattr(ret, field, spec[field])
+    if args.dump:
+        base, extension = os.path.splitext(args.dump)
+        ret.dump = '{}_{}{}'.format(base, ret.name, extension)
+    return ret
+
+
+def complete_target_args(ret, parser):
     if ret.fake is None:
         if not ret.elf and not ret.embedded:
             # elf required unless fake_sine in effect
@@ -378,7 +573,6 @@ def parse_args(args=None):
             if ret.varfile is None:
                 ret.varfile = os.path.join(module_dir, '..', '..', 'vars.csv')
                 ret.snapshotfile = os.path.join(module_dir, '..', '..', 'snapshot_vars.csv')
-    return ret
 
 
 def bandwidth_calc(args, variables):
@@ -421,7 +615,17 @@ def banner(s):
 
 
 async def run_client(args, client, variables, allow_kb_stop):
-    if not await initialize_board(client=client, variables=variables):
+    await run_clients(args=args, clients_and_variables=[(client, variables)], allow_kb_stop=allow_kb_stop)
+
+
+async def run_clients(args, clients_and_variables, allow_kb_stop):
+    """
+    Sample with every client until all of them are done or a key is pressed
+    :param clients_and_variables: list of (client, variables to sample)
+    """
+    initialized = await gather(*(initialize_board(client=client, variables=variables)
+                                 for client, variables in clients_and_variables))
+    if not all(initialized):
         logger.error("Failed to initialize board, exiting.")
         raise SystemExit(1)
     sys.stdout.flush()
@@ -430,11 +634,15 @@ async def run_client(args, client, variables, allow_kb_stop):
     dt = 0.1 if args.runtime is not None else 1.0
     if allow_kb_stop and try_getch_message:
         print(try_getch_message)
-    while client.running:
+    while any(client.running for client, variables in clients_and_variables):
         if allow_kb_stop and try_getch():
             break
         await sleep(dt)
 
+    await gather(*(stop_sampler(client) for client, variables in clients_and_variables))
+
+
+async def stop_sampler(client):
     retry_count = 0
     max_retries = 3
     while retry_count < max_retries:
@@ -447,11 +655,41 @@ async def run_client(args, client, variables, allow_kb_stop):
             logger.info(f"Ack Timeout. Retry {retry_count}")
 
 
+async def replay_dump(args, client, variables):
+    """
+    Feed the --replay dump through the receive pipeline, as if received from
+    a target sampling variables. Samples keep their recorded timestamps.
+    """
+    client.cylib.sampler.register_variables(variables)
+    client.cylib.sampler.on_started()
+    speed = args.replay_speed
+    start = None
+    for timestamp, chunk in read_dump(args.replay):
+        if not client.running:
+            break
+        if speed > 0 and timestamp is None and start is None:
+            logger.warning("dump has no usable timestamps (older format), replaying as fast as possible")
+            start = (None, None)
+        if speed > 0 and timestamp is not None:
+            if start is None:
+                start = (time(), timestamp)
+            delay = start[0] + (timestamp - start[1]) / speed - time()
+            if delay > 0:
+                await sleep(delay)
+        else:
+            # let listeners run
+            await sleep(0)
+        client.cylib.data_received(chunk, timestamp)
+    client.cylib.sampler.on_stopped()
+    client.cylib.csv_handler.stop()
+
+
 async def record_snapshot(args, client, csv_filename, varsfile, extra_vars=None):
     if extra_vars is None:
         extra_vars = []
     defs = merge_vars_from_file_and_list(filename=varsfile, def_lines=extra_vars)
-    names, variables = read_elf_variables(elf=args.elf, defs=defs, fake_build_timestamp=args.fake_elf_build_timestamp_value)
+    names, variables = read_elf_variables(elf=args.elf, defs=defs, fake_build_timestamp=args.fake_elf_build_timestamp_value,
+                                          cache=not args.no_elf_cache)
     elf_by_name = {x['name']: x for x in variables}
     client.reset(csv_filename=csv_filename, names=names, min_ticks=1, max_samples=1)
     await run_client(args, client, variables, allow_kb_stop=False)
@@ -472,27 +710,52 @@ async def record_snapshot(args, client, csv_filename, varsfile, extra_vars=None)
 CONFIG_FILE_NAME = 'local_machine_config.ini'
 
 
-class SamplePassOn(Protocol):
-    def __init__(self, client):
-        self.client = client
+async def start_tcp_listener(client, port, overflow=STREAM_OVERFLOW_DROP, points_per_second=0,
+                             decimation=DECIMATION_MINMAX, ticks_per_second=None):
+    """
+    Stream the samples to any number of subscribers, see streaming.py
+    """
+    server = SampleStreamServer(overflow=overflow, points_per_second=points_per_second, decimation=decimation,
+                                ticks_per_second=ticks_per_second)
+    client.register_listener(server.listener)
+    loop = get_event_loop()
+    await loop.create_server(server.protocol_factory, host='localhost', port=port)
+    print("waiting on {port}".format(port=port))
 
-    def connection_made(self, transport):
-        self.transport = transport
-        self.client.register_listener(self.write_messages)
 
-    def write_messages(self, messages):
-        pickled_messages = dumps(messages)
-        self.transport.write(pack('<i', len(pickled_messages)))
-        self.transport.write(pickled_messages)
+async def run_gui(plot):
+    while not plot.closed:
+        plot.draw()
+        plot.flush_events()
+        await sleep(1 / plot.max_fps)
 
 
-async def start_tcp_listener(client, port):
-    loop = get_event_loop()
-    await loop.create_server(lambda: SamplePassOn(client), host='localhost', port=port)
-    print("waiting on {port}".format(port=port))
+def start_gui(client, args):
+    """
+    Plot the samples live, see liveplot.py
+    """
+    try:
+        plot = LivePlot(ticks_per_second=args.ticks_per_second, window_seconds=args.gui_window,
+                        points_per_second=args.gui_points_per_second, max_fps=args.gui_fps)
+    except LivePlotError as e:
+        print("error: {}".format(e), file=sys.stderr)
+        raise SystemExit(1)
+    client.register_listener(plot.listener)
+    client.gui_task = get_event_loop().create_task(run_gui(plot))
 
 
-async def amain_startup(args):
+async def stop_gui(client):
+    if client.gui_task is None:
+        return
+    client.gui_task.cancel()
+    try:
+        await client.gui_task
+    except CancelledError:
+        pass
+    client.gui_task = None
+
+
+def startup(args):
     if not os.path.exists(CONFIG_FILE_NAME):
         print("Configuration file {} not found. "
               "This file is required for specifying local machine configuration such as the output folder.\n"
@@ -505,12 +768,31 @@ async def amain_startup(args):
     # TODO - fold this into window, make it the general IO object, so it decided to spew to stdout or to the GUI
     banner("Emolog: Embedded Monitor and Logger")
 
+
+async def start_client(args):
     client = EmoToolClient(ticks_per_second=args.ticks_per_second,
         verbose=not args.silent, dump=args.dump, debug=args.debug,
-        csv_writer_factory=resolve(args.csv_factory))
-    await start_transport(client=client, args=args)
+        csv_writer_factory=resolve(args.csv_factory),
+        writer_queue_size=args.writer_queue, writer_overflow=args.writer_overflow)
+    client.MAX_WINDOW = args.max_window
+    if args.replay is None:
+        await start_transport(client=client, args=args)
     return client
 
+
+async def amain_startup(args):
+    startup(args)
+    return await start_client(args)
+
+
+async def amain_targets_startup(args):
+    """
+    Connect to every --target, all on this loop
+    """
+    startup(args)
+    return list(await gather(*(start_client(target) for target in args.targets)))
+
+
 def reasonable_timestamp_ms(timestamp):
     """
     checks that the timestamp is within 100 years and not zero
@@ -546,10 +828,7 @@ def check_timestamp(params, elf_variables):
     print("Timestamp verified: ELF file and embedded target match")
 
 
-async def amain(client, args):
-    defs = merge_vars_from_file_and_list(def_lines=args.var, filename=args.varfile)
-    names, variables = read_elf_variables(elf=args.elf, defs=defs)
-
+def recording_filename(args, extension):
     config = ConfigParser()
     config.read(CONFIG_FILE_NAME)
 
@@ -558,19 +837,73 @@ async def amain(client, args):
         if args.label or args.group:
             print("error: --out cannot be combined with --label or --group", file=sys.stderr)
             raise SystemExit(1)
-        if args.out[-4:] != '.csv':
-            args.out = args.out + '.csv'
+        if args.out[-len(extension):] != extension:
+            args.out = args.out + extension
         csv_filename = os.path.join(output_folder, args.out)
     else:   # either --out or --out_prefix must be specified
         validate_filename_component(args.label, '--label')
         validate_filename_component(args.group, '--group')
         csv_filename = next_available(output_folder, args.out_prefix,
-                                      group=args.group, label=args.label)
+                                      group=args.group, label=args.label, extension=extension)
+    return csv_filename
+
+
+def output_filename(args, csv_filename):
+    """
+    :return: the file to open the recording with, its index when rotated
+    """
+    if args.rotate_samples > 0 or args.rotate_seconds > 0:
+        return index_filename(csv_filename)
+    return csv_filename
+
+
+def sampling_limits(args, variables):
+    """
+    :return: (ticks between samples, samples to record or 0 for no limit)
+    """
+    min_ticks = gcd(*(var['period_ticks'] for var in variables))
+    max_samples = args.ticks_per_second * args.runtime if args.runtime else 0 # TODO - off by a factor of at least min_ticks_between_samples
+    # TODO this corrects run-time if all vars are sampled at a low rate, but still incorrect in some cases e.g. (10, 13)
+    max_samples = max_samples / min_ticks
+    if args.replay is not None:
+        max_samples = 0
+    return min_ticks, max_samples
+
+
+def print_bandwidth(args, variables):
+    bandwidth_bps = bandwidth_calc(args=args, variables=variables)
+    print("Estimated bandwidth usage: {} Mbps out of {} ({:.3f}%)".format(
+        bandwidth_bps / 1e6,
+        args.baud / 1e6,
+        100 * bandwidth_bps / args.baud))
+
+
+def print_client_stats(client, total_time):
+    print("Samples received: {samples_received}\nTicks lost: {ticks_lost}\nTime run {total_time:.3f}s".format(
+            samples_received=client.samples_received,
+            ticks_lost=client.ticks_lost,
+            total_time=total_time,
+        ))
+    writer_stats = client.writer_stats
+    if writer_stats is not None:
+        print("Writer queue high-water mark: {high_water}/{queue_size}, samples dropped: {rows_dropped}".format(
+            **writer_stats))
+    skip_stats = client.skip_stats
+    if skip_stats['resyncs'] > 0:
+        print("Line noise: {skipped_bytes} bytes skipped in {resyncs} places".format(**skip_stats))
+
+
+async def amain(client, args):
+    defs = merge_vars_from_file_and_list(def_lines=args.var, filename=args.varfile)
+    names, variables = read_elf_variables(elf=args.elf, defs=defs, cache=not args.no_elf_cache)
+
+    recording_format = RECORDING_FORMATS[args.format]
+    csv_filename = recording_filename(args, recording_format.extension)
 
     take_snapshot = args.check_timestamp or args.snapshotfile
     if take_snapshot:
         print("Taking snapshot of parameters")
-        snapshot_output_filename = csv_filename[:-4] + '_params.csv'
+        snapshot_output_filename = os.path.splitext(csv_filename)[0] + '_params.csv'
         (snapshot_elf_variables, params) = await record_snapshot(
             args=args, client=client,
             csv_filename=snapshot_output_filename,
@@ -583,47 +916,101 @@ async def amain(client, args):
             check_timestamp(params, snapshot_elf_variables)
 
     print("")
-    print("Output file: {}".format(os.path.basename(csv_filename)))
+    print("Output file: {}".format(os.path.basename(output_filename(args, csv_filename))))
     print("Output folder: {}".format(os.path.dirname(os.path.abspath(csv_filename))))
     if getattr(args, 'serial_autodetect_info', None):
         print(f"Auto-detected {args.serial_autodetect_info['device']}")
         logger.info(format_autodetect_detail(args.serial_autodetect_info))
-    bandwidth_bps = bandwidth_calc(args=args, variables=variables)
-    print("Estimated bandwidth usage: {} Mbps out of {} ({:.3f}%)".format(
-        bandwidth_bps / 1e6,
-        args.baud / 1e6,
-        100 * bandwidth_bps / args.baud))
-    min_ticks = gcd(*(var['period_ticks'] for var in variables))
-    max_samples = args.ticks_per_second * args.runtime if args.runtime else 0 # TODO - off by a factor of at least min_ticks_between_samples
-    # TODO this corrects run-time if all vars are sampled at a low rate, but still incorrect in some cases e.g. (10, 13)
-    max_samples = max_samples / min_ticks
+    print_bandwidth(args, variables)
+    min_ticks, max_samples = sampling_limits(args, variables)
     if max_samples > 0:
         print("Running for {} seconds = {} samples".format(args.runtime, int(max_samples)))
-    client.reset(csv_filename=csv_filename, names=names, min_ticks=min_ticks, max_samples=max_samples)
+    client.reset(csv_filename=csv_filename, names=names, min_ticks=min_ticks, max_samples=max_samples,
+                 writer_factory=recording_format.writer_factory, rotate_samples=args.rotate_samples,
+                 rotate_seconds=args.rotate_seconds)
     if args.listen:
-        await start_tcp_listener(client, args.listen)
+        await start_tcp_listener(client, args.listen, overflow=args.listen_overflow,
+                                 points_per_second=args.listen_points_per_second, decimation=args.listen_decimation,
+                                 ticks_per_second=args.ticks_per_second)
+    if args.gui:
+        start_gui(client, args)
 
     print("")
     print("========== Recording started ==========")
 
     start_time = time()
-    await run_client(args=args, client=client, variables=variables, allow_kb_stop=True)
+    if args.replay is not None:
+        await replay_dump(args=args, client=client, variables=variables)
+    else:
+        await run_client(args=args, client=client, variables=variables, allow_kb_stop=True)
 
     logger.debug("stopped at time={} samples={}".format(time(), client.samples_received))
-    total_time = time() - start_time
-    print("Samples received: {samples_received}\nTicks lost: {ticks_lost}\nTime run {total_time:.3f}s".format(
-            samples_received=client.samples_received,
-            ticks_lost=client.ticks_lost,
-            total_time=total_time,
-        ))
+    print_client_stats(client, time() - start_time)
     return client
 
 
+def target_recording_filename(filename, target):
+    base, extension = os.path.splitext(filename)
+    return '{}_{}{}'.format(base, target.name, extension)
+
+
+async def amain_targets(clients, args):
+    """
+    Record all the --target at once, each to its own recording named after
+    the same one, e.g. emo_007_motor.csv and emo_007_psu.csv. Timestamps in
+    all of them are the host's utc milliseconds, comparable across targets.
+    """
+    defs = [merge_vars_from_file_and_list(def_lines=target.var, filename=target.varfile) for target in args.targets]
+    targets_variables = read_elf_variables_of_targets(
+        [(target.elf, target_defs) for target, target_defs in zip(args.targets, defs)], cache=not args.no_elf_cache)
+
+    recording_format = RECORDING_FORMATS[args.format]
+    csv_filename = recording_filename(args, recording_format.extension)
+    print("")
+    print("Output folder: {}".format(os.path.dirname(os.path.abspath(csv_filename))))
+    for target, client, (names, variables) in zip(args.targets, clients, targets_variables):
+        target_filename = target_recording_filename(csv_filename, target)
+        print("{}: output file {}".format(target.name, os.path.basename(output_filename(args, target_filename))))
+        if getattr(target, 'serial_autodetect_info', None):
+            print(f"{target.name}: auto-detected {target.serial_autodetect_info['device']}")
+        print_bandwidth(target, variables)
+        min_ticks, max_samples = sampling_limits(target, variables)
+        client.reset(csv_filename=target_filename, names=names, min_ticks=min_ticks, max_samples=max_samples,
+                     writer_factory=recording_format.writer_factory, rotate_samples=args.rotate_samples,
+                     rotate_seconds=args.rotate_seconds)
+    if args.runtime:
+        print("Running for {} seconds".format(args.runtime))
+
+    print("")
+    print("========== Recording started ==========")
+
+    start_time = time()
+    await run_clients(args=args, clients_and_variables=[(client, variables) for client, (names, variables) in
+                                                        zip(clients, targets_variables)], allow_kb_stop=True)
+    total_time = time() - start_time
+    for target, client in zip(args.targets, clients):
+        print("{}:".format(target.name))
+        print_client_stats(client, total_time)
+    return clients
+
+
+async def cleanup_targets(args, clients):
+    for target, client in zip(args.targets, clients):
+        await cleanup(target, client)
+
+
 def start_callback(args, loop):
+    """
+    :return: the client, or the list of clients of the --target
+    """
     loop.set_debug(args.debug)
+    if args.targets:
+        startup_func, main_func, cleanup_func = amain_targets_startup, amain_targets, cleanup_targets
+    else:
+        startup_func, main_func, cleanup_func = amain_startup, amain, cleanup
 
     try:
-        client = loop.run_until_complete(amain_startup(args))
+        client = loop.run_until_complete(startup_func(args))
     except SystemExit:
         # this is fine, but please exit — preserve the original exit code
         raise
@@ -632,14 +1019,14 @@ def start_callback(args, loop):
         raise SystemExit(1)
     ctrl_c = False
     try:
-        client = loop.run_until_complete(amain(client=client, args=args))
+        client = loop.run_until_complete(main_func(client, args))
     except KeyboardInterrupt:
         print("exiting on user ctrl-c")
         ctrl_c = True
     except Exception as e:
         logger.error("got exception {!r}".format(e))
         raise
-    loop.run_until_complete(cleanup(args=args, client=client))
+    loop.run_until_complete(cleanup_func(args, client))
     if ctrl_c:
         # Treat ctrl-c as an error exit so wrapper .bat files skip post-processing.
         # The graceful "press any key to stop" path returns normally instead.
@@ -647,6 +1034,17 @@ def start_callback(args, loop):
     return client
 
 
+def resolve_target_serial(args):
+    if args.fake is None and args.replay is None:
+        try:
+            args.serial, args.serial_autodetect_info = resolve_serial(args.serial, args.serial_autodetect)
+        except AutodetectError as e:
+            print(str(e), file=sys.stderr)
+            raise SystemExit(1)
+    else:
+        args.serial_autodetect_info = None
+
+
 def main(cmdline=None):
     freeze_support()
     parse_args_args = [] if cmdline is None else [cmdline]
@@ -656,14 +1054,8 @@ def main(cmdline=None):
         from .embedded import main as embmain
         embmain()
     else:
-        if args.fake is None:
-            try:
-                args.serial, args.serial_autodetect_info = resolve_serial(args.serial, args.serial_autodetect)
-            except AutodetectError as e:
-                print(str(e), file=sys.stderr)
-                raise SystemExit(1)
-        else:
-            args.serial_autodetect_info = None
+        for target in args.targets if args.targets else [args]:
+            resolve_target_serial(target)
         loop = get_event_loop()
         def exception_handler(loop, context):
             print("Async Exception caught: {context}".format(context=context))
@@ -671,8 +1063,9 @@ def main(cmdline=None):
             raise SystemExit(1)
         loop.set_exception_handler(exception_handler)
         client = start_callback(args, loop)
-        if client.csv_filename is None or not os.path.exists(client.csv_filename):
-            print("no csv file created.")
+        for c in client if args.targets else [client]:
+            if c.csv_filename is None or not recording_exists(c.csv_filename):
+                print("no csv file created.")
 
 
 if __name__ == '__main__':
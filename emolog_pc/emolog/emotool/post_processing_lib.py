@@ -5,9 +5,15 @@ import argparse
 import configparser
 import numpy as np
 
+from ..recording import read_recording, RECORDING_EXTENSIONS
+from ..rotation import is_index, is_part, recording_base
+
 
 CONFIG_FILE_NAME = 'local_machine_config.ini'
 
+# --first-ticks / --last-ticks of the run, applied by load_and_clean unless given a range
+ticks_range = (None, None)
+
 
 # ---------------   main() Related Logic   ---------------
 
@@ -27,6 +33,11 @@ def get_args():
                         help='Sample rate of the recording in Hz. Forwarded to the project-specific callback via args.')
     parser.add_argument('--analysis', default=None,
                         help='Identifier for the analysis type to use. Interpreted by the project-specific callback.')
+    parser.add_argument('--first-ticks', type=int, default=None,
+                        help='Process only the samples from these ticks on. Of a rotated recording (.index.json) '
+                             'only the parts holding the range are read.')
+    parser.add_argument('--last-ticks', type=int, default=None,
+                        help='Process only the samples up to these ticks, see --first-ticks.')
     args = parser.parse_args()
     return args
 
@@ -49,9 +60,9 @@ def calc_file_list(args, config):
             print(f"No input was provided and configuration file {CONFIG_FILE_NAME} does not "
                   f"specify [folders] output_folder, I don't know what to process. Exiting.")
             raise SystemExit(1)
-        args.input_csv = os.path.join(output_folder, '**', '*.csv')
+        args.input_csv = os.path.join(output_folder, '**', '*.*')
     elif os.path.isdir(args.input_csv):
-        args.input_csv = os.path.join(args.input_csv, '**', '*.csv')
+        args.input_csv = os.path.join(args.input_csv, '**', '*.*')
     files = glob.glob(args.input_csv, recursive=True)
     # Fallback for relative paths with no match in cwd: retry under the configured output folder.
     # A bare filename (no directory component) is searched recursively, so subfolder grouping
@@ -69,9 +80,11 @@ def calc_file_list(args, config):
             if retry:
                 args.input_csv = candidate
                 files = retry
-    files = [f for f in files if f[-4:].lower() == '.csv' and f[-11:-4] != '_params']
+    # the parts of a rotated recording are processed together, through their index
+    files = [f for f in files if is_index(f) or (os.path.splitext(f)[1].lower() in RECORDING_EXTENSIONS
+             and not os.path.splitext(f)[0].endswith('_params') and not is_part(f))]
     if len(files) == 0:
-        print('No CSV files found. Exiting.')
+        print('No recordings found. Exiting.')
         raise SystemExit(1)
     if args.newest:
         files = [find_newest_file(files)]
@@ -107,7 +120,9 @@ def print_summary(summary):
 
 
 def post_processing_main(process_func):
+    global ticks_range
     args = get_args()
+    ticks_range = (args.first_ticks, args.last_ticks)
     config = read_config(CONFIG_FILE_NAME)
     files = calc_file_list(args, config)
 
@@ -118,7 +133,7 @@ def post_processing_main(process_func):
 
     summary = {'processed': 0, 'failed': 0, 'skipped': 0}
     for filename in files:
-        output_filename = filename[:-4] + '.xlsx'
+        output_filename = recording_base(filename) + '.xlsx'
         output_base = os.path.basename(output_filename)
         if multi:
             print(os.path.basename(filename) + ':  ', end='')
@@ -162,8 +177,14 @@ def output_exists(output_filename):
 
 # ---------------   Generic Post-Processing Library Functions  ---------------
 
-def load_and_clean(input_csv_filename, prefixes_to_remove, suffixes_to_remove):
-    data = pd.read_csv(input_csv_filename)
+def load_and_clean(input_csv_filename, prefixes_to_remove, suffixes_to_remove, first_ticks=None, last_ticks=None):
+    """
+    :param first_ticks, last_ticks: ticks range to read, see read_recording. By default the
+                                    --first-ticks / --last-ticks given to post_processing_main
+    """
+    if first_ticks is None and last_ticks is None:
+        first_ticks, last_ticks = ticks_range
+    data = read_recording(input_csv_filename, first_ticks=first_ticks, last_ticks=last_ticks)
     data.columns = [clean_col_name(c, prefixes_to_remove, suffixes_to_remove) for c in data.columns]
     data = remove_unneeded_columns(data)
     data = data.set_index('Ticks')
@@ -233,7 +254,7 @@ def interpolate_missing_data(data):
 
 
 def process_params_snapshot(input_csv_filename, prefixes_to_remove, suffixes_to_remove):
-    snapshot_csv_filename = input_csv_filename[:-4] + '_params.csv'
+    snapshot_csv_filename = recording_base(input_csv_filename) + '_params.csv'
     if not os.path.isfile(snapshot_csv_filename):
         return None
     params = pd.read_csv(snapshot_csv_filename)
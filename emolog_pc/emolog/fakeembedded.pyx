@@ -48,6 +48,8 @@ cdef class FakeSineEmbeddedBase:
     """
 
     VERSION = 1
+    # requests we accept in flight, advertised in our Version; the parser buffers any number
+    WINDOW = 32
     cdef Sine sines[10]
     cdef int sines_num
     cdef int start_time
@@ -100,7 +102,7 @@ cdef class FakeSineEmbeddedBase:
 
         # reply with ACK to everything
         if isinstance(msg, Version):
-            self.parser.send_message(Version, version=self.VERSION, reply_to_seq=msg.seq)
+            self.parser.send_message(Version, version=self.VERSION, reply_to_seq=msg.seq, window=self.WINDOW)
         else:
             self.parser.send_message(Ack, error=0, reply_to_seq=msg.seq)
 
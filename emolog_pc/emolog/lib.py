@@ -19,8 +19,8 @@
 
 import asyncio
 from asyncio import Future, Protocol, sleep, get_event_loop
-# from asyncio.futures import InvalidStateError
-from time import time
+from asyncio import InvalidStateError
+from collections import deque
 from struct import pack
 import sys
 from logging import getLogger
@@ -34,6 +34,7 @@ from .cylib import (
     Message, Ack, SamplerSample,
     header_size, emo_decode
     )
+from .background_writer import OVERFLOW_BLOCK
 
 if 'profile' not in builtins.__dict__:
     def nop_decorator(f):
@@ -45,39 +46,36 @@ logger = getLogger('emolog')
 
 
 class Futures:
-    CHECK_DT = 0.1
+    """
+    Futures with an optional timeout, after which they are resolved with
+    timeout_result. Each timeout is a loop timer, cancelled as soon as the
+    future is done, so timeouts fire on time and nothing runs while idle.
+    """
     def __init__(self):
         self._futures = {}
-        self._new_futures = {}
-        get_event_loop().create_task(self.reaper())
-
-    async def reaper(self):
-        while True:
-            await sleep(self.CHECK_DT)
-            now = time()
-            removed = []
-            for f, (start_time, timeout, timeout_result) in self._futures.items():
-                if f.done():
-                    removed.append(f)
-                elif timeout is not None and now > start_time + timeout:
-                    self.set_future_result(f, timeout_result)
-                    removed.append(f)
-            for f in removed:
-                if f in self._futures:
-                    del self._futures[f]
-            self._futures.update(self._new_futures)
-            self._new_futures.clear()
 
     def cancel_all(self):
-        for f, (start_time, timeout, timeout_result) in self._futures.items():
+        for f, timer in self._futures.items():
+            if timer is not None:
+                timer.cancel()
             f.cancel()
         self._futures.clear()
 
     def add_future(self, timeout=None, timeout_result=None):
-        f = Future()
-        self._new_futures[f] = (time(), timeout, timeout_result)
+        loop = get_event_loop()
+        f = loop.create_future()
+        timer = None
+        if timeout is not None:
+            timer = loop.call_later(timeout, self.set_future_result, f, timeout_result)
+        self._futures[f] = timer
+        f.add_done_callback(self._future_done)
         return f
 
+    def _future_done(self, f):
+        timer = self._futures.pop(f, None)
+        if timer is not None:
+            timer.cancel()
+
     def set_future_result(self, future, result):
         try:
             future.set_result(result)
@@ -98,15 +96,22 @@ class ClientProtocolMixin(Protocol):
     ACK_TIMEOUT_SECONDS = 1.0
     ACK_TIMEOUT = 'ACK_TIMEOUT'
     MISSED_MESSAGES_BEFORE_REREGISTRATION = 2
+    # most register requests in flight, if the target's Version advertises a window.
+    # 1 disables pipelining
+    MAX_WINDOW = 32
 
-    def __init__(self, verbose, dump, ticks_per_second, csv_writer_factory=None):
+    def __init__(self, verbose, dump, ticks_per_second, csv_writer_factory=None, writer_queue_size=0,
+                 writer_overflow=OVERFLOW_BLOCK):
         Protocol.__init__(self)
         self._ticks_per_second = ticks_per_second
         self.last_samples_received = None
         self.cylib = EmotoolCylib(
             parent=self, verbose=verbose, dump=dump,
-            csv_writer_factory=csv_writer_factory)
+            csv_writer_factory=csv_writer_factory,
+            writer_queue_size=writer_queue_size, writer_overflow=writer_overflow)
         self.futures = Futures()
+        self.window = 1
+        self._pipelined_acks = {}
         self.reset_ack()
         self.connection_made_future = self.futures.add_future()
         self._reset_task = None
@@ -126,6 +131,18 @@ class ClientProtocolMixin(Protocol):
         #self._debug_log("serial connection_lost")
         pass
 
+    def ack_received(self, reply_to_seq):
+        future = self._pipelined_acks.get(reply_to_seq)
+        if future is None:
+            future = self.ack
+        self.set_future_result(future, True)
+
+    def version_received(self, version):
+        self.window = max(1, min(version.window, self.MAX_WINDOW))
+        if self.window > 1:
+            logger.info("target accepts {} requests in flight".format(version.window))
+        self.set_future_result(self.ack, True)
+
     def exit_gracefully(self):
         self.futures.cancel_all()
 
@@ -157,14 +174,23 @@ class ClientProtocolMixin(Protocol):
     async def send_set_variables(self, variables):
         await self.send_sampler_clear()
         self.cylib.sampler.clear()
-        for d in variables:
-            logger.info("Sending 'Register variable': {}".format(repr(d)))
-            await self._send_sampler_register_variable(
+        if self.window > 1:
+            for d in variables:
+                logger.info("Sending 'Register variable': {}".format(repr(d)))
+            await self.send_pipelined([(SamplerRegisterVariable, dict(
                 phase_ticks=d['phase_ticks'],
                 period_ticks=d['period_ticks'],
                 address=d['address'],
-                size=d['size']
-            )
+                size=d['size'])) for d in variables])
+        else:
+            for d in variables:
+                logger.info("Sending 'Register variable': {}".format(repr(d)))
+                await self._send_sampler_register_variable(
+                    phase_ticks=d['phase_ticks'],
+                    period_ticks=d['period_ticks'],
+                    address=d['address'],
+                    size=d['size']
+                )
         self.cylib.sampler.register_variables(variables)
         self._variables = variables
 
@@ -224,8 +250,8 @@ class ClientProtocolMixin(Protocol):
 
     async def send_version(self):
         # We don't tell our version to the embedded right now - it doesn't care
-        # anyway
-        await self.send_after_last(Version)
+        # anyway. Wait for its reply, it sets the window for send_pipelined
+        await self.send_and_ack(Version)
 
     async def send_after_last(self, msg_type, **kw):
         """
@@ -241,3 +267,31 @@ class ClientProtocolMixin(Protocol):
     async def send_and_ack(self, msg_type, **kw):
         await self.send_after_last(msg_type, **kw)
         await self.await_ack()
+
+    async def send_pipelined(self, messages):
+        """
+        Send [(msg_type, kw)] keeping up to self.window requests in flight,
+        matching acks by reply_to_seq. Takes about one round trip instead of
+        one per message. Returns once all are acked.
+        """
+        await self.await_ack()
+        in_flight = deque()
+        try:
+            for msg_type, kw in messages:
+                if len(in_flight) >= self.window:
+                    await self._await_pipelined_ack(in_flight.popleft())
+                seq = self.cylib.parser.send_message(msg_type, **kw)
+                self._pipelined_acks[seq] = self.futures.add_future(
+                    timeout=self.ACK_TIMEOUT_SECONDS, timeout_result=self.ACK_TIMEOUT)
+                in_flight.append(seq)
+            while len(in_flight) > 0:
+                await self._await_pipelined_ack(in_flight.popleft())
+        finally:
+            self._pipelined_acks.clear()
+
+    async def _await_pipelined_ack(self, seq):
+        result = await self._pipelined_acks[seq]
+        del self._pipelined_acks[seq]
+        if result == self.ACK_TIMEOUT:
+            print("Timeout")
+            raise AckTimeout()
@@ -0,0 +1,188 @@
+"""
+emotool --gui: live plot of the sampled variables, fed by a CSVHandler
+listener.
+
+Samples are decimated (decimation.py, minmax) to points_per_second and kept
+in a RingBuffer per variable holding the last window_seconds, so memory
+stays the same however long the capture runs. Lines are set to views of the
+ring buffers, no copy is made before matplotlib's own, and redrawn by draw(),
+which does nothing when called more than max_fps times a second or when no
+samples arrived since the last drawing.
+
+The x axis is the target's ticks in seconds, unwrapped: uint32 ticks wrap
+after a few days at usual tick rates.
+
+matplotlib is only needed here (pip install emolog[gui]). A headless LivePlot
+draws with the Agg backend to an offscreen buffer, see render().
+"""
+
+from time import monotonic
+
+import numpy as np
+
+from .decimation import Decimator, DECIMATION_MINMAX
+from .streaming import stream_schema, stream_arrays
+from .ticks import TicksUnwrapper
+
+
+DEFAULT_WINDOW_SECONDS = 10.0
+DEFAULT_POINTS_PER_SECOND = 2000
+DEFAULT_MAX_FPS = 20
+
+class LivePlotError(Exception):
+    pass
+
+
+class RingBuffer:
+    """
+    The last capacity values appended, read as a single contiguous view: every
+    value is stored twice, capacity apart, so the oldest to newest values
+    always follow each other somewhere in the array.
+    """
+
+    def __init__(self, capacity, dtype=np.float64):
+        self.capacity = capacity
+        self.data = np.zeros(2 * capacity, dtype=dtype)
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def extend(self, values):
+        values = values[len(values) - min(len(values), self.capacity):]
+        n = len(values)
+        first = min(n, self.capacity - self.head)
+        for offset in (self.head, self.head + self.capacity):
+            self.data[offset:offset + first] = values[:first]
+        for offset in (0, self.capacity):
+            self.data[offset:offset + n - first] = values[first:]
+        self.head = (self.head + n) % self.capacity
+        self.count = min(self.count + n, self.capacity)
+
+    def view(self):
+        """
+        :return: the values, oldest first, without copying
+        """
+        end = self.head + self.capacity
+        return self.data[end - self.count:end]
+
+
+def _figure(headless):
+    try:
+        if headless:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            figure = Figure()
+            FigureCanvasAgg(figure)
+            return figure
+        from matplotlib import pyplot
+    except ImportError as e:
+        raise LivePlotError('live plotting needs matplotlib, pip install emolog[gui]: {}'.format(e))
+    figure = pyplot.figure()
+    pyplot.show(block=False)
+    return figure
+
+
+class LivePlot:
+    """
+    Register listener with the CSVHandler (EmoToolClient.register_listener)
+    and call draw() periodically, see emotool's run_gui.
+    """
+
+    def __init__(self, ticks_per_second, window_seconds=DEFAULT_WINDOW_SECONDS,
+                 points_per_second=DEFAULT_POINTS_PER_SECOND, max_fps=DEFAULT_MAX_FPS, headless=False):
+        self.ticks_per_second = ticks_per_second
+        self.window_seconds = window_seconds
+        self.max_fps = max_fps
+        self.decimator = Decimator(DECIMATION_MINMAX, points_per_second, ticks_per_second)
+        # minmax rows come in pairs, and a bucket may straddle the window start
+        self.capacity = int(np.ceil(window_seconds * points_per_second)) + 4
+        self.figure = _figure(headless)
+        self.closed = False
+        self.figure.canvas.mpl_connect('close_event', self._on_close)
+        self.names = []
+        self._schema_key = None
+        self._indices = []
+        self.times = RingBuffer(self.capacity)
+        self.buffers = []
+        self.lines = []
+        self.unwrap = TicksUnwrapper()
+        self.dirty = False
+        self.last_draw = None
+
+    def _on_close(self, event):
+        self.closed = True
+
+    def _reset(self, names, types):
+        columns, self._indices = stream_schema(names, types)
+        self.names = [column['name'] for column in columns[3:]]
+        self.decimator.reset()
+        self.times.clear()
+        self.unwrap.reset()
+        self.figure.clear()
+        self.buffers = []
+        self.lines = []
+        axes = None
+        for i, name in enumerate(self.names):
+            axes = self.figure.add_subplot(len(self.names), 1, i + 1, sharex=axes)
+            axes.set_ylabel(name)
+            self.buffers.append(RingBuffer(self.capacity))
+            self.lines.append(axes.plot([], [])[0])
+        if axes is not None:
+            axes.set_xlabel('seconds')
+
+    def listener(self, names, types, seq, ticks, timestamp, values):
+        key = (tuple(names), tuple(map(id, types)))
+        if key != self._schema_key:
+            self._schema_key = key
+            self._reset(names, types)
+        arrays = self.decimator(stream_arrays(seq, ticks, timestamp, values, self._indices))
+        if len(arrays[1]) == 0:
+            return
+        self.times.extend(self.seconds(arrays[1]))
+        for buffer, column in zip(self.buffers, arrays[3:]):
+            buffer.extend(column)
+        self.dirty = True
+
+    def seconds(self, ticks):
+        """
+        :return: ticks, unwrapped, in seconds
+        """
+        return self.unwrap(ticks) / self.ticks_per_second
+
+    def draw(self, force=False):
+        """
+        :param force: draw even if called again too soon
+        :return: True if drawn
+        """
+        now = monotonic()
+        if not self.dirty or (not force and self.last_draw is not None and now - self.last_draw < 1 / self.max_fps):
+            return False
+        times = self.times.view()
+        for line, buffer in zip(self.lines, self.buffers):
+            line.set_data(times, buffer.view())
+            line.axes.relim()
+            line.axes.autoscale_view(scalex=False)
+        if len(self.lines) > 0 and len(times) > 0:
+            self.lines[0].axes.set_xlim(times[-1] - self.window_seconds, times[-1])
+        self.figure.canvas.draw_idle()
+        self.dirty = False
+        self.last_draw = now
+        return True
+
+    def flush_events(self):
+        self.figure.canvas.flush_events()
+
+    def render(self):
+        """
+        Draw now, for headless use
+        :return: the figure as an RGBA array
+        """
+        self.draw(force=True)
+        self.figure.canvas.draw()
+        return np.asarray(self.figure.canvas.buffer_rgba())
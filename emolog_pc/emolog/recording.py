@@ -0,0 +1,300 @@
+"""
+Recording file formats.
+
+csv - the default, one text row per sample.
+
+emolog-bin - binary, columnar, written in chunks. Layout (little endian):
+
+    magic        8 bytes, RECORDING_MAGIC
+    schema       uint32 length + utf-8 JSON:
+                 {"columns": [{"name": "sequence", "dtype": "u1"},
+                              {"name": "ticks", "dtype": "<u4"},
+                              {"name": "timestamp", "dtype": "<f8"},
+                              {"name": <variable>, "dtype": <numpy dtype str or "str">,
+                               ["names": {<value>: <name>}, "max_unsigned_val": <int>]}, ...]}
+    chunks       until end of file, each:
+                 uint32 number of rows
+                 per column, in schema order:
+                     uint8 1 if a validity mask follows, else 0
+                     [rows bytes, 1 where the column has a value]
+                     fixed size dtype: rows * itemsize bytes
+                     str: rows uint32 lengths + the utf-8 encoded values
+
+Variables are stored with the numpy type of their decoder, not formatted;
+enums keep their integer value and the schema holds the value to name
+mapping. Variables that are not sampled in a row (multi-rate sampling) are
+masked out.
+"""
+
+import json
+import os
+from struct import pack, unpack, calcsize
+
+import numpy as np
+
+from .decoders import numpy_dtype_from_unpack_str
+from .rotation import is_index, read_index, parts_in_range, select_ticks
+
+
+RECORDING_MAGIC = b'EMOLOG\x00\x01'
+CHUNK_HEADER_FORMAT = '<I'
+SCHEMA_LENGTH_FORMAT = '<I'
+# rows buffered before a chunk is written
+CHUNK_ROWS = 1 << 16
+
+STR_DTYPE = 'str'
+
+
+class RecordingFormatError(Exception):
+    pass
+
+
+def column_schema(name, t):
+    """
+    Schema entry for a variable decoded by t (a decoders.Decoder)
+    """
+    if hasattr(t, 'decode') or t.unpack_str not in numpy_dtype_from_unpack_str:
+        return dict(name=name, dtype=STR_DTYPE)
+    ret = dict(name=name, dtype=numpy_dtype_from_unpack_str[t.unpack_str])
+    if hasattr(t, 'val_to_name'):
+        ret['names'] = {str(k): v for k, v in t.val_to_name.items()}
+        ret['max_unsigned_val'] = t.max_unsigned_val
+    return ret
+
+
+class BinaryWriter:
+    """
+    Writer for the emolog-bin format. Used by CSVHandler through write_columns
+    instead of writerow; the schema is written with the first batch, once the
+    decoders are known.
+    """
+
+    def __init__(self, filename, fields):
+        self.fd = open(filename, 'wb')
+        self.fields = fields
+        self.schema = None
+        self.pending = []
+        self.pending_rows = 0
+
+    def write_columns(self, seq, ticks, timestamp, values, types):
+        """
+        :param values: one sequence per variable, numpy array or list with None
+                       for rows where the variable was not sampled
+        :param types: the decoder of each variable
+        """
+        if self.schema is None:
+            self._write_schema(types)
+        self.pending.append([seq, ticks, timestamp] + list(values))
+        self.pending_rows += len(seq)
+        if self.pending_rows >= CHUNK_ROWS:
+            self.flush()
+
+    def _write_schema(self, types):
+        self.schema = [dict(name='sequence', dtype='u1'),
+                       dict(name='ticks', dtype='<u4'),
+                       dict(name='timestamp', dtype='<f8')]
+        self.schema.extend(column_schema(name, t) for name, t in zip(self.fields[3:], types))
+        encoded = json.dumps(dict(columns=self.schema)).encode('utf-8')
+        self.fd.write(RECORDING_MAGIC + pack(SCHEMA_LENGTH_FORMAT, len(encoded)) + encoded)
+
+    def flush(self):
+        if self.pending_rows == 0:
+            return
+        parts = [pack(CHUNK_HEADER_FORMAT, self.pending_rows)]
+        for i, column in enumerate(self.schema):
+            parts.extend(encode_column(column['dtype'], [batch[i] for batch in self.pending]))
+        self.fd.write(b''.join(parts))
+        self.fd.flush()
+        self.pending = []
+        self.pending_rows = 0
+
+    def close(self):
+        self.flush()
+        self.fd.close()
+
+
+def encode_column(dtype, batches):
+    valid = None
+    if all(isinstance(b, np.ndarray) for b in batches):
+        data = np.concatenate(batches)
+    else:
+        data = [v for b in batches for v in (b.tolist() if isinstance(b, np.ndarray) else b)]
+        if any(v is None for v in data):
+            valid = np.array([v is not None for v in data], dtype=np.uint8)
+    if dtype == STR_DTYPE:
+        encoded = [('' if v is None else str(v)).encode('utf-8') for v in data]
+        body = [np.array([len(e) for e in encoded], dtype='<u4').tobytes(), b''.join(encoded)]
+    else:
+        if valid is not None:
+            fill = b'' if np.dtype(dtype).kind == 'S' else 0
+            data = [fill if v is None else v for v in data]
+        body = [np.asarray(data, dtype=dtype).tobytes()]
+    if valid is None:
+        return [b'\x00'] + body
+    return [b'\x01', valid.tobytes()] + body
+
+
+def binary_writer_factory(filename, fields, *args, **kw):
+    """
+    csv_writer_factory compatible factory for the emolog-bin format
+    """
+    return BinaryWriter(filename, fields)
+
+
+def read_binary_columns(filename):
+    """
+    :return: (schema, {column name: numpy array}), masked values are NaN
+             (integer columns with masked values become float64)
+    """
+    with open(filename, 'rb') as fd:
+        data = fd.read()
+    if data[:len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+        raise RecordingFormatError('{}: not an emolog-bin recording'.format(filename))
+    i = len(RECORDING_MAGIC)
+    schema_length, = unpack(SCHEMA_LENGTH_FORMAT, data[i:i + calcsize(SCHEMA_LENGTH_FORMAT)])
+    i += calcsize(SCHEMA_LENGTH_FORMAT)
+    schema = json.loads(data[i:i + schema_length].decode('utf-8'))['columns']
+    i += schema_length
+    chunks = {column['name']: [] for column in schema}
+    while i < len(data):
+        rows, = unpack(CHUNK_HEADER_FORMAT, data[i:i + calcsize(CHUNK_HEADER_FORMAT)])
+        i += calcsize(CHUNK_HEADER_FORMAT)
+        for column in schema:
+            values, i = decode_column(column['dtype'], data, i, rows)
+            chunks[column['name']].append(values)
+    columns = {}
+    for column in schema:
+        name = column['name']
+        if chunks[name]:
+            columns[name] = np.concatenate(chunks[name])
+        else:
+            columns[name] = np.array([], dtype=object if column['dtype'] == STR_DTYPE else column['dtype'])
+    return schema, columns
+
+
+def decode_column(dtype, data, i, rows):
+    has_mask = data[i]
+    i += 1
+    valid = None
+    if has_mask:
+        valid = np.frombuffer(data, dtype=np.uint8, count=rows, offset=i).astype(bool)
+        i += rows
+    if dtype == STR_DTYPE:
+        lengths = np.frombuffer(data, dtype='<u4', count=rows, offset=i)
+        i += 4 * rows
+        values = np.empty(rows, dtype=object)
+        for j, length in enumerate(lengths.tolist()):
+            values[j] = data[i:i + length].decode('utf-8')
+            i += length
+    else:
+        values = np.frombuffer(data, dtype=dtype, count=rows, offset=i)
+        i += values.nbytes
+    if valid is not None:
+        if values.dtype.kind in 'iub':
+            values = values.astype(np.float64)
+        elif values.dtype.kind != 'f':
+            values = values.astype(object)
+        else:
+            values = values.copy()
+        values[~valid] = np.nan
+    return values, i
+
+
+def read_binary(filename):
+    """
+    Read an emolog-bin recording into a pandas DataFrame with the same columns
+    and values pandas.read_csv gives for the csv recording.
+    """
+    import pandas as pd
+    schema, columns = read_binary_columns(filename)
+    for column in schema:
+        if 'names' not in column:
+            continue
+        names = column['names']
+        max_unsigned_val = column['max_unsigned_val']
+        values = columns[column['name']]
+        if set(names.values()) <= {'True', 'False'}:
+            # read_csv parses these into booleans
+            names = {k: v == 'True' for k, v in names.items()}
+        columns[column['name']] = map_names(values, names, max_unsigned_val)
+    return pd.DataFrame({column['name']: columns[column['name']] for column in schema})
+
+
+def map_names(values, names, max_unsigned_val):
+    """
+    Enum values to their names, with numpy: the values modulo max_unsigned_val
+    are looked up among the sorted keys of names.
+    :param values: integer array, or float with NaN where masked
+    :param names: {str(value): name}
+    :return: object array of the names, the value itself where it has no name, NaN where masked
+    """
+    ret = np.full(len(values), np.nan, dtype=object)
+    valid = np.flatnonzero(~np.isnan(values)) if values.dtype.kind == 'f' else np.arange(len(values))
+    keys = np.array(sorted(int(k) for k in names), dtype=np.int64)
+    named = np.array([names[str(k)] for k in keys], dtype=object)
+    codes = values[valid].astype(np.int64) % max_unsigned_val
+    found = np.searchsorted(keys, codes)
+    has_name = found < len(keys)
+    has_name[has_name] = keys[found[has_name]] == codes[has_name]
+    ret[valid[has_name]] = named[found[has_name]]
+    ret[valid[~has_name]] = values[valid[~has_name]].astype(object)
+    return ret
+
+
+class RecordingFormat:
+    def __init__(self, name, extension, writer_factory, reader):
+        self.name = name
+        self.extension = extension
+        self.writer_factory = writer_factory
+        self.reader = reader
+
+
+def read_csv(filename):
+    import pandas as pd
+    return pd.read_csv(filename)
+
+
+# writer_factory None means CSVHandler's default (or --csv-factory)
+RECORDING_FORMATS = {
+    'csv': RecordingFormat(name='csv', extension='.csv', writer_factory=None, reader=read_csv),
+    'emolog-bin': RecordingFormat(name='emolog-bin', extension='.emob', writer_factory=binary_writer_factory,
+                                  reader=read_binary),
+}
+
+RECORDING_EXTENSIONS = [f.extension for f in RECORDING_FORMATS.values()]
+
+
+def format_from_filename(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    for f in RECORDING_FORMATS.values():
+        if f.extension == extension:
+            return f
+    raise RecordingFormatError('{}: unknown recording format'.format(filename))
+
+
+def read_recording(filename, first_ticks=None, last_ticks=None):
+    """
+    Read a recording of any format into a pandas DataFrame. An index of a
+    rotated recording reads its parts, see rotation.
+    :param first_ticks, last_ticks: only the samples in this ticks range (inclusive, unwrapped
+                                    from the recording's first ticks), None for unbounded
+    """
+    if is_index(filename):
+        return read_ticks_range(filename, first_ticks, last_ticks)
+    return select_ticks(format_from_filename(filename).reader(filename), first_ticks, last_ticks)
+
+
+def read_ticks_range(filename, first_ticks=None, last_ticks=None):
+    """
+    Read the samples of a rotated recording in a ticks range into a pandas
+    DataFrame, opening only the parts overlapping it.
+    :param filename: the index filename
+    :param first_ticks, last_ticks: unwrapped ticks range, inclusive, None for unbounded
+    """
+    import pandas as pd
+    index = read_index(filename)
+    frames = [select_ticks(read_recording(part['filename']), first_ticks, last_ticks, start=part['first_ticks'])
+              for part in parts_in_range(index, first_ticks, last_ticks)]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=index['fields'])
+    return pd.concat(frames, ignore_index=True)
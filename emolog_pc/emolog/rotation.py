@@ -0,0 +1,270 @@
+"""
+Rotated recordings, for captures that run for hours (--runtime 0): instead of
+one ever-growing file the recording is written to parts, each started when the
+previous one holds rotate_samples samples or spans rotate_seconds of host
+time, whichever comes first:
+
+    emo_142.part0001.csv
+    emo_142.part0002.csv
+    ...
+    emo_142.index.json
+
+Every part is a complete recording of the chosen format, header included. The
+index lists the parts in order:
+
+    {"version": 1,
+     "fields": ["sequence", "ticks", "timestamp", <variable>, ...],
+     "parts": [{"filename": "emo_142.part0001.csv", "samples": <int>,
+                "first_ticks": <int>, "last_ticks": <int>,
+                "first_timestamp": <float>, "last_timestamp": <float>}, ...]}
+
+Ticks in the index are unwrapped: they keep counting past 2**32, so tick
+ranges stay ordered however long the capture. The ticks column of the parts
+is as received. The index is rewritten whenever a part is completed, and
+with the current part included when it gets its first samples and then every
+INDEX_INTERVAL_SECONDS of host time, after flushing its writer: a killed
+capture loses only what was written since.
+
+recording.read_ticks_range opens only the parts overlapping the requested
+ticks, as does recording.read_recording given an index.
+"""
+
+import json
+import os
+import re
+
+import numpy as np
+
+from .ticks import TicksUnwrapper
+
+
+PART_FORMAT = '{}.part{:04}{}'
+PART_PATTERN = re.compile(r'\.part\d{4,}$')
+INDEX_SUFFIX = '.index.json'
+INDEX_VERSION = 1
+INDEX_INTERVAL_SECONDS = 10
+
+
+def index_filename(filename):
+    """
+    :param filename: the recording filename, e.g. emo_142.csv
+    :return: its index filename, emo_142.index.json
+    """
+    return os.path.splitext(filename)[0] + INDEX_SUFFIX
+
+
+def part_filename(filename, part):
+    """
+    :return: the filename of the given part (counting from 1), e.g. emo_142.part0001.csv
+    """
+    base, extension = os.path.splitext(filename)
+    return PART_FORMAT.format(base, part, extension)
+
+
+def is_index(filename):
+    return filename.lower().endswith(INDEX_SUFFIX)
+
+
+def is_part(filename):
+    """
+    :return: True for a part of a rotated recording, read through its index
+    """
+    return PART_PATTERN.search(os.path.splitext(filename)[0]) is not None
+
+
+def recording_base(filename):
+    """
+    :return: the filename without its extension, or without INDEX_SUFFIX for an index
+    """
+    if is_index(filename):
+        return filename[:-len(INDEX_SUFFIX)]
+    return os.path.splitext(filename)[0]
+
+
+def recording_exists(filename):
+    """
+    :return: True if the recording was written, as a single file or rotated
+    """
+    return os.path.exists(filename) or os.path.exists(index_filename(filename))
+
+
+def write_header(writer, fields):
+    """
+    Header row of a row writer (csv.DictWriter like or csv.writer like)
+    """
+    if hasattr(writer, 'writeheader'):
+        writer.writeheader()
+    else:
+        writer.writerow(fields)
+
+
+class RotatingWriter:
+    """
+    Writes a recording to parts through writer_factory, one writer per part,
+    and keeps the index. Has the interface of the writers it creates:
+    writerow / writerows, or write_columns for columnar writers (see
+    CSVHandler), and close.
+    """
+
+    def __init__(self, filename, fields, writer_factory, rotate_samples=0, rotate_seconds=0, **kw):
+        """
+        :param rotate_samples: most samples per part, 0 for no limit
+        :param rotate_seconds: most host seconds per part, 0 for no limit
+        :param kw: passed to writer_factory
+        """
+        if rotate_samples < 0 or rotate_seconds < 0:
+            raise ValueError('rotation limits cannot be negative, got {} samples and {} seconds'.format(
+                rotate_samples, rotate_seconds))
+        self.filename = filename
+        self.index_filename = index_filename(filename)
+        self.fields = fields
+        self.writer_factory = writer_factory
+        self.kw = kw
+        self.rotate_samples = rotate_samples
+        # timestamps are milliseconds
+        self.rotate_ms = rotate_seconds * 1000
+        self.parts = []
+        self.unwrap = TicksUnwrapper()
+        self.writer = None
+        # last_timestamp of the current part when last in the index, None if not yet
+        self.indexed_timestamp = None
+        self._open()
+        if hasattr(self.writer, 'write_columns'):
+            self.write_columns = self._write_columns
+
+    def _open(self):
+        filename = part_filename(self.filename, len(self.parts) + 1)
+        self.writer = self.writer_factory(filename, fields=self.fields, **self.kw)
+        if not hasattr(self.writer, 'write_columns'):
+            write_header(self.writer, self.fields)
+        self.parts.append(dict(filename=os.path.basename(filename), samples=0, first_ticks=None, last_ticks=None,
+                               first_timestamp=None, last_timestamp=None))
+        self.indexed_timestamp = None
+
+    def _rotate(self):
+        self.writer.close()
+        self._write_index()
+        self._open()
+
+    def _write_index(self):
+        parts = [part for part in self.parts if part['samples'] > 0]
+        temp_filename = self.index_filename + '.tmp'
+        with open(temp_filename, 'w') as fd:
+            json.dump(dict(version=INDEX_VERSION, fields=self.fields, parts=parts), fd, indent=1)
+        os.replace(temp_filename, self.index_filename)
+        self.indexed_timestamp = self.parts[-1]['last_timestamp']
+
+    def _checkpoint(self):
+        """
+        Index the current part, once it has samples and then every
+        INDEX_INTERVAL_SECONDS
+        """
+        last_timestamp = self.parts[-1]['last_timestamp']
+        if last_timestamp is None:
+            return
+        if self.indexed_timestamp is not None and last_timestamp - self.indexed_timestamp < INDEX_INTERVAL_SECONDS * 1000:
+            return
+        if hasattr(self.writer, 'flush'):
+            self.writer.flush()
+        self._write_index()
+
+    def _ranges(self, ticks, timestamp):
+        """
+        Split a batch between the parts, rotating as needed
+        :return: iterator of (start, end) rows going to the current part
+        """
+        n = len(ticks)
+        if n == 0:
+            return
+        unwrapped = self.unwrap(ticks)
+        start = 0
+        while start < n:
+            part = self.parts[-1]
+            end = n
+            if self.rotate_samples > 0:
+                end = min(end, start + self.rotate_samples - part['samples'])
+            if self.rotate_ms > 0:
+                first = part['first_timestamp'] if part['samples'] > 0 else timestamp[start]
+                late = np.flatnonzero(np.asarray(timestamp[start:end]) - first >= self.rotate_ms)
+                if len(late) > 0:
+                    end = start + int(late[0])
+            if end <= start:
+                self._rotate()
+                continue
+            if part['samples'] == 0:
+                part['first_ticks'] = int(unwrapped[start])
+                part['first_timestamp'] = float(timestamp[start])
+            part['last_ticks'] = int(unwrapped[end - 1])
+            part['last_timestamp'] = float(timestamp[end - 1])
+            part['samples'] += end - start
+            yield start, end
+            start = end
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        ticks = [row[1] for row in rows]
+        timestamp = [row[2] for row in rows]
+        for start, end in self._ranges(ticks, timestamp):
+            if hasattr(self.writer, 'writerows'):
+                self.writer.writerows(rows[start:end])
+            else:
+                for row in rows[start:end]:
+                    self.writer.writerow(row)
+        self._checkpoint()
+
+    def _write_columns(self, seq, ticks, timestamp, values, types):
+        for start, end in self._ranges(ticks, timestamp):
+            self.writer.write_columns(seq[start:end], ticks[start:end], timestamp[start:end],
+                                      [v[start:end] for v in values], types)
+        self._checkpoint()
+
+    def close(self):
+        self.writer.close()
+        self._write_index()
+
+
+def read_index(filename):
+    """
+    :return: the index, with the part filenames relative to the current directory
+    """
+    with open(filename) as fd:
+        index = json.load(fd)
+    if index.get('version') != INDEX_VERSION:
+        raise ValueError('{}: unsupported index version {}'.format(filename, index.get('version')))
+    folder = os.path.dirname(filename)
+    for part in index['parts']:
+        part['filename'] = os.path.join(folder, part['filename'])
+    return index
+
+
+def parts_in_range(index, first_ticks=None, last_ticks=None):
+    """
+    :param first_ticks, last_ticks: unwrapped ticks range, inclusive, None for unbounded
+    :return: the parts of index having samples in the range
+    """
+    return [part for part in index['parts']
+            if (first_ticks is None or part['last_ticks'] >= first_ticks)
+            and (last_ticks is None or part['first_ticks'] <= last_ticks)]
+
+
+def select_ticks(data, first_ticks=None, last_ticks=None, start=None):
+    """
+    :param data: a recording's pandas DataFrame
+    :param first_ticks, last_ticks: unwrapped ticks range, inclusive, None for unbounded
+    :param start: unwrapped ticks of the first row, by default its ticks as they are
+    :return: the rows of data in the range
+    """
+    if (first_ticks is None and last_ticks is None) or len(data) == 0:
+        return data
+    unwrapped = TicksUnwrapper()(data['ticks'].to_numpy(dtype=np.int64))
+    if start is not None:
+        unwrapped += start - unwrapped[0]
+    keep = np.ones(len(data), dtype=bool)
+    if first_ticks is not None:
+        keep &= unwrapped >= first_ticks
+    if last_ticks is not None:
+        keep &= unwrapped <= last_ticks
+    return data[keep]
+
@@ -9,6 +9,7 @@ import threading
 import socket
 import logging
 import signal
+from time import time
 from argparse import ArgumentParser
 
 from serial.tools.list_ports import comports
@@ -55,12 +56,57 @@ RED_END = "\033[0;0m"
 
 verbose = False
 
+# Reads take up to READ_SIZE bytes, returning early after READ_TIMEOUT seconds
+# with whatever arrived. At 8-12 Mbaud that coalesces a few kilobytes per
+# read call instead of a call per byte, and bounds the added latency.
+READ_SIZE = 64 * 1024
+READ_TIMEOUT = 0.002
+# socket -> serial is only commands, coalesced up to this size per write
+WRITE_SIZE = 4096
+# the pc side may stall reading; buffer rather than block the serial reader
+SOCKET_SNDBUF = 20 * 1024 * 1024
+
+
+class RedirectorStats:
+    """
+    Counters for one direction of the Redirector
+    """
+    def __init__(self):
+        self.start = time()
+        self.bytes = 0
+        self.calls = 0
+
+    def add(self, n):
+        self.bytes += n
+        self.calls += 1
+
+    @property
+    def bytes_per_second(self):
+        dt = time() - self.start
+        return self.bytes / dt if dt > 0 else 0.0
+
+    @property
+    def average_chunk_size(self):
+        return self.bytes / self.calls if self.calls > 0 else 0.0
+
+    def __str__(self):
+        return '{} bytes, {} calls, {:.1f} bytes/call, {:.0f} bytes/sec'.format(
+            self.bytes, self.calls, self.average_chunk_size, self.bytes_per_second)
+
+
 class Redirector:
-    def __init__(self, serial, s):
+    def __init__(self, serial, s, read_size=READ_SIZE, write_size=WRITE_SIZE):
         self.serial = serial
         self.socket = s
         self.alive = False
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 20 * 1024 * 1024)
+        self.read_size = read_size
+        self.write_size = write_size
+        # serial -> socket, socket -> serial
+        self.read_stats = RedirectorStats()
+        self.write_stats = RedirectorStats()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SNDBUF)
+        # acks and samples are small messages, don't let Nagle hold them back
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     def shortcut(self):
         """connect the serial port to the tcp port by copying everything
@@ -72,17 +118,14 @@ class Redirector:
 
     def reader(self):
         """loop forever and copy serial->socket"""
+        read_stats = self.read_stats
         while self.alive:
             try:
-                #read one, blocking
-                data = self.serial.read(1)
-                #look if there is more
-                n = self.serial.inWaiting()
-                if n:
-                    #and get as much as possible
-                    data = data + self.serial.read(n)
+                # returns after read_size bytes or the serial timeout (READ_TIMEOUT)
+                data = self.serial.read(self.read_size)
                 if data:
                     #if b'EM\x03' in data: print("probably an ACK")
+                    read_stats.add(len(data))
                     #send it over TCP
                     self.socket.sendall(data)
             except socket.error as msg:
@@ -93,12 +136,15 @@ class Redirector:
 
     def writer(self):
         """loop forever and copy socket->serial"""
+        write_stats = self.write_stats
         while self.alive:
             try:
-                data = self.socket.recv(1)
+                # everything the client sent so far, up to write_size
+                data = self.socket.recv(self.write_size)
                 if not data:
                     break
-                self.serial.write(data)  # get a bunch of bytes and send them
+                write_stats.add(len(data))
+                self.serial.write(data)
             except socket.error as msg:
                 log.error(repr(msg))
                 break
@@ -108,6 +154,8 @@ class Redirector:
 
         self.alive = False
         self.thread_read.join()
+        log.info('serial -> tcp: {}'.format(self.read_stats))
+        log.info('tcp -> serial: {}'.format(self.write_stats))
 
     def stop(self):
         """Stop copying"""
@@ -131,8 +179,8 @@ def start(serial_port, baudrate, rtscts, port):
             baudrate=baudrate,
             rtscts=rtscts,
             xonxoff=False,
-            #required so that the reader thread can exit
-            timeout=1
+            #short, for bulk reads; also lets the reader thread exit
+            timeout=READ_TIMEOUT
             )
     except serial.SerialException as e:
         log.fatal("Could not open serial port %s: %s" % (serial_port, e))
@@ -200,6 +248,12 @@ if __name__ == '__main__':
         '--access-list', dest='acl', type=str, default="127.0.0.1",
         help="List of IP addresses e.g '127.0.0.1, 192.168.0.2'")
 
+    parser.add_argument("-v", "--verbose", dest="verbose",
+                      help="log connection info and throughput counters on disconnect", action='store_true', default=False)
+
     options = parser.parse_args()
+    if options.verbose:
+        log.setLevel(logging.INFO)
+        ch.setLevel(logging.INFO)
     start(options.serial, options.baudrate, options.rtscts, options.port)
 
@@ -0,0 +1,138 @@
+"""
+In process serial transport.
+
+Reads the serial port from a thread straight into an asyncio Protocol, instead
+of relaying it through the serial2tcp subprocess and a localhost socket.
+Works with any pyserial URL, including pty devices and loop://.
+"""
+
+import asyncio
+from logging import getLogger
+from threading import Thread, current_thread
+
+import serial
+
+
+logger = getLogger('emolog')
+
+
+# seconds; bounds how long the reader thread takes to notice close() when the
+# port cannot cancel a pending read
+SERIAL_READ_TIMEOUT = 0.5
+
+
+class SerialThreadTransport(asyncio.Transport):
+    """
+    asyncio Transport over a pyserial Serial instance. A reader thread passes
+    everything received to protocol.data_received on the loop thread; writes
+    go directly to the port.
+
+    lost is a Future set once the reader stopped, with the exception that
+    stopped it or None after close().
+    """
+
+    def __init__(self, loop, protocol, serial_instance):
+        super().__init__()
+        self._loop = loop
+        self._protocol = protocol
+        self.serial = serial_instance
+        self._closing = False
+        self.lost = loop.create_future()
+        self._thread = Thread(target=self._reader, daemon=True, name='emolog-serial-reader')
+        loop.call_soon(protocol.connection_made, self)
+        loop.call_soon(self._thread.start)
+
+    def _reader(self):
+        exc = None
+        ser = self.serial
+        while not self._closing:
+            try:
+                # block for the first byte, then take everything already waiting
+                data = ser.read(max(1, ser.in_waiting))
+            except (serial.SerialException, OSError, TypeError) as e:
+                # TypeError: pyserial reading a port closed under it
+                if not self._closing:
+                    exc = e
+                break
+            if data:
+                self._call_soon_threadsafe(self._protocol.data_received, data)
+        self._call_soon_threadsafe(self._connection_lost, exc)
+
+    def _call_soon_threadsafe(self, callback, *args):
+        try:
+            self._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # loop already closed, nothing left to deliver to
+            pass
+
+    def _connection_lost(self, exc):
+        if self.lost.done():
+            return
+        if exc is not None:
+            logger.error('serial connection lost: {}'.format(exc))
+        self.lost.set_result(exc)
+        self._protocol.connection_lost(exc)
+
+    def write(self, data):
+        if self._closing:
+            return
+        try:
+            self.serial.write(data)
+        except (serial.SerialException, OSError) as e:
+            logger.error('serial write failed: {}'.format(e))
+            self._closing = True
+            self._loop.call_soon(self._connection_lost, e)
+
+    def can_write_eof(self):
+        return False
+
+    def is_closing(self):
+        return self._closing
+
+    def get_extra_info(self, name, default=None):
+        if name == 'serial':
+            return self.serial
+        return default
+
+    def get_protocol(self):
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def close(self):
+        if self._closing and not self._thread.is_alive():
+            return
+        self._closing = True
+        if hasattr(self.serial, 'cancel_read'):
+            self.serial.cancel_read()
+        if self._thread.is_alive() and self._thread is not current_thread():
+            self._thread.join(timeout=2 * SERIAL_READ_TIMEOUT)
+        self.serial.close()
+
+    def abort(self):
+        self.close()
+
+
+def open_serial(url, baudrate, rtscts=False):
+    ser = serial.serial_for_url(
+        url,
+        baudrate=baudrate,
+        rtscts=rtscts,
+        xonxoff=False,
+        timeout=SERIAL_READ_TIMEOUT)
+    ser.reset_input_buffer()
+    ser.reset_output_buffer()
+    return ser
+
+
+async def create_serial_connection(loop, protocol_factory, url, baudrate, rtscts=False):
+    """
+    Counterpart of loop.create_connection for a serial port.
+    :return: (transport, protocol)
+    """
+    protocol = protocol_factory()
+    transport = SerialThreadTransport(loop, protocol, open_serial(url, baudrate=baudrate, rtscts=rtscts))
+    # let connection_made run before returning, as create_connection does
+    await asyncio.sleep(0)
+    return transport, protocol
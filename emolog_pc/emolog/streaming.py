@@ -0,0 +1,378 @@
+"""
+Live samples over TCP, emotool --listen.
+
+A subscriber gets a schema frame when it connects, and again whenever the
+sampled variables change, then a batch frame per batch of samples received
+from the target. Frames (little endian):
+
+    uint32 length of the rest of the frame
+    uint8 kind
+    FRAME_SCHEMA  utf-8 JSON {"columns": [...]}, entries as in the emolog-bin
+                  schema (see recording.py)
+    FRAME_BATCH   uint32 rows
+                  uint32 decimation, the batch holds every decimation'th row
+                  uint32 rows dropped for this subscriber since the previous batch
+                  per column, in schema order: rows * itemsize bytes
+
+Subscribers may send a single frame, in the same framing:
+
+    FRAME_SUBSCRIBE  utf-8 JSON {"points_per_second": <number, 0 for every sample>,
+                                 "decimation": "minmax" or "stride"}
+
+to be sent their own rate instead of the server's default, see decimation.py.
+Subscribers of the same rate share its decimation.
+
+Columns are sequence (u1), ticks (<u4), timestamp (<f8) and every numeric
+variable as <f8, NaN in rows where it was not sampled. Enums keep their
+integer value and the "names" mapping. Variables decoded to strings are not
+streamed.
+
+Every subscriber has its own backpressure, so a slow one never stalls the
+receive path or the others. Once its transport buffers more than high_water
+bytes the overflow policy applies until it drains:
+
+    drop     - batches are not sent, the next one sent counts the rows dropped
+    decimate - batches are sent decimated, the factor doubling with every
+               batch up to MAX_DECIMATION, then dropped. The factor halves
+               with every batch once drained.
+
+SampleStreamClient reads the stream from python.
+"""
+
+import json
+import socket
+from asyncio import Protocol
+from collections import namedtuple
+from logging import getLogger
+from struct import pack, unpack, calcsize
+
+import numpy as np
+
+from .decimation import Decimator, DECIMATION_MINMAX
+from .recording import STR_DTYPE, column_schema
+
+
+logger = getLogger('emolog')
+
+
+FRAME_HEADER_FORMAT = '<IB'
+BATCH_HEADER_FORMAT = '<III'
+
+FRAME_SCHEMA = 1
+FRAME_BATCH = 2
+FRAME_SUBSCRIBE = 3
+
+# longest FRAME_SUBSCRIBE accepted
+MAX_REQUEST_LENGTH = 4096
+
+OVERFLOW_DROP = 'drop'
+OVERFLOW_DECIMATE = 'decimate'
+OVERFLOW_POLICIES = [OVERFLOW_DROP, OVERFLOW_DECIMATE]
+
+DEFAULT_HIGH_WATER = 1 << 20
+
+MAX_DECIMATION = 64
+
+STREAM_DTYPE = '<f8'
+
+_FIXED_COLUMNS = [dict(name='sequence', dtype='u1'),
+                  dict(name='ticks', dtype='<u4'),
+                  dict(name='timestamp', dtype='<f8')]
+
+
+def encode_frame(kind, payload):
+    return pack(FRAME_HEADER_FORMAT, len(payload) + 1, kind) + payload
+
+
+def stream_schema(names, types):
+    """
+    :return: (schema columns, index in names of each streamed variable)
+    """
+    columns = list(_FIXED_COLUMNS)
+    indices = []
+    for i, (name, t) in enumerate(zip(names, types)):
+        column = column_schema(name, t)
+        if column['dtype'] == STR_DTYPE:
+            continue
+        column['dtype'] = STREAM_DTYPE
+        columns.append(column)
+        indices.append(i)
+    return columns, indices
+
+
+def encode_schema(columns):
+    return encode_frame(FRAME_SCHEMA, json.dumps(dict(columns=columns)).encode('utf-8'))
+
+
+def stream_arrays(seq, ticks, timestamp, values, indices):
+    """
+    :param values: as given to CSVHandler listeners, arrays or lists with None
+    :return: one array per schema column
+    """
+    arrays = [np.asarray(seq, dtype='u1'), np.asarray(ticks, dtype='<u4'), np.asarray(timestamp, dtype='<f8')]
+    for i in indices:
+        column = values[i]
+        if not isinstance(column, np.ndarray):
+            column = [np.nan if v is None else v for v in column]
+        arrays.append(np.asarray(column, dtype=STREAM_DTYPE))
+    return arrays
+
+
+def encode_batch(arrays, decimation=1, start=0, dropped=0):
+    """
+    :param arrays: one array per schema column, see stream_arrays
+    :param start: first row to send when decimating
+    """
+    if decimation != 1 or start != 0:
+        arrays = [a[start::decimation] for a in arrays]
+    rows = len(arrays[0])
+    parts = [pack(BATCH_HEADER_FORMAT, rows, decimation, dropped)]
+    parts.extend(a.tobytes() for a in arrays)
+    return encode_frame(FRAME_BATCH, b''.join(parts))
+
+
+class SampleStreamServer:
+    """
+    Register listener with the CSVHandler (EmoToolClient.register_listener)
+    and serve protocol_factory (loop.create_server).
+    :param points_per_second: default rate to decimate to, 0 for every sample
+    :param ticks_per_second: of the target, needed for decimation
+    """
+
+    def __init__(self, overflow=OVERFLOW_DROP, high_water=DEFAULT_HIGH_WATER, points_per_second=0,
+                 decimation=DECIMATION_MINMAX, ticks_per_second=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow policy must be one of {}, got {!r}'.format(OVERFLOW_POLICIES, overflow))
+        self.overflow = overflow
+        self.high_water = high_water
+        self.ticks_per_second = ticks_per_second
+        # raise now for bad defaults rather than on the first connection
+        self.default_rate = self.rate(points_per_second, decimation)
+        # rate -> Decimator, shared by the subscribers of that rate
+        self.decimators = {}
+        self.subscribers = set()
+        self.schema_frame = None
+        self._schema_key = None
+        self._indices = None
+
+    def protocol_factory(self):
+        return StreamSubscriber(self)
+
+    def rate(self, points_per_second, decimation):
+        """
+        :return: (decimation, points_per_second) for a subscriber, None for every sample
+        :raises ValueError: for a rate that cannot be decimated to
+        """
+        if not points_per_second:
+            return None
+        if self.ticks_per_second is None:
+            raise ValueError('decimation needs the ticks per second of the target')
+        Decimator(decimation, points_per_second, self.ticks_per_second)
+        return decimation, points_per_second
+
+    def listener(self, names, types, seq, ticks, timestamp, values):
+        if len(self.subscribers) == 0 or len(seq) == 0:
+            return
+        key = (tuple(names), tuple(map(id, types)))
+        if key != self._schema_key:
+            columns, self._indices = stream_schema(names, types)
+            self._schema_key = key
+            self.schema_frame = encode_schema(columns)
+            self.decimators.clear()
+            for subscriber in self.subscribers:
+                subscriber.send_schema()
+        arrays = stream_arrays(seq, ticks, timestamp, values, self._indices)
+        # rate -> (decimated arrays, encoded frames), subscribers keeping up share the encoding
+        by_rate = {None: (arrays, {})}
+        for subscriber in list(self.subscribers):
+            rate = subscriber.rate
+            if rate not in by_rate:
+                decimator = self.decimators.get(rate)
+                if decimator is None:
+                    decimator = self.decimators[rate] = Decimator(rate[0], rate[1], self.ticks_per_second)
+                by_rate[rate] = (decimator(arrays), {})
+            subscriber.send_batch(*by_rate[rate])
+        # a rate nobody asked for in this batch would resume with stale buckets
+        for rate in list(self.decimators):
+            if rate not in by_rate:
+                del self.decimators[rate]
+
+
+class StreamSubscriber(Protocol):
+    """
+    One connected client of a SampleStreamServer
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.paused = False
+        self.rate = server.default_rate
+        self.received = bytearray()
+        self.decimation = 1
+        # rows to skip at the start of the next batch, keeping decimated rows evenly spaced
+        self.phase = 0
+        self.dropped = 0
+        self.rows_sent = 0
+        self.rows_dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.server.high_water)
+        self.server.subscribers.add(self)
+        if self.server.schema_frame is not None:
+            self.send_schema()
+
+    def connection_lost(self, exc):
+        self.server.subscribers.discard(self)
+        logger.debug('stream subscriber left: {} rows sent, {} dropped'.format(self.rows_sent, self.rows_dropped))
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+
+    def data_received(self, data):
+        self.received.extend(data)
+        header_size = calcsize(FRAME_HEADER_FORMAT)
+        while len(self.received) >= header_size:
+            length, kind = unpack(FRAME_HEADER_FORMAT, self.received[:header_size])
+            if length > MAX_REQUEST_LENGTH:
+                logger.warning('stream subscriber sent a {} bytes frame, disconnecting'.format(length))
+                self.transport.close()
+                return
+            if len(self.received) < header_size - 1 + length:
+                return
+            payload = bytes(self.received[header_size:header_size - 1 + length])
+            del self.received[:header_size - 1 + length]
+            if kind == FRAME_SUBSCRIBE:
+                self.subscribe(payload)
+            else:
+                logger.warning('ignoring stream subscriber frame of unknown kind {}'.format(kind))
+
+    def subscribe(self, payload):
+        try:
+            request = json.loads(payload.decode('utf-8'))
+            self.rate = self.server.rate(request.get('points_per_second', 0),
+                                         request.get('decimation', DECIMATION_MINMAX))
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.warning('ignoring bad stream subscribe request: {}'.format(e))
+
+    def send_schema(self):
+        self.transport.write(self.server.schema_frame)
+
+    def send_batch(self, arrays, frames):
+        """
+        :param frames: encoded frames shared between the subscribers of this batch and rate
+        """
+        rows = len(arrays[0])
+        if self.server.overflow == OVERFLOW_DECIMATE:
+            if self.paused:
+                self.decimation = min(self.decimation * 2, MAX_DECIMATION)
+            elif self.decimation > 1:
+                self.decimation //= 2
+        if self.paused and (self.server.overflow == OVERFLOW_DROP or self.decimation == MAX_DECIMATION):
+            self.dropped += rows
+            self.rows_dropped += rows
+            self.phase = 0
+            return
+        start = self.phase % self.decimation
+        self.phase = (start - rows) % self.decimation
+        sent = len(range(start, rows, self.decimation))
+        if sent == 0:
+            return
+        key = (self.decimation, start, self.dropped)
+        frame = frames.get(key)
+        if frame is None:
+            frame = frames[key] = encode_batch(arrays, *key)
+        self.transport.write(frame)
+        self.rows_sent += sent
+        self.dropped = 0
+
+
+StreamBatch = namedtuple('StreamBatch', 'columns decimation dropped')
+
+
+class SampleStreamClient:
+    """
+    Blocking reader of an emotool --listen stream:
+
+        with SampleStreamClient(port=port) as client:
+            for batch in client:
+                plot(batch.columns['ticks'], batch.columns['motor.speed'])
+
+    Iterating yields a StreamBatch per batch frame, columns being a dict of
+    column name to array; schema holds the columns of the latest schema frame.
+    """
+
+    def __init__(self, host='localhost', port=None, timeout=None, points_per_second=None,
+                 decimation=DECIMATION_MINMAX):
+        """
+        :param points_per_second: None for the server's default rate, 0 for every sample
+        """
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.schema = None
+        if points_per_second is not None:
+            request = dict(points_per_second=points_per_second, decimation=decimation)
+            self.socket.sendall(encode_frame(FRAME_SUBSCRIBE, json.dumps(request).encode('utf-8')))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.socket.close()
+
+    def _read_exactly(self, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        i = 0
+        while i < n:
+            received = self.socket.recv_into(view[i:])
+            if received == 0:
+                return None
+            i += received
+        return buf
+
+    def read_frame(self):
+        """
+        :return: (kind, payload), None when the stream ended
+        """
+        header = self._read_exactly(calcsize(FRAME_HEADER_FORMAT))
+        if header is None:
+            return None
+        length, kind = unpack(FRAME_HEADER_FORMAT, header)
+        payload = self._read_exactly(length - 1)
+        if payload is None:
+            return None
+        return kind, payload
+
+    def __iter__(self):
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            kind, payload = frame
+            if kind == FRAME_SCHEMA:
+                self.schema = json.loads(payload.decode('utf-8'))['columns']
+            elif kind == FRAME_BATCH:
+                yield decode_batch(self.schema, payload)
+            else:
+                logger.warning('ignoring stream frame of unknown kind {}'.format(kind))
+
+
+def decode_batch(schema, payload):
+    """
+    :return: StreamBatch of the FRAME_BATCH payload
+    """
+    rows, decimation, dropped = unpack(BATCH_HEADER_FORMAT, payload[:calcsize(BATCH_HEADER_FORMAT)])
+    i = calcsize(BATCH_HEADER_FORMAT)
+    columns = {}
+    for column in schema:
+        values = np.frombuffer(payload, dtype=column['dtype'], count=rows, offset=i)
+        columns[column['name']] = values
+        i += values.nbytes
+    return StreamBatch(columns=columns, decimation=decimation, dropped=dropped)
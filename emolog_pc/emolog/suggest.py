@@ -0,0 +1,128 @@
+"""
+"Did you mean" suggestions for variable names missing from the ELF.
+
+Names are compared case insensitively, component by component of their
+dotted struct path: 'motr.stte' is two edits from 'motor.state', and only
+names with the same number of components are compared this way. A name with
+a different number of components is matched by its last one, at one edit
+more: 'state' suggests 'motor.state'.
+
+Components close to a given one are found through a deletion index
+(SymSpell): every component of the ELF is stored under each string made by
+deleting up to max_distance of its characters. Two strings within
+max_distance edits share such a deletion, so a lookup only checks the
+components stored under the deletions of the given one.
+"""
+
+from itertools import combinations
+
+
+DEFAULT_MAX_DISTANCE = 2
+
+DEFAULT_MAX_SUGGESTIONS = 10
+
+# marks a trie node that ends a name, mapping to the lower case name
+_END = None
+
+
+def edit_distance(a, b):
+    """
+    Optimal string alignment distance: insertions, deletions, substitutions
+    and transpositions of adjacent characters
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        prev2, prev = prev, cur
+    return prev[len(b)]
+
+
+def deletions(word, max_distance):
+    """
+    :return: the strings made by deleting up to max_distance characters of word, word included
+    """
+    ret = {word}
+    for n in range(1, min(max_distance, len(word)) + 1):
+        for indices in combinations(range(len(word)), n):
+            ret.add(''.join(c for i, c in enumerate(word) if i not in indices))
+    return ret
+
+
+class SuggestionIndex:
+    """
+    Built once from all the names of an ELF, answers suggest() for any
+    number of missing names. Picklable, elfcache stores it with the
+    variables table.
+    """
+
+    def __init__(self, names, max_distance=DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.lower_to_actual = {}
+        # component -> trie node, a node being a dict of the same with _END for a complete name
+        self.trie = {}
+        # deletion -> components
+        self.deletions = {}
+        # last component -> lower case names ending with it
+        self.by_last_component = {}
+        components = set()
+        for name in names:
+            lower = name.lower()
+            self.lower_to_actual.setdefault(lower, name)
+            parts = lower.split('.')
+            node = self.trie
+            for part in parts:
+                node = node.setdefault(part, {})
+            node[_END] = lower
+            components.update(parts)
+            self.by_last_component.setdefault(parts[-1], []).append(lower)
+        for component in components:
+            for deletion in deletions(component, max_distance):
+                self.deletions.setdefault(deletion, []).append(component)
+
+    def close_components(self, component, max_distance):
+        """
+        :return: dict of the components within max_distance edits of component to their distance
+        """
+        ret = {}
+        for deletion in deletions(component, max_distance):
+            for candidate in self.deletions.get(deletion, []):
+                if candidate in ret or abs(len(candidate) - len(component)) > max_distance:
+                    continue
+                distance = edit_distance(component, candidate)
+                if distance <= max_distance:
+                    ret[candidate] = distance
+        return ret
+
+    def _walk(self, node, candidates, i, distance):
+        if i == len(candidates):
+            if _END in node:
+                yield node[_END], distance
+            return
+        for component, component_distance in candidates[i].items():
+            child = node.get(component)
+            if child is not None and distance + component_distance <= self.max_distance:
+                yield from self._walk(child, candidates, i + 1, distance + component_distance)
+
+    def suggest(self, name, limit=DEFAULT_MAX_SUGGESTIONS):
+        """
+        :return: up to limit names of the ELF close to name, closest first
+        """
+        parts = name.lower().split('.')
+        candidates = [self.close_components(part, self.max_distance) for part in parts]
+        found = {}
+        for lower, distance in self._walk(self.trie, candidates, 0, 0):
+            found[lower] = distance
+        for component, distance in self.close_components(parts[-1], self.max_distance - 1).items():
+            for lower in self.by_last_component.get(component, []):
+                if lower.count('.') + 1 != len(parts) and lower not in found:
+                    found[lower] = distance + 1
+        ranked = sorted(found.items(), key=lambda item: (item[1], abs(len(item[0]) - len(name)), item[0]))
+        return [self.lower_to_actual[lower] for lower, distance in ranked[:limit]]
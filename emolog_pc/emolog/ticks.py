@@ -0,0 +1,38 @@
+"""
+Target ticks are uint32 and wrap after a few days at usual tick rates. Where
+they are compared or plotted across a whole capture they are unwrapped: a
+backward jump of more than half the range is taken as a wrap, and the ticks
+keep counting past 2**32 as int64.
+"""
+
+import numpy as np
+
+
+TICKS_WRAP = 1 << 32
+
+
+class TicksUnwrapper:
+    """
+    Unwraps ticks given batch after batch, continuing from the previous batch
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.last_ticks = None
+        self.wraps = 0
+
+    def __call__(self, ticks):
+        """
+        :param ticks: non empty sequence of ticks as received
+        :return: int64 array of the unwrapped ticks
+        """
+        ticks = np.asarray(ticks, dtype=np.int64)
+        previous = np.empty_like(ticks)
+        previous[0] = self.last_ticks if self.last_ticks is not None else ticks[0]
+        previous[1:] = ticks[:-1]
+        wraps = self.wraps + np.cumsum(ticks - previous < -(TICKS_WRAP // 2))
+        self.wraps = int(wraps[-1])
+        self.last_ticks = int(ticks[-1])
+        return ticks + wraps * TICKS_WRAP
@@ -1,5 +1,6 @@
 from subprocess import Popen
 import os
+import sys
 from importlib import import_module
 from psutil import Process, NoSuchProcess, wait_procs, TimeoutExpired
 
@@ -33,6 +34,13 @@ def resolve(module_attr):
         return None
 
 
+def get_python_executable():
+    """
+    The python running us, to run emolog again in a subprocess
+    """
+    return sys.executable
+
+
 def create_process(cmdline):
     print("starting subprocess: {}".format(cmdline))
     process = Popen(cmdline)
@@ -106,7 +106,10 @@ setup(
         'colorama>=0.3.7',
         'pyinstaller>=5.11.0'
     ] + cython_install_requires,
-    packages=['emolog', 'emolog.dwarf', 'emolog.emotool'],
+    extras_require={
+        'gui': ['matplotlib'],
+    },
+    packages=['emolog', 'emolog.bench', 'emolog.dwarf', 'emolog.emotool'],
     ext_modules = cythonize(cython_extensions, gdb_debug=gdb_debug),
     data_files=[
         (join('etc', 'emolog'), ['config/local_machine_config.ini.example']),
@@ -119,6 +122,8 @@ setup(
             'emotool-vars = emolog.varsfile:main',
             'emotool-dwarf = emolog.dwarfutil:main',
             'emotool-dwarf-dump = emolog.dwarfutil:main_dump',
+            'emotool-bench = emolog.bench.main:main',
+            'emotool-bench-dwarf = emolog.bench.dwarf:main',
         ]
     },
     classifiers = ['Development Status :: 3 - Alpha',
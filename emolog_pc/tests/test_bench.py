@@ -0,0 +1,74 @@
+import json
+from pathlib import Path
+from shutil import which
+
+import pytest
+
+from emolog.bench import main as bench
+from emolog.bench import streams
+from emolog.bench import dwarf as bench_dwarf
+from emolog.elfcache import CachedVariable, parse_elf_variables, compilation_unit_groups
+
+
+example_out = Path(__file__).parent / 'example.out'
+
+
+@pytest.mark.parametrize('noise', [0.0, 0.2])
+@pytest.mark.parametrize('scenario', streams.SCENARIOS)
+def test_all_stages_see_all_samples(scenario, noise):
+    variables = streams.make_variables(scenario, 6)
+    _stream, samples = streams.synthesize_stream(variables, 100, noise=noise)
+    results = bench.run_benchmarks(stage_names=bench.STAGES, scenarios=[scenario], var_counts=[6],
+                                   chunk_sizes=[7, 4096], ticks=100, repeat=1, noise=noise)
+    assert len(results) == 2 * len(bench.STAGES)
+    for r in results:
+        assert r['samples'] == samples, r['stage']
+        assert r['samples_per_sec'] > 0 and r['mb_per_sec'] > 0
+
+
+def test_parser_microbenchmark():
+    results = bench.run_benchmarks(stage_names=['parser-legacy', 'parser', 'parser-batch'], scenarios=['uniform'],
+                                   var_counts=[4], chunk_sizes=[4096], ticks=5000, repeat=3, noise=0.1)
+    seconds = {r['stage']: r['seconds'] for r in results}
+    assert all(r['samples'] == 5000 for r in results)
+    # decode_messages runs the whole chunk in C, several times faster in practice
+    assert seconds['parser-batch'] < seconds['parser'] < seconds['parser-legacy']
+
+
+def test_json_output(tmp_path):
+    out = tmp_path / 'results.json'
+    bench.main(['--stages', 'parser,end-to-end', '--scenarios', 'uniform', '--vars', '2', '--ticks', '50',
+                '--repeat', '1', '--json', str(out)])
+    report = json.loads(out.read_text())
+    assert [r['stage'] for r in report['results']] == ['parser', 'end-to-end']
+    assert report['results'][0]['samples'] == 50
+
+
+def _table(filename, parser_factory):
+    parser = parser_factory(filename)
+    return [CachedVariable.from_var_descriptor(v).to_tuple() for v in parser.visit_interesting_vars_tree_leafs()]
+
+
+@pytest.mark.skipif(which('gcc') is None, reason='needs gcc')
+def test_dwarf_type_facts_match_legacy(tmp_path):
+    synthetic = bench_dwarf.synthesize_elf(str(tmp_path), 30)
+    for elf in [str(example_out), synthetic]:
+        table = _table(elf, bench_dwarf.FileParser)
+        assert len(table) > 0
+        assert table == _table(elf, bench_dwarf.LegacyFileParser)
+    assert len(_table(synthetic, bench_dwarf.FileParser)) == 30 * 12
+    results = bench_dwarf.run_benchmarks(stage_names=bench_dwarf.STAGES, elfs=[str(example_out)], synthetic_vars=[],
+                                         names=['var_int'], repeat=1)
+    assert [r['variables'] for r in results] == [11, 11, 1, 11]
+
+
+@pytest.mark.skipif(which('gcc') is None, reason='needs gcc')
+def test_dwarf_parallel_matches_serial(tmp_path):
+    synthetic = bench_dwarf.synthesize_elf(str(tmp_path), 40, num_cus=5)
+    assert len(compilation_unit_groups(synthetic, 3)) == 3
+    serial = [v.to_tuple() for v in parse_elf_variables(synthetic)]
+    assert len(serial) == 40 * 12
+    assert [v.to_tuple() for v in parse_elf_variables(synthetic, jobs=3)] == serial
+    results = bench_dwarf.run_benchmarks(stage_names=['dwarf-jobs'], elfs=[synthetic], synthetic_vars=[],
+                                         names=None, repeat=1, jobs=[1, 2])
+    assert [(r['jobs'], r['variables']) for r in results] == [(1, 40 * 12), (2, 40 * 12)]
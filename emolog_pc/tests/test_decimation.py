@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from emolog.decimation import Decimator, DECIMATION_MINMAX, DECIMATION_STRIDE
+
+
+def columns(ticks, *values):
+    ticks = np.asarray(ticks, dtype=np.uint32)
+    return [(ticks % 256).astype(np.uint8), ticks, ticks / 1000.] + [np.asarray(v, dtype=np.float64) for v in values]
+
+
+def test_stride_across_batches():
+    # 1000 ticks per second to 100 points per second: a row every 10 ticks
+    decimator = Decimator(DECIMATION_STRIDE, 100, 1000)
+    first = decimator(columns(range(0, 25), range(0, 25)))
+    assert first[1].tolist() == [0, 10, 20]
+    second = decimator(columns(range(25, 40), range(25, 40)))
+    assert second[1].tolist() == [30]
+    assert second[3].tolist() == [30.]
+
+
+def test_minmax_keeps_peaks():
+    # buckets of 20 ticks, two rows each
+    decimator = Decimator(DECIMATION_MINMAX, 100, 1000)
+    values = np.zeros(50)
+    values[13] = 5.
+    values[27] = -3.
+    missing = np.full(50, np.nan)
+    missing[::7] = np.arange(8)
+    out = decimator(columns(range(50), values, missing))
+    # the last bucket, ticks 40.., waits for the next batch
+    assert out[1].tolist() == [0, 19, 20, 39]
+    assert out[3].tolist() == [0., 5., -3., 0.]
+    assert out[4].tolist() == [0., 2., 3., 5.]
+    out = decimator(columns(range(50, 70), np.ones(20), np.full(20, np.nan)))
+    assert out[1].tolist() == [40, 59]
+    assert out[3].tolist() == [0., 1.]
+    assert out[4].tolist() == [6., 7.]
+    assert [len(c) for c in decimator(columns([]))] == [0, 0, 0]
+
+
+def test_bad_rates():
+    with pytest.raises(ValueError):
+        Decimator(DECIMATION_MINMAX, 0, 1000)
+    with pytest.raises(ValueError):
+        Decimator('average', 100, 1000)
@@ -16,6 +16,8 @@ from emolog.emotool.main import (read_elf_variables, EmoToolClient, main)
 from emolog.decoders import ArrayDecoder, Decoder
 from emolog.cylib import SamplerSample, emo_decode
 from emolog.fakeembedded import FakeSineEmbedded
+from emolog.dwarfutil import read_all_elf_variables
+from emolog import elfcache
 
 
 module_path = path.dirname(__file__)
@@ -177,6 +179,34 @@ def test_read_elf_variables():
     breakpoint()
 
 
+def test_elf_variables_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv(elfcache.CACHE_DIR_ENV, str(tmp_path / 'cache'))
+
+    def comparable(variables):
+        return [(v['name'], v['address'], v['size'], v['init_value'], type(v['_type']), v['_type'].name,
+                 v['_type'].unpack_str) for v in variables]
+
+    parsed_names, parsed = read_all_elf_variables(str(example_out), cache=False)
+    # only the names asked for are parsed and cached at first
+    assert [v.get_full_name() for v in elfcache.read_elf_variables_table(str(example_out), names=['s.y'])] == \
+        ['s.x', 's.y', 's.z']
+    cached_names, cached = read_all_elf_variables(str(example_out), cache=True)
+    assert cached_names == parsed_names
+    assert comparable(cached) == comparable(parsed)
+    assert len(listdir(str(tmp_path / 'cache'))) == 1
+    # a second read comes from the cache file
+    from_file = elfcache.read_elf_variables_table(str(example_out))
+    assert sorted(v.get_full_name() for v in from_file) == cached_names
+    assert all(isinstance(v, elfcache.CachedVariable) for v in from_file)
+
+    # different contents, different cache entry
+    changed = tmp_path / 'changed.out'
+    changed.write_bytes(example_out.read_bytes() + b'\0')
+    changed_names, _ = read_all_elf_variables(str(changed), cache=True)
+    assert changed_names == parsed_names
+    assert len(listdir(str(tmp_path / 'cache'))) == 2
+
+
 def test_array_decoder():
     assert '{ 1, 2, 3 }' == ArrayDecoder(b'foo', b'i', 3).decode(pack('<3i', 1, 2, 3))
     assert '{ 1.000, 2.000, 3.000 }' == ArrayDecoder(b'bar', b'f', 3).decode(pack('<3f', 1.0, 2.0, 3.0))
@@ -203,3 +233,238 @@ def test_args():
 
 if __name__ == '__main__':
     test_client_and_fake_thingy()
+
+
+def test_pipelined_register_variables():
+    """
+    with a target advertising a window, registering variables takes about one
+    round trip instead of one per variable
+    """
+    delay = 0.04
+    variables = [dict(name='v{}'.format(i), phase_ticks=0, period_ticks=1, address=100 + i, size=4,
+                      _type=Decoder(b'f', b'l')) for i in range(10)]
+
+    async def register(window):
+        loop = asyncio.get_event_loop()
+
+        class SlowTarget(FakeSineEmbedded):
+            WINDOW = window
+
+            def data_received(self, data):
+                loop.call_later(delay, FakeSineEmbedded.data_received, self, data)
+
+        client_end, embedded_end = socketpair()
+        client = EmoToolClient(ticks_per_second=1000, dump=False, verbose=False, debug=False)
+        await loop.create_connection(lambda: client, sock=client_end)
+        _, target = await loop.create_connection(
+            lambda: SlowTarget(1000, build_timestamp_addr=0, build_timestamp_value=0), sock=embedded_end)
+        await client.send_version()
+        start = loop.time()
+        await client.send_set_variables(variables)
+        dt = loop.time() - start
+        client.exit_gracefully()
+        client.transport.close()
+        return client.window, dt, client._variables
+
+    loop = get_event_loop_with_exception_handler()
+    window, dt, registered = loop.run_until_complete(register(0))
+    assert window == 1
+    assert dt >= delay * (len(variables) + 1)
+    assert [v['name'] for v in registered] == [v['name'] for v in variables]
+    window, dt, registered = loop.run_until_complete(register(16))
+    assert window == 16
+    # clear, then all the variables
+    assert dt < delay * 4
+    assert [v['name'] for v in registered] == [v['name'] for v in variables]
+
+
+def test_ack_round_trips():
+    async def run():
+        loop = asyncio.get_event_loop()
+        client_end, embedded_end = socketpair()
+        client = EmoToolClient(ticks_per_second=1000, dump=False, verbose=False, debug=False)
+        await loop.create_connection(lambda: client, sock=client_end)
+        await loop.create_connection(
+            lambda: FakeSineEmbedded(1000, build_timestamp_addr=0, build_timestamp_value=0), sock=embedded_end)
+        await client.send_version()
+        count = 0
+        start = loop.time()
+        while loop.time() - start < 0.5:
+            await client.send_sampler_stop()
+            count += 1
+        rate = count / (loop.time() - start)
+        client.exit_gracefully()
+        client.transport.close()
+        return rate
+
+    loop = get_event_loop_with_exception_handler()
+    rate = loop.run_until_complete(run())
+    assert rate > 200
+
+
+def test_replay_dump(tmp_path):
+    from argparse import Namespace
+    from time import time
+    from emolog.bench import streams
+    from emolog.dump import DumpWriter, LEGACY_RECORD_HEADER_FORMAT
+    from emolog.emotool.main import replay_dump
+    variables = streams.make_variables('uniform', 3)
+    stream, num_samples = streams.synthesize_stream(variables, 300, noise=0.1)
+    chunks = streams.chunked(stream, 100)
+    dump = tmp_path / 'capture.dump'
+    writer = DumpWriter(str(dump))
+    for i, chunk in enumerate(chunks):
+        writer.write(1000.0 + 0.01 * i, chunk)
+    writer.close()
+    legacy = tmp_path / 'legacy.dump'
+    legacy.write_bytes(b''.join(pack(LEGACY_RECORD_HEADER_FORMAT, 0.0, len(c)) + c for c in chunks))
+
+    async def replay(filename, speed, out):
+        client = EmoToolClient(ticks_per_second=1000, dump=False, verbose=False, debug=False)
+        client.reset(csv_filename=str(out), names=[v['name'] for v in variables], min_ticks=1, max_samples=0)
+        start = time()
+        await replay_dump(Namespace(replay=str(filename), replay_speed=speed), client, variables)
+        client.exit_gracefully()
+        return client, time() - start
+
+    loop = get_event_loop_with_exception_handler()
+    recorded_seconds = 0.01 * (len(chunks) - 1)
+    for filename, speed in [(dump, 0), (dump, 10), (legacy, 10)]:
+        out = tmp_path / 'out.csv'
+        client, dt = loop.run_until_complete(replay(filename, speed, out))
+        assert client.samples_received == num_samples
+        with open(str(out)) as fd:
+            rows = list(csv.reader(fd))[1:]
+        assert [int(row[1]) for row in rows] == list(range(300))
+        if filename == dump:
+            # recorded timestamps, not the time of the replay
+            assert float(rows[0][2]) == 1000000.0
+            assert float(rows[-1][2]) == 1000.0 * (1000.0 + recorded_seconds)
+        if speed > 0 and filename == dump:
+            assert dt >= recorded_seconds / speed
+
+
+def test_multiple_targets(tmp_path, monkeypatch):
+    from emolog.emotool.main import parse_args, amain_targets
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'local_machine_config.ini').write_text("[folders]\noutput_folder=.\n")
+    args = parse_args(['--target', 'name=motor,fake=gen', '--target', 'name=psu,fake=gen', '--runtime', '0.05'])
+    assert [target.name for target in args.targets] == ['motor', 'psu']
+    loop = get_event_loop_with_exception_handler()
+    clients = [loop.run_until_complete(_test_client_and_sine_socket_pair(loop))[0] for target in args.targets]
+    loop.run_until_complete(amain_targets(clients, args))
+    for client in clients:
+        client.exit_gracefully()
+    assert sorted(listdir('.')) == ['emo_001_motor.csv', 'emo_001_psu.csv', 'local_machine_config.ini']
+    times = []
+    for client, name in zip(clients, ['motor', 'psu']):
+        assert client.samples_received == 1000
+        with open('emo_001_{}.csv'.format(name)) as fd:
+            rows = list(csv.reader(fd))
+        assert rows[0] == ['sequence', 'ticks', 'timestamp'] + list('abcdefgh')
+        assert len(rows) == 1001
+        times.append((float(rows[1][2]), float(rows[-1][2])))
+    # both recorded at the same time, in host time
+    (motor_start, motor_end), (psu_start, psu_end) = times
+    assert motor_start < psu_end and psu_start < motor_end
+
+
+def test_targets_share_elf(monkeypatch):
+    from emolog import dwarfutil
+    reads = []
+    read = dwarfutil.dwarf_get_variables_by_name
+
+    def counting_read(filename, names, **kw):
+        reads.append(names)
+        return read(filename, names, **kw)
+
+    monkeypatch.setattr(dwarfutil, 'dwarf_get_variables_by_name', counting_read)
+    motor, psu = dwarfutil.read_elf_variables_of_targets([
+        (str(example_out), [('var_int', 1, 0), ('var_float', 2, 0)]),
+        (path.relpath(str(example_out)), [('var_float', 4, 1), ('var_unsigned_char', 1, 0)]),
+    ], cache=False)
+    assert reads == [['var_int', 'var_float', 'var_unsigned_char']]
+    assert motor[0] == ['var_int', 'var_float'] and psu[0] == ['var_float', 'var_unsigned_char']
+    assert [(v['name'], v['period_ticks']) for v in psu[1]] == [('var_float', 4), ('var_unsigned_char', 1)]
+
+
+def start_callback_in(tmp_path, monkeypatch, cmdline):
+    """
+    Run emotool through start_callback in tmp_path
+    :return: what start_callback returns
+    """
+    from emolog.emotool.main import parse_args, start_callback
+    # the --embedded subprocesses are started by running emotool again
+    script = tmp_path / 'emotool.py'
+    script.write_text("from emolog.emotool.main import main\nmain()\n")
+    monkeypatch.setattr('sys.argv', [str(script)])
+    monkeypatch.setenv('PYTHONPATH', str(Path(__file__).parent.parent))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'local_machine_config.ini').write_text("[folders]\noutput_folder=.\n")
+    args = parse_args(cmdline)
+    loop = get_event_loop_with_exception_handler()
+    return start_callback(args, loop)
+
+
+def press_key_after(monkeypatch, polls):
+    """
+    Stop the capture as a key press would, after polls polls of the keyboard
+    """
+    remaining = [polls]
+
+    def try_getch():
+        remaining[0] -= 1
+        return b' ' if remaining[0] < 0 else None
+    monkeypatch.setattr('emolog.emotool.main.try_getch', try_getch)
+
+
+def test_multiple_fake_gen_targets(tmp_path, monkeypatch):
+    clients = start_callback_in(tmp_path, monkeypatch,
+                                ['--target', 'name=motor,fake=gen', '--target', 'name=psu,fake=gen', '--runtime', '0.2'])
+    for client, name in zip(clients, ['motor', 'psu']):
+        # stopped by cleanup
+        assert client.fake_process.poll() is not None
+        assert client.samples_received == 4000 and client.ticks_lost == 0
+        with open('emo_001_{}.csv'.format(name)) as fd:
+            rows = list(csv.reader(fd))
+        assert rows[0] == ['sequence', 'ticks', 'timestamp'] + list('abcdefgh')
+        assert len(rows) == 4001
+
+
+def test_binary_recording_stopped_early(tmp_path, monkeypatch):
+    from emolog.recording import read_recording
+    # --runtime 0 never reaches max_samples, only cleanup writes the rows the writer buffers
+    press_key_after(monkeypatch, 5)
+    client = start_callback_in(tmp_path, monkeypatch, ['--fake', 'gen', '--runtime', '0', '--format', 'emolog-bin'])
+    assert client.samples_received > 0
+    data = read_recording('emo_001.emob')
+    assert len(data) == client.samples_received
+
+
+def test_rotated_recording_stopped_early(tmp_path, monkeypatch):
+    from emolog.recording import read_recording
+    from emolog.rotation import read_index
+    press_key_after(monkeypatch, 5)
+    client = start_callback_in(tmp_path, monkeypatch, ['--fake', 'gen', '--runtime', '0', '--format', 'emolog-bin',
+                                                       '--rotate-samples', '2000'])
+    # the last part is closed and indexed by cleanup
+    index = read_index('emo_001.index.json')
+    assert len(index['parts']) > 1
+    assert sum(part['samples'] for part in index['parts']) == client.samples_received
+    assert len(read_recording('emo_001.index.json')) == client.samples_received
+
+
+def test_background_writer_stopped_early(tmp_path, monkeypatch):
+    import threading
+
+    def writer_threads():
+        return len([thread for thread in threading.enumerate() if thread.name == 'emolog-writer'])
+    before = writer_threads()
+    press_key_after(monkeypatch, 5)
+    client = start_callback_in(tmp_path, monkeypatch, ['--fake', 'gen', '--runtime', '0', '--writer-queue', '1024'])
+    assert client.writer_stats is not None
+    # cleanup writes the queued batches and joins the writer thread
+    assert writer_threads() == before
+    with open('emo_001.csv') as fd:
+        rows = list(csv.reader(fd))
+    assert len(rows) == client.samples_received + 1
@@ -43,6 +43,131 @@ def test_client_parser():
     parser = emolog.Parser(serial)
 
 
+def test_parser_split_chunks():
+    samples = [emolog.SamplerSample(seq=i, ticks=i, var_size_pairs=[(i, 4), (2 * i, 2)]) for i in range(50)]
+    stream = b''.join(s.encode() for s in samples)
+    # small buffer to force the buffer to be replaced several times
+    parser = emolog.Parser(None, buffer_size=16)
+    msgs = []
+    for chunk_size in [1, 3, 7, 64]:
+        for i in range(0, len(stream), chunk_size):
+            msgs.extend(parser.consume_and_return_messages(stream[i:i + chunk_size]))
+    assert parser.pending == 0
+    assert len(msgs) == 4 * len(samples)
+    for i, msg in enumerate(msgs):
+        ticks = i % len(samples)
+        assert isinstance(msg, emolog.SamplerSample)
+        assert msg.ticks == ticks
+        # payloads of earlier messages are not overwritten by later reads
+        assert struct.unpack('<lh', msg.payload) == (ticks, 2 * ticks)
+
+
+def test_parser_consume_into():
+    from emolog.cylib import SampleBatch
+    messages = []
+    for i in range(50):
+        messages.append(emolog.SamplerSample(seq=i, ticks=1000 + i, var_size_pairs=[(i, 4), (2 * i, 2)]))
+        if i % 7 == 0:
+            messages.append(emolog.Ping(seq=i))
+    stream = b''.join(m.encode() for m in messages)
+    parser = emolog.Parser(None, buffer_size=16)
+    batch = SampleBatch(size=1)
+    samples = []
+    others = []
+    for i in range(0, len(stream), 37):
+        others.extend(parser.consume_into(stream[i:i + 37], batch, float(i)))
+        assert list(batch.timestamp) == [float(i)] * len(batch)
+        # the batch is reused, samples() refers to the receive buffer and outlives it
+        samples.extend(batch.samples())
+    assert parser.pending == 0
+    assert [type(m) for m in others] == [emolog.Ping] * 8
+    expected = [m for m in emolog.Parser(None).consume_and_return_messages(stream)
+                if isinstance(m, emolog.SamplerSample)]
+    assert [(seq, ticks) for now, seq, ticks, payload in samples] == [(m.seq, m.ticks) for m in expected]
+    assert [ticks for now, seq, ticks, payload in samples] == [1000 + i for i in range(50)]
+    assert [struct.unpack('<lh', payload) for now, seq, ticks, payload in samples] == [(i, 2 * i) for i in range(50)]
+
+
+def test_parser_many_messages_in_a_chunk():
+    from emolog.cylib import SampleBatch
+    # more control messages than decode_messages lists in one call
+    messages = [emolog.Ping(seq=i) if i % 3 else emolog.SamplerSample(seq=i, ticks=i, var_size_pairs=[(i, 2)])
+                for i in range(1000)]
+    stream = b''.join(m.encode() for m in messages)
+    assert [type(m) for m in emolog.Parser(None).consume_and_return_messages(stream)] == [type(m) for m in messages]
+    batch = SampleBatch(size=1)
+    others = emolog.Parser(None).consume_into(stream, batch, 0.0)
+    assert len(others) == 666
+    assert list(batch.ticks) == list(range(0, 1000, 3))
+
+
+def test_parser_skips_line_noise():
+    good = [emolog.SamplerSample(seq=i, ticks=i, var_size_pairs=[(i, 4)]).encode() for i in range(40)]
+    corrupt_payload = bytearray(good[0])
+    corrupt_payload[-1] ^= 0xff
+    noise = [b'\x00\x01\x02', b'EM', b'E' * 5, bytes(corrupt_payload), b'EMxxxxxxx\xff' * 3]
+    stream = b''
+    for i, message in enumerate(good):
+        if i % 4 == 1:
+            stream += noise[(i // 4) % len(noise)]
+        stream += message
+    noise_bytes = len(stream) - sum(len(m) for m in good)
+    for chunk_size in [len(stream), 5, 64]:
+        parser = emolog.Parser(None, buffer_size=16)
+        msgs = []
+        for i in range(0, len(stream), chunk_size):
+            msgs.extend(parser.consume_and_return_messages(stream[i:i + chunk_size]))
+        assert [m.ticks for m in msgs] == list(range(40))
+        assert parser.pending == 0
+        assert parser.skip_stats['skipped_bytes'] == noise_bytes
+        assert parser.skip_stats['resyncs'] >= 10
+        if chunk_size == len(stream):
+            assert parser.skip_stats['resyncs'] == 10
+
+
+def test_parser_skips_short_sample():
+    from emolog.cylib import SampleBatch, SkipBytes, emo_decode, emo_message_types
+    # an ack re-typed as a sample: its 3 bytes payload has no room for the ticks
+    short = bytearray(emolog.Ack(seq=1, error=0, reply_to_seq=2).encode())
+    short[2] = emo_message_types.sampler_sample
+    # the header CRC covers the type, find the one matching
+    for header_crc in range(256):
+        short[7] = header_crc
+        if emo_decode(bytes(short), 0)[1] == len(short):
+            break
+    else:
+        assert False, 'no header CRC matches'
+    msg, i_next, error = emo_decode(bytes(short), 0)
+    assert isinstance(msg, SkipBytes) and msg.skip == len(short) and i_next == len(short)
+    good = emolog.SamplerSample(seq=3, ticks=7, var_size_pairs=[(5, 4)]).encode()
+    parser = emolog.Parser(None)
+    assert [m.ticks for m in parser.consume_and_return_messages(bytes(short) + good)] == [7]
+    assert parser.skip_stats == dict(skipped_bytes=len(short), resyncs=1)
+    batch = SampleBatch(size=1)
+    assert emolog.Parser(None).consume_into(bytes(short) + good, batch, 0.0) == []
+    assert list(batch.ticks) == [7]
+
+
+def test_columns_from_batch():
+    from emolog.cylib import SampleBatch
+    from emolog.decoders import Decoder
+    sampler, handler, writer = make_sampler_and_handler([('a', 4, Decoder(b'a', b'l')), ('b', 2, Decoder(b'b', b'h'))])
+    stream = b''.join(emolog.SamplerSample(seq=i, ticks=i, var_size_pairs=[(i, 4), (-i, 2)]).encode()
+                      for i in range(1, 301))
+    batch = SampleBatch()
+    assert emolog.Parser(None).consume_into(stream, batch, 5.0) == []
+    seq, ticks, timestamp, values = sampler.columns_from_batch(batch)
+    assert list(ticks) == list(range(1, 301))
+    assert [list(v) for v in values] == [list(range(1, 301)), [-i for i in range(1, 301)]]
+    handler.max_samples = 200
+    handler.handle_sample_batch(batch)
+    assert handler.samples_received == 200
+    assert not handler.running()
+    assert [row[1:] for row in writer.rows[1:3]] == [[1, 5.0, 1, -1], [2, 5.0, 2, -2]]
+    assert [row[0] for row in writer.rows[1:]] == list(seq[:200])
+    assert len(writer.rows) == 201
+
+
 def test_client_with_c_thing():
     # TODO
     pass
@@ -64,3 +189,413 @@ def failed_blasted_data_not_reaching_subprocess_test_client_and_fake_thingy_qt_p
     with eventloop:
         eventloop.run_until_complete(main())
 
+
+
+class ListWriter:
+    def __init__(self, filename, fields, **kw):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(list(row))
+
+    def close(self):
+        pass
+
+
+def make_sampler_and_handler(types, period_and_phase=None, min_ticks=1):
+    from emolog.cylib import VariableSampler, CSVHandler
+    if period_and_phase is None:
+        period_and_phase = [(1, 0)] * len(types)
+    sampler = VariableSampler()
+    sampler.register_variables([dict(name=name, phase_ticks=phase, period_ticks=period, address=0, size=size, _type=t)
+                                for (name, size, t), (period, phase) in zip(types, period_and_phase)])
+    writers = []
+    def factory(*args, **kw):
+        writers.append(ListWriter(*args, **kw))
+        return writers[-1]
+    handler = CSVHandler(sampler=sampler, verbose=False, dump=False, csv_writer_factory=factory)
+    handler.reset(csv_filename='unused', names=[name for name, size, t in types], min_ticks=min_ticks, max_samples=0)
+    return sampler, handler, writers[0]
+
+
+def test_columns_from_samples():
+    from emolog.decoders import Decoder, NamedDecoder
+    types = [('a', 4, Decoder(b'a', b'f')),
+             ('b', 2, Decoder(b'b', b'h')),
+             ('c', 1, NamedDecoder(b'c', max_unsigned_val=256, unpack_str=b'b', val_to_name={0: 'off', 1: 'on'}))]
+    sampler, handler, writer = make_sampler_and_handler(types)
+    samples = [(1000.0 + i, i % 256, 10 + i, struct.pack('<fhb', i / 2, -i, i % 2)) for i in range(300)]
+    seq, ticks, timestamp, values = sampler.columns_from_samples(samples)
+    assert list(seq) == [i % 256 for i in range(300)]
+    assert list(ticks) == [10 + i for i in range(300)]
+    assert list(timestamp) == [1000.0 + i for i in range(300)]
+    assert [list(v) for v in values] == [[i / 2 for i in range(300)], [-i for i in range(300)], [i % 2 for i in range(300)]]
+    # drop a tick to see the jump accounted for
+    del samples[100]
+    handler.handle_sampler_samples(samples)
+    assert handler.ticks_lost == 1
+    assert handler.samples_received == 299
+    assert writer.rows[0] == ['sequence', 'ticks', 'timestamp', 'a', 'b', 'c']
+    assert writer.rows[1] == [0, 10, 1000.0, 0.0, 0, 'off']
+    assert writer.rows[101] == [101, 111, 1101.0, 50.5, -101, 'on']
+
+
+def test_columns_from_samples_not_possible():
+    from emolog.decoders import Decoder
+    sampler, handler, writer = make_sampler_and_handler([('a', 4, Decoder(b'a', b'f'))])
+    # wrong payload size falls back to the per sample decoding
+    assert sampler.columns_from_samples([(0.0, 0, 0, b'\x00' * 3)]) is None
+    sampler.register_variables([dict(name='a', phase_ticks=1, period_ticks=2, address=0, size=4, _type=Decoder(b'a', b'f'))])
+    assert sampler.columns_from_samples([(0.0, 0, 1, b'\x00' * 4)]) is None
+
+
+def test_multi_rate_samples():
+    from emolog.decoders import Decoder, ArrayDecoder
+    period_and_phase = [(10, 0), (13, 3), (100, 50)]
+    plain = [('a', 4, Decoder(b'a', b'f')), ('b', 2, Decoder(b'b', b'h')), ('c', 4, Decoder(b'c', b'l'))]
+    with_array = plain[:2] + [('c', 4, ArrayDecoder(b'c', b'h', 2))]
+    for types in [plain, with_array]:
+        sampler, handler, writer = make_sampler_and_handler(types, period_and_phase)
+        is_array = isinstance(types[2][2], ArrayDecoder)
+        samples = []
+        expected = []
+        for ticks in range(1000):
+            active = [i for i, (period, phase) in enumerate(period_and_phase) if ticks % period == phase]
+            if not active:
+                continue
+            payload = b''
+            row = [ticks % 256, ticks, float(ticks), None, None, None]
+            for i in active:
+                if i == 2 and is_array:
+                    payload += struct.pack('<2h', ticks, -ticks)
+                    row[3 + i] = '{{ {}, {} }}'.format(ticks, -ticks)
+                else:
+                    payload += struct.pack('<' + types[i][2].unpack_str.decode(), ticks)
+                    row[3 + i] = ticks
+            samples.append((float(ticks), ticks % 256, ticks, payload))
+            expected.append(row)
+        handler.handle_sampler_samples(samples)
+        assert writer.rows[1:] == expected
+
+
+
+def test_multi_rate_large_coprime_periods():
+    from emolog.decoders import Decoder
+    # the least common multiple of the periods does not fit in 64 bits, wrapping to a negative long
+    periods = [1, 1000003, 1000033, 1000039, 1000081]
+    types = [(name, 2, Decoder(name.encode(), b'h')) for name in 'abcde']
+    sampler, handler, writer = make_sampler_and_handler(types, [(period, 0) for period in periods])
+    samples = [(0.0, 0, 0, struct.pack('<5h', 1, 2, 3, 4, 5)),
+               (1.0, 1, 1, struct.pack('<h', 6)),
+               (2.0, 2, 1000003, struct.pack('<2h', 7, 8))]
+    handler.handle_sampler_samples(samples)
+    assert writer.rows[1:] == [[0, 0, 0.0, 1, 2, 3, 4, 5],
+                               [1, 1, 1.0, 6, None, None, None, None],
+                               [2, 1000003, 2.0, 7, 8, None, None, None]]
+
+def test_binary_recording_round_trip(tmp_path):
+    from emolog.decoders import Decoder, NamedDecoder, ArrayDecoder
+    from emolog.recording import binary_writer_factory, read_recording
+    period_and_phase = [(1, 0), (3, 1), (5, 0), (2, 0)]
+    types = [('a', 4, Decoder(b'a', b'f')),
+             ('b', 2, Decoder(b'b', b'h')),
+             ('c', 1, NamedDecoder(b'c', max_unsigned_val=256, unpack_str=b'b', val_to_name={0: 'off', 1: 'on'})),
+             ('d', 4, ArrayDecoder(b'd', b'h', 2))]
+    for period_and_phase in [[(1, 0)] * 3, period_and_phase]:
+        sampler, handler, _ = make_sampler_and_handler(types[:len(period_and_phase)], period_and_phase)
+        filename = str(tmp_path / 'emo_001.emob')
+        handler.reset(csv_filename=filename, names=[name for name, size, t in types[:len(period_and_phase)]],
+                      min_ticks=1, max_samples=0, writer_factory=binary_writer_factory)
+        samples = []
+        expected = []
+        for ticks in range(300):
+            payload = b''
+            row = [ticks % 256, ticks, float(ticks)]
+            for i, (period, phase) in enumerate(period_and_phase):
+                if ticks % period != phase:
+                    row.append(None)
+                elif i == 3:
+                    payload += struct.pack('<2h', ticks, -ticks)
+                    row.append('{{ {}, {} }}'.format(ticks, -ticks))
+                else:
+                    payload += struct.pack('<' + types[i][2].unpack_str.decode(), ticks % 2)
+                    row.append(['off', 'on'][ticks % 2] if i == 2 else ticks % 2)
+            samples.append((float(ticks), ticks % 256, ticks, payload))
+            expected.append(row)
+        handler.handle_sampler_samples(samples)
+        handler.stop()
+        data = read_recording(filename)
+        assert list(data.columns) == ['sequence', 'ticks', 'timestamp'] + [name for name, size, t in types[:len(period_and_phase)]]
+        rows = [[None if v != v else v for v in row] for row in data.itertuples(index=False)]
+        assert rows == expected
+
+
+
+def test_map_names():
+    import numpy as np
+    from emolog.recording import map_names
+    names = {'0': 'off', '1': 'on', '255': 'fault'}
+    # -1 is 255 as unsigned, 7 has no name
+    values = np.array([0, 1, -1, 7], dtype=np.int8)
+    assert map_names(values, names, 256).tolist() == ['off', 'on', 'fault', 7]
+    masked = map_names(np.array([1., np.nan, 3.]), names, 256).tolist()
+    assert masked[0] == 'on' and masked[1] != masked[1] and masked[2] == 3.
+    assert map_names(np.array([2], dtype=np.uint8), {}, 256).tolist() == [2]
+
+class StalledWriter(ListWriter):
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        import threading
+        self.stalled = threading.Event()
+
+    def writerows(self, rows):
+        self.stalled.wait()
+        self.rows.extend(list(row) for row in rows)
+
+
+@pytest.mark.parametrize('overflow', ['block', 'drop'])
+def test_background_writer_overflow(overflow):
+    import threading
+    import time
+    from emolog.background_writer import BackgroundWriter
+    target = StalledWriter('unused', fields=None)
+    writer = BackgroundWriter(target, maxsize=2, overflow=overflow)
+    batches = [[[i, j] for j in range(3)] for i in range(10)]
+    done = threading.Event()
+    writer.writerows(batches[0])
+    while writer.queue_depth > 0:
+        time.sleep(0.001)
+
+    def produce():
+        for rows in batches[1:]:
+            writer.writerows(rows)
+        done.set()
+    producer = threading.Thread(target=produce)
+    producer.start()
+    # the writer thread holds one batch, the queue two more
+    if overflow == 'block':
+        assert not done.wait(0.2)
+        assert writer.queue_depth == 2
+    else:
+        assert done.wait(5)
+        assert writer.rows_dropped == 3 * 7
+    target.stalled.set()
+    producer.join()
+    writer.close()
+    assert writer.high_water == 2
+    expected = batches if overflow == 'block' else batches[:3]
+    assert target.rows == [row for rows in expected for row in rows]
+
+
+def test_csv_handler_background_writer():
+    from emolog.cylib import VariableSampler, CSVHandler
+    from emolog.decoders import Decoder
+    sampler = VariableSampler()
+    sampler.register_variables([dict(name='a', phase_ticks=0, period_ticks=1, address=0, size=4, _type=Decoder(b'a', b'f'))])
+    writers = []
+    def factory(*args, **kw):
+        writers.append(ListWriter(*args, **kw))
+        return writers[-1]
+    handler = CSVHandler(sampler=sampler, verbose=False, dump=False, csv_writer_factory=factory, writer_queue_size=4)
+    handler.reset(csv_filename='unused', names=['a'], min_ticks=1, max_samples=100)
+    for i in range(0, 200, 10):
+        handler.handle_sampler_samples([(float(t), t % 256, t, struct.pack('<f', t)) for t in range(i, i + 10)])
+    stats = handler.writer_stats
+    assert stats['queue_size'] == 4 and stats['rows_dropped'] == 0
+    # max_samples reached, stop() waits for the queue to be written
+    assert not handler.running()
+    assert writers[0].rows == [['sequence', 'ticks', 'timestamp', 'a']] + [[t, t, float(t), float(t)] for t in range(100)]
+
+
+@pytest.mark.skipif(not hasattr(__import__('os'), 'openpty'), reason='needs a pty pair')
+def test_serial_transport_pty():
+    import os
+    from emolog.serial_transport import create_serial_connection
+
+    class Collector(asyncio.Protocol):
+        def __init__(self):
+            self.parser = emolog.Parser(None)
+            self.messages = []
+            self.received = asyncio.Event()
+            self.lost = False
+
+        def data_received(self, data):
+            self.messages.extend(self.parser.consume_and_return_messages(data))
+            if len(self.messages) == 100:
+                self.received.set()
+
+        def connection_lost(self, exc):
+            self.lost = True
+
+    master, slave = os.openpty()
+    samples = b''.join(emolog.SamplerSample(seq=i, ticks=i, var_size_pairs=[(i, 4)]).encode() for i in range(100))
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        transport, protocol = await create_serial_connection(loop, Collector, url=os.ttyname(slave), baudrate=115200)
+        # the target writes samples, written in pieces as a serial port delivers them
+        for i in range(0, len(samples), 100):
+            os.write(master, samples[i:i + 100])
+        await asyncio.wait_for(protocol.received.wait(), 5)
+        # and reads commands
+        stop = emolog.SamplerStop(seq=1).encode()
+        transport.write(stop)
+        assert os.read(master, 1024) == stop
+        transport.close()
+        assert await asyncio.wait_for(transport.lost, 5) is None
+        return protocol
+
+    try:
+        protocol = asyncio.run(run())
+    finally:
+        os.close(master)
+        os.close(slave)
+    assert [m.ticks for m in protocol.messages] == list(range(100))
+    assert protocol.lost
+
+
+def test_redirector_bulk_loopback():
+    import threading
+    import serial
+    from emolog import serial2tcp
+    ser = serial.serial_for_url('loop://', timeout=serial2tcp.READ_TIMEOUT)
+    import socket
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    redirector_side, _ = server.accept()
+    server.close()
+    redirector = serial2tcp.Redirector(ser, redirector_side)
+    thread = threading.Thread(target=redirector.shortcut, daemon=True)
+    thread.start()
+    data = bytes(range(256)) * 400
+    for i in range(0, len(data), 1000):
+        client.sendall(data[i:i + 1000])
+    received = b''
+    client.settimeout(5)
+    while len(received) < len(data):
+        received += client.recv(65536)
+    client.close()
+    thread.join(5)
+    assert received == data
+    assert not redirector.alive
+    for stats in [redirector.read_stats, redirector.write_stats]:
+        assert stats.bytes == len(data)
+        # block reads and writes, not a call per byte
+        assert stats.calls < len(data) / 100
+        assert stats.average_chunk_size > 100
+        assert stats.bytes_per_second > 0
+
+
+def test_futures_timeout_precision():
+    timeout = 0.05
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        futures = emolog.Futures()
+        errors = []
+        for i in range(5):
+            start = loop.time()
+            result = await futures.add_future(timeout=timeout, timeout_result='timeout')
+            assert result == 'timeout'
+            errors.append(loop.time() - start - timeout)
+        # resolved futures drop their timers
+        f = futures.add_future(timeout=10.0, timeout_result='timeout')
+        futures.set_future_result(f, True)
+        assert await f is True
+        await asyncio.sleep(0)
+        assert len(futures._futures) == 0
+        return errors
+
+    errors = asyncio.run(run())
+    # the old reaper polled every 100ms
+    assert max(errors) < 0.02
+    assert min(errors) >= -0.002
+
+
+def test_rotated_recording(tmp_path):
+    import os
+    from emolog.decoders import Decoder
+    from emolog.cylib import default_csv_factory
+    from emolog.recording import binary_writer_factory, read_recording, read_ticks_range
+    from emolog.rotation import read_index, parts_in_range
+    for writer_factory, extension in [(default_csv_factory, '.csv'), (binary_writer_factory, '.emob')]:
+        sampler, handler, _ = make_sampler_and_handler([('a', 4, Decoder(b'a', b'f'))])
+        filename = str(tmp_path / ('emo_001' + extension))
+        handler.reset(csv_filename=filename, names=['a'], min_ticks=1, max_samples=0, writer_factory=writer_factory,
+                      rotate_samples=40, rotate_seconds=0.1)
+        # ticks wrap at 2**32 during the second part, the host time jumps a second in the fourth
+        ticks = [(2 ** 32 - 50 + t) % 2 ** 32 for t in range(150)]
+        timestamp = [1000.0 + t + (1000 if t >= 125 else 0) for t in range(150)]
+        for i in range(0, 150, 30):
+            handler.handle_sampler_samples([(timestamp[t], t % 256, ticks[t], struct.pack('<f', t))
+                                            for t in range(i, i + 30)])
+        handler.stop()
+        index = read_index(str(tmp_path / 'emo_001.index.json'))
+        assert [os.path.basename(part['filename']) for part in index['parts']] == [
+            'emo_001.part{:04}{}'.format(part, extension) for part in range(1, 6)]
+        assert [part['samples'] for part in index['parts']] == [40, 40, 40, 5, 25]
+        first = 2 ** 32 - 50
+        assert [(part['first_ticks'], part['last_ticks']) for part in index['parts']] == [
+            (first, first + 39), (first + 40, first + 79), (first + 80, first + 119), (first + 120, first + 124),
+            (first + 125, first + 149)]
+        assert index['parts'][3]['last_timestamp'] == 1124.0 and index['parts'][4]['first_timestamp'] == 2125.0
+        data = read_recording(str(tmp_path / 'emo_001.index.json'))
+        assert data['a'].tolist() == list(range(150)) and data['ticks'].tolist() == ticks
+        # the range spans the wrap, only the second and third parts are read
+        assert [os.path.basename(part['filename']) for part in parts_in_range(index, first + 45, first + 90)] == [
+            'emo_001.part0002' + extension, 'emo_001.part0003' + extension]
+        data = read_ticks_range(str(tmp_path / 'emo_001.index.json'), first + 45, first + 90)
+        assert data['a'].tolist() == list(range(45, 91))
+        assert len(read_ticks_range(str(tmp_path / 'emo_001.index.json'), first + 1000)) == 0
+        for f in os.listdir(str(tmp_path)):
+            os.remove(str(tmp_path / f))
+
+
+def test_post_processing_ticks_range(tmp_path, monkeypatch):
+    from emolog.decoders import Decoder
+    from emolog.cylib import default_csv_factory
+    from emolog.emotool import post_processing_lib
+    sampler, handler, _ = make_sampler_and_handler([('a', 4, Decoder(b'a', b'f'))])
+    handler.reset(csv_filename=str(tmp_path / 'emo_001.csv'), names=['a'], min_ticks=1, max_samples=0,
+                  writer_factory=default_csv_factory, rotate_samples=40)
+    handler.handle_sampler_samples([(1000.0 + t, t % 256, 100 + t, struct.pack('<f', t)) for t in range(150)])
+    handler.stop()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr('sys.argv', ['post_process', 'emo_001.index.json', '--first-ticks', '145',
+                                     '--last-ticks', '190'])
+    monkeypatch.setattr(post_processing_lib, 'ticks_range', (None, None))
+    loaded = []
+
+    def process(input_filename, output_filename, args):
+        loaded.append(post_processing_lib.load_and_clean(input_filename, [], [])[0])
+    post_processing_lib.post_processing_main(process)
+    assert len(loaded) == 1
+    assert loaded[0].index.tolist() == list(range(145, 191)) and loaded[0]['A'].tolist() == list(range(45, 91))
+
+
+def test_rotated_recording_indexed_while_written(tmp_path):
+    from emolog.decoders import Decoder
+    from emolog.cylib import default_csv_factory
+    from emolog.recording import binary_writer_factory, read_recording
+    from emolog.rotation import read_index, INDEX_INTERVAL_SECONDS
+    for writer_factory, extension in [(default_csv_factory, '.csv'), (binary_writer_factory, '.emob')]:
+        sampler, handler, _ = make_sampler_and_handler([('a', 4, Decoder(b'a', b'f'))])
+        filename = str(tmp_path / ('emo_002' + extension))
+        handler.reset(csv_filename=filename, names=['a'], min_ticks=1, max_samples=0, writer_factory=writer_factory,
+                      rotate_samples=1000)
+        index_filename = str(tmp_path / 'emo_002.index.json')
+
+        def write(first, n, timestamp):
+            handler.handle_sampler_samples([(timestamp, t % 256, t, struct.pack('<f', t)) for t in range(first, first + n)])
+
+        # a part is indexed once it has samples, then every INDEX_INTERVAL_SECONDS, without closing
+        write(0, 10, 1000.0)
+        assert [part['samples'] for part in read_index(index_filename)['parts']] == [10]
+        write(10, 10, 1000.0 + INDEX_INTERVAL_SECONDS * 500)
+        assert [part['samples'] for part in read_index(index_filename)['parts']] == [10]
+        write(20, 10, 1000.0 + INDEX_INTERVAL_SECONDS * 1000)
+        assert [part['samples'] for part in read_index(index_filename)['parts']] == [30]
+        assert read_recording(index_filename)['a'].tolist() == list(range(30))
+        handler.stop()
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from emolog.decoders import Decoder, ArrayDecoder
+from emolog.liveplot import RingBuffer, LivePlot
+
+
+def test_ring_buffer():
+    ring = RingBuffer(5)
+    ring.extend(np.arange(3.))
+    assert ring.view().tolist() == [0., 1., 2.]
+    ring.extend(np.arange(3., 7.))
+    assert ring.view().tolist() == [2., 3., 4., 5., 6.]
+    assert np.shares_memory(ring.view(), ring.data)
+    ring.extend(np.arange(10., 22.))
+    assert ring.view().tolist() == [17., 18., 19., 20., 21.]
+    ring.clear()
+    assert len(ring.view()) == 0
+
+
+def test_live_plot_headless():
+    pytest.importorskip('matplotlib')
+    names = ['speed', 'label']
+    types = [Decoder(b'speed', b'f'), ArrayDecoder(b'label', b'c', 5)]
+    # 1000 ticks per second, 1 second window of 100 points
+    plot = LivePlot(ticks_per_second=1000, window_seconds=1, points_per_second=100, headless=True)
+    data = None
+    for first in range(0, 50000, 1000):
+        # wraps around the uint32 ticks
+        ticks = (np.arange(first, first + 1000, dtype=np.int64) + (1 << 32) - 20000).astype(np.uint32)
+        speed = np.sin(np.arange(first, first + 1000) / 100.)
+        plot.listener(names, types, ticks.astype(np.uint8), ticks, ticks / 1000., [speed, ['x'] * 1000])
+        if data is None:
+            data = plot.buffers[0].data
+    assert plot.names == ['speed']
+    # memory stays the same
+    assert plot.buffers[0].data is data and len(plot.buffers[0]) == plot.capacity
+    times = plot.times.view()
+    assert np.all(np.diff(times) >= 0)
+    assert times[-1] == pytest.approx(((1 << 32) - 20000 + 49999) / 1000., abs=0.02)
+    assert plot.buffers[0].view().max() == pytest.approx(1, abs=1e-3)
+    image = plot.render()
+    assert image.ndim == 3 and image.shape[2] == 4
+    assert plot.draw() is False
+
+
+def test_gui_stopped_by_cleanup(monkeypatch):
+    pytest.importorskip('matplotlib')
+    import asyncio
+    from functools import partial
+    from types import SimpleNamespace
+    from emolog.emotool import main as emotool_main
+    monkeypatch.setattr(emotool_main, 'LivePlot', partial(LivePlot, headless=True))
+    args = SimpleNamespace(ticks_per_second=1000, gui_window=1, gui_points_per_second=100, gui_fps=20,
+                           replay='unused')
+    loop = asyncio.new_event_loop()
+
+    async def run():
+        client = emotool_main.EmoToolClient(ticks_per_second=1000, verbose=False, dump=None, debug=False)
+        emotool_main.start_gui(client, args)
+        task = client.gui_task
+        await asyncio.sleep(0.1)
+        assert not task.done()
+        await emotool_main.cleanup(args, client)
+        # the client's own progress watchdog
+        for other in asyncio.all_tasks() - {asyncio.current_task()}:
+            other.cancel()
+        return task, client
+
+    task, client = loop.run_until_complete(run())
+    loop.close()
+    assert task.cancelled() and client.gui_task is None
@@ -0,0 +1,122 @@
+import asyncio
+
+import numpy as np
+
+from emolog.decoders import Decoder, NamedDecoder, ArrayDecoder
+from emolog.streaming import (SampleStreamServer, SampleStreamClient, StreamSubscriber, OVERFLOW_DECIMATE,
+                              MAX_DECIMATION, FRAME_SUBSCRIBE, encode_frame)
+
+
+NAMES = ['speed', 'mode', 'label']
+TYPES = [Decoder(b'speed', b'f'), NamedDecoder(b'mode', 256, b'B', {0: 'off', 1: 'on'}),
+         ArrayDecoder(b'label', b'c', 5)]
+
+
+def batch(first, rows):
+    seq = np.arange(first, first + rows, dtype=np.uint8)
+    ticks = np.arange(first, first + rows, dtype=np.uint32) * 10
+    timestamp = ticks / 1000.
+    speed = [None if i % 2 else float(i) for i in range(first, first + rows)]
+    values = [speed, np.arange(rows, dtype=np.uint8) % 2, ['x'] * rows]
+    return seq, ticks, timestamp, values
+
+
+class RecordingTransport:
+    def __init__(self):
+        self.frames = []
+
+    def write(self, data):
+        self.frames.append(data)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+
+def test_stream_to_client():
+    loop = asyncio.new_event_loop()
+    server = SampleStreamServer()
+    tcp_server = loop.run_until_complete(loop.create_server(server.protocol_factory, host='localhost', port=0))
+    port = tcp_server.sockets[0].getsockname()[1]
+
+    def read_all():
+        with SampleStreamClient(port=port) as client:
+            return client, list(client)
+
+    async def serve():
+        reader = loop.run_in_executor(None, read_all)
+        while len(server.subscribers) == 0:
+            await asyncio.sleep(0.01)
+        server.listener(NAMES, TYPES, *batch(0, 5))
+        server.listener(NAMES, TYPES, *batch(5, 3))
+        for subscriber in list(server.subscribers):
+            subscriber.transport.close()
+        return await reader
+
+    client, batches = loop.run_until_complete(serve())
+    tcp_server.close()
+    loop.close()
+    assert [c['name'] for c in client.schema] == ['sequence', 'ticks', 'timestamp', 'speed', 'mode']
+    assert client.schema[4]['names'] == {'0': 'off', '1': 'on'}
+    assert [len(b.columns['ticks']) for b in batches] == [5, 3]
+    first = batches[0].columns
+    assert first['ticks'].tolist() == [0, 10, 20, 30, 40]
+    assert first['timestamp'].tolist() == [0, 0.01, 0.02, 0.03, 0.04]
+    assert np.isnan(first['speed'][1]) and first['speed'][[0, 2, 4]].tolist() == [0., 2., 4.]
+    assert batches[1].columns['mode'].tolist() == [0., 1., 0.]
+
+
+def test_slow_subscriber_backpressure():
+    server = SampleStreamServer()
+    fast = server.protocol_factory()
+    fast.connection_made(RecordingTransport())
+    slow = server.protocol_factory()
+    slow.connection_made(RecordingTransport())
+    server.listener(NAMES, TYPES, *batch(0, 10))
+    slow.pause_writing()
+    server.listener(NAMES, TYPES, *batch(10, 10))
+    server.listener(NAMES, TYPES, *batch(20, 10))
+    slow.resume_writing()
+    server.listener(NAMES, TYPES, *batch(30, 10))
+    # schema + 4 batches, the first shared between both
+    assert len(fast.transport.frames) == 5
+    assert fast.transport.frames[1] is slow.transport.frames[1]
+    assert len(slow.transport.frames) == 3
+    assert slow.rows_dropped == 20 and slow.rows_sent == 20 and fast.rows_sent == 40
+
+
+def test_slow_subscriber_decimated():
+    server = SampleStreamServer(overflow=OVERFLOW_DECIMATE)
+    subscriber = server.protocol_factory()
+    assert isinstance(subscriber, StreamSubscriber)
+    subscriber.connection_made(RecordingTransport())
+    subscriber.pause_writing()
+    server.listener(NAMES, TYPES, *batch(0, 5))
+    server.listener(NAMES, TYPES, *batch(5, 5))
+    assert subscriber.decimation == 4
+    # every 2nd row, then every 4th continuing evenly spaced
+    assert subscriber.rows_sent == 3 + 1
+    for i in range(10):
+        server.listener(NAMES, TYPES, *batch(10, 5))
+    assert subscriber.decimation == MAX_DECIMATION and subscriber.rows_dropped > 0
+    subscriber.resume_writing()
+    server.listener(NAMES, TYPES, *batch(0, 5))
+    assert subscriber.decimation == MAX_DECIMATION // 2
+
+
+def test_subscriber_rates():
+    # ticks are 10 apart: 100 samples per second at 1000 ticks per second
+    server = SampleStreamServer(points_per_second=20, decimation='stride', ticks_per_second=1000)
+    default, full, minmax = [server.protocol_factory() for _ in range(3)]
+    for subscriber in [default, full, minmax]:
+        subscriber.connection_made(RecordingTransport())
+    full.data_received(encode_frame(FRAME_SUBSCRIBE, b'{"points_per_second": 0}'))
+    request = encode_frame(FRAME_SUBSCRIBE, b'{"points_per_second": 10, "decimation": "minmax"}')
+    minmax.data_received(request[:3])
+    minmax.data_received(request[3:])
+    for first in range(0, 100, 20):
+        server.listener(NAMES, TYPES, *batch(first, 20))
+    assert full.rows_sent == 100
+    assert default.rows_sent == 20
+    # a pair of rows per 200 ticks, the last one held back
+    assert minmax.rows_sent == 8
+    assert len(server.decimators) == 2
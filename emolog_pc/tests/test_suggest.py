@@ -0,0 +1,56 @@
+from pathlib import Path
+from time import perf_counter
+
+import pytest
+
+from emolog.suggest import SuggestionIndex, edit_distance, deletions
+from emolog.dwarfutil import dwarf_get_variables_by_name
+from emolog import elfcache
+
+
+example_out = Path(__file__).parent / 'example.out'
+
+
+def test_edit_distance():
+    assert edit_distance('motor', 'motor') == 0
+    assert edit_distance('motor', 'motr') == 1
+    assert edit_distance('motor', 'mtoor') == 1
+    assert edit_distance('motor', 'rotor') == 1
+    assert edit_distance('motor', 'mtr') == 2
+    assert edit_distance('', 'ab') == 2
+    assert deletions('ab', 2) == {'ab', 'a', 'b', ''}
+
+
+def test_suggest_dotted_paths():
+    index = SuggestionIndex(['motor.state', 'motor.speed', 'pump.state', 'pump.pressure', 'Motor_Count', 'x'])
+    assert index.suggest('motr.stte') == ['motor.state']
+    assert index.suggest('motor.sped') == ['motor.speed']
+    assert index.suggest('pump.stat') == ['pump.state']
+    assert index.suggest('motor_count') == ['Motor_Count']
+    # a leaf without its path suggests the names ending with it
+    assert index.suggest('state') == ['pump.state', 'motor.state']
+    assert index.suggest('unrelated') == []
+
+
+def test_suggest_scale():
+    names = ['module{}.channel{}.field_{}'.format(m, c, f) for m in range(50) for c in range(40) for f in
+             ['gain', 'offset', 'value', 'limit', 'state', 'filter', 'count', 'error', 'enable', 'mode']]
+    start = perf_counter()
+    index = SuggestionIndex(names)
+    built = perf_counter() - start
+    start = perf_counter()
+    suggestions = index.suggest('module7.chanel3.field_gian')
+    took = perf_counter() - start
+    assert suggestions[0] == 'module7.channel3.field_gain'
+    assert built < 5 and took < 0.1, (built, took)
+
+
+def test_missing_variable_suggestions(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv(elfcache.CACHE_DIR_ENV, str(tmp_path))
+    for cache in [False, True]:
+        with pytest.raises(SystemExit):
+            dwarf_get_variables_by_name(str(example_out), ['var_itn', 's.y', 's_aray.z'], cache=cache)
+        out = capsys.readouterr().out
+        assert 'var_itn is close to var_int' in out
+        assert 's_aray.z is close to s_array.z' in out
+    assert isinstance(elfcache.read_suggestion_index(str(example_out)), SuggestionIndex)
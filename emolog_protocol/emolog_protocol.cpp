@@ -129,7 +129,13 @@ int header_check_start(const emo_header *header)
 
 uint16_t emo_encode_version(uint8_t *dest, uint8_t reply_to_seq)
 {
-    emo_version_payload payload = {EMOLOG_PROTOCOL_VERSION, reply_to_seq, 0};
+    return emo_encode_version_window(dest, reply_to_seq, 0);
+}
+
+
+uint16_t emo_encode_version_window(uint8_t *dest, uint8_t reply_to_seq, uint8_t window)
+{
+    emo_version_payload payload = {EMOLOG_PROTOCOL_VERSION, reply_to_seq, window};
 
     write_message(dest, EMO_MESSAGE_TYPE_VERSION, sizeof(payload), (const uint8_t *)&payload);
     return sizeof(emo_version);
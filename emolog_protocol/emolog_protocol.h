@@ -82,7 +82,8 @@ typedef struct emo_ ## payload_name {    \
 typedef struct emo_version_payload {
     uint16_t   protocol_version;
     uint8_t    reply_to_seq; // -1 if initiating, seq of replied to message if responding
-    uint8_t    reserved;
+    uint8_t    window;       // requests the sender can receive before replying to the first,
+                             // 0 (old senders, reserved) or 1 means one at a time
 } PACKED emo_version_payload;
 
 MAKE_STRUCT(version)
@@ -169,6 +170,13 @@ MAKE_STRUCT(sampler_sample)
 EXPORT uint16_t emo_encode_version(uint8_t *dest, uint8_t reply_to_seq);
 
 
+/*
+ * version, advertising a receive window: the host may send up to window
+ * requests before getting the ack of the first one.
+ */
+EXPORT uint16_t emo_encode_version_window(uint8_t *dest, uint8_t reply_to_seq, uint8_t window);
+
+
 /*
  * The simplest message that the sending of requires an ack.
  */